@@ -0,0 +1,61 @@
+"""
+Benchmark of the fused `to_uint8` conversion against the normalize, true color and
+cast chain used to produce RGB images
+
+    python benchmarks/bench_to_uint8.py --size 4096
+"""
+import argparse
+import timeit
+
+import numpy
+
+from geotoys import process
+
+
+def chain(x):
+    return process.normalize(process.true_color(x), 0, 255).astype("uint8")
+
+
+def fused(x, out):
+    scale, offset = process.stretch_coefficients(x.min(), x.max())
+    return process.to_uint8(x, scale, offset, out=out)
+
+
+def numpy_fused(x, out):
+    scale, offset = process.stretch_coefficients(x.min(), x.max())
+    process._numpy_uint8(x, scale, offset, 0.0, 255.0, None, 0, out)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=4096, help="Size of band")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs")
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    x = rng.integers(0, 10000, (args.size, args.size)).astype("uint16")
+    out = numpy.empty(x.shape, dtype="uint8")
+
+    # Compile numba kernel, if installed, before timing
+    fused(x[:16, :16], out[:16, :16])
+
+    kernel = "numba" if process._numba_uint8_kernel() else "numpy"
+    cases = [
+        ("normalize(true_color(x)).astype", lambda: chain(x)),
+        (f"to_uint8 ({kernel})", lambda: fused(x, out)),
+        ("to_uint8 (numpy threads)", lambda: numpy_fused(x, out)),
+        ]
+
+    print(f"{args.size}x{args.size} uint16 band, best of {args.repeat}")
+    baseline = None
+    for name, func in cases:
+        t = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        baseline = baseline or t
+        print(f"{name:<35} {t * 1000:8.1f} ms  {baseline / t:5.1f}x")
+
+    assert (chain(x) == fused(x, out)).mean() > 0.999
+
+
+if __name__ == "__main__":
+    main()
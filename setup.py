@@ -14,10 +14,13 @@ def read(fp):
 install_requires = [
     # NOTE, workaround for the PEP517 error until Cartopy >0.17.0 is released
     # https://github.com/SciTools/cartopy/issues/1270#issuecomment-458933013
+    "aiohttp>=3.5.4",
     "Cartopy==0.16.0",
+    "dask[array]>=1.1.4",
     "descartes>=1.1.0",
     "geopandas>=0.4.1",
     "netCDF4==1.5.0.1",
+    "numcodecs>=0.6.3",
     "numpy>=1.16.2",
     "matplotlib>=3.0.3",
     "pandas>=0.24.2",
@@ -28,6 +31,8 @@ install_requires = [
     "sentinelsat>=0.13",
     "scipy>=1.2.1",
     "Shapely>=1.6.4",
+    "xarray>=0.12.1",
+    "zarr>=2.3.1",
 ]
 
 with open("README.md", "r") as f:
@@ -49,5 +54,8 @@ setup(
     long_description=long_description,
     long_description_type="text/markdown",
     install_requires=install_requires,
+    entry_points={
+        "console_scripts": ["geotoys-quicklook=geotoys.jpeg2000:main"],
+    },
     test_suite="tests",
 )
@@ -0,0 +1,259 @@
+"""
+Module containing a persistent catalog of raster files for spatial and temporal queries
+"""
+import logging
+import sqlite3
+
+_logger = logging.getLogger(__name__)
+
+EXTENSIONS = (".tif", ".tiff", ".jp2")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    timestamp INTEGER,
+    crs TEXT,
+    left REAL,
+    bottom REAL,
+    right REAL,
+    top REAL,
+    res_x REAL,
+    res_y REAL,
+    band TEXT
+);
+CREATE INDEX IF NOT EXISTS files_timestamp ON files (timestamp);
+CREATE INDEX IF NOT EXISTS files_band ON files (band);
+CREATE VIRTUAL TABLE IF NOT EXISTS bounds USING rtree (id, minx, maxx, miny, maxy);
+"""
+
+
+class Catalog(object):
+    """
+    Index of GeoTIFF and JPEG2000 files stored in an SQLite database
+
+    The path, modification time, size, timestamp, CRS, bounds, resolution and band
+    name of each file are stored, with the bounds in longitude and latitude in an
+    R-tree for spatial queries. Updating the catalog only reads the headers of
+    files that are new or modified since the last update.
+
+    Example
+    =======
+    >>> with Catalog("catalog.sqlite") as catalog:
+    ...     catalog.update("/data/sentinel")
+    ...     files = catalog.query(bbox=(10.0, 59.0, 11.0, 60.0), band="B04")
+    """
+
+    def __init__(self, path_db):
+        self.conn = sqlite3.connect(path_db)
+        self.conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, path, exts=EXTENSIONS, n_workers=8):
+        """
+        Add new and modified files under a path and remove those that no longer exist
+
+        Parameters
+        ==========
+        path: str
+            Path to directory to recursively search for files
+        exts: tuple of str
+            Extensions of files to be added to the catalog
+        n_workers: int
+            Number of threads used to list directories and read file headers
+
+        Returns
+        =======
+        n_updated: int
+            Number of files added or updated
+        n_removed: int
+            Number of files removed
+
+        Files whose headers can not be read are logged and skipped, and are
+        read again at the next update.
+        """
+        import concurrent.futures
+        import os
+
+        from geotoys.system import scan
+
+        path = os.path.abspath(path)
+
+        files = dict()
+        for fp in scan(path, exts=exts, n_threads=n_workers):
+            stat = os.stat(fp)
+            files[fp] = (stat.st_mtime, stat.st_size)
+
+        # Match the path prefix exactly, as `LIKE` treats `_` and `%` as
+        # wildcards and ignores case
+        prefix = os.path.join(path, "")
+        rows = self.conn.execute(
+            "SELECT id, path, mtime, size FROM files WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix),
+            )
+        indexed = {fp: (i, (mtime, size)) for i, fp, mtime, size in rows}
+
+        removed = [i for fp, (i, _) in indexed.items() if fp not in files]
+        modified = [
+            fp for fp, stat in files.items()
+            if fp not in indexed or indexed[fp][1] != stat
+            ]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            records = list(executor.map(_try_read_record, modified))
+
+        with self.conn:
+            self._delete(removed + [indexed[fp][0] for fp in modified if fp in indexed])
+            for fp, record in zip(modified, records):
+                if record is None:
+                    continue
+                mtime, size = files[fp]
+                cursor = self.conn.execute(
+                    "INSERT INTO files (path, mtime, size, timestamp, crs, left, "
+                    "bottom, right, top, res_x, res_y, band) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (fp, mtime, size) + record["values"],
+                    )
+                if record["lonlat_bounds"]:
+                    self.conn.execute(
+                        "INSERT INTO bounds VALUES (?, ?, ?, ?, ?)",
+                        (cursor.lastrowid,) + record["lonlat_bounds"],
+                        )
+
+        n_failed = sum(record is None for record in records)
+
+        return len(modified) - n_failed, len(removed)
+
+    def _delete(self, ids):
+        """
+        Delete files from the catalog by their row ids
+        """
+        self.conn.executemany("DELETE FROM files WHERE id = ?", [(i,) for i in ids])
+        self.conn.executemany("DELETE FROM bounds WHERE id = ?", [(i,) for i in ids])
+
+    def query(self, bbox=None, ts0=None, ts1=None, band=None, crs=None):
+        """
+        Find files intersecting a bounding box, time range, band and CRS
+
+        Parameters
+        ==========
+        bbox: tuple of float
+            Bounding box in longitude and latitude (lon0, lat0, lon1, lat1)
+        ts0: str or pandas.Timestamp
+            Start of time range, inclusive
+        ts1: str or pandas.Timestamp
+            End of time range, inclusive
+        band: str or list of str
+            Band name(s), e.g. `B04`
+        crs: str
+            CRS of files as WKT
+
+        Returns
+        =======
+        files: list of str
+            Paths of matching files ordered by timestamp
+        """
+        from geotoys.datetime import utc_timestamp
+
+        sql = "SELECT f.path FROM files f"
+        where = list()
+        params = list()
+
+        if bbox is not None:
+            lon0, lat0, lon1, lat1 = bbox
+            sql += " JOIN bounds b ON f.id = b.id"
+            where.append("b.minx <= ? AND b.maxx >= ? AND b.miny <= ? AND b.maxy >= ?")
+            params += [lon1, lon0, lat1, lat0]
+        if ts0 is not None:
+            where.append("f.timestamp >= ?")
+            params.append(utc_timestamp(ts0).value)
+        if ts1 is not None:
+            where.append("f.timestamp <= ?")
+            params.append(utc_timestamp(ts1).value)
+        if band is not None:
+            bands = [band] if isinstance(band, str) else list(band)
+            where.append(f"f.band IN ({', '.join('?' * len(bands))})")
+            params += bands
+        if crs is not None:
+            where.append("f.crs = ?")
+            params.append(crs)
+
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY f.timestamp, f.path"
+
+        return [fp for fp, in self.conn.execute(sql, params)]
+
+
+def band_from_filename(fp):
+    """
+    Get the Sentinel band label in a file name, or `None` if not found
+
+    Masks and auxiliary images of SAFE products, which are named like bands (e.g.
+    `QI_DATA/MSK_DETFOO_B02.jp2`), have no band.
+    """
+    import os
+
+    from geotoys.jpeg2000 import BAND_PATTERN, SAFE_EXCLUDE_DIRS
+
+    if any(d in SAFE_EXCLUDE_DIRS for d in fp.split(os.sep)):
+        return None
+    match = BAND_PATTERN.search(os.path.basename(fp))
+
+    return match.group(1) if match else None
+
+
+def _try_read_record(fp):
+    """
+    Read the header values of a raster file with `_read_record`, logging and
+    returning `None` if it can not be read
+    """
+    try:
+        return _read_record(fp)
+    except Exception as e:
+        _logger.warning(f"Skipping {fp}, which could not be read: {e}")
+        return None
+
+
+def _read_record(fp):
+    """
+    Read the header values of a raster file to be stored in the catalog
+    """
+    import os
+    import rasterio
+    from rasterio.warp import transform_bounds
+
+    from geotoys.datetime import timestamp_from_string
+
+    ts = timestamp_from_string(os.path.basename(fp))
+    band = band_from_filename(fp)
+
+    with rasterio.open(fp) as src:
+        crs = src.crs.to_wkt() if src.crs else None
+        if band is None and src.count == 1 and src.descriptions[0]:
+            band = src.descriptions[0]
+
+        lonlat_bounds = None
+        if src.crs:
+            lon0, lat0, lon1, lat1 = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+            lonlat_bounds = (lon0, lon1, lat0, lat1)
+
+        values = (
+            ts.value if ts is not None else None,
+            crs,
+            *src.bounds,
+            *src.res,
+            band,
+            )
+
+    return {"values": values, "lonlat_bounds": lonlat_bounds}
@@ -1,11 +1,91 @@
 """
 This module containes methods for performing common tasks with timestamps
 """
+import functools
+import re
+
+_DATE = r"(?P<year>[12]\d{3})(?P<sep>-?)(?P<month>0[1-9]|1[0-2])(?P=sep)" \
+        r"(?P<day>0[1-9]|[12]\d|3[01])"
+_TIME = r"(?P<hour>[01]\d|2[0-3])(?P<tsep>:?)(?P<minute>[0-5]\d)" \
+        r"(?:(?P=tsep)(?P<second>[0-5]\d|60))?" \
+        r"(?P<offset>Z|[+-](?:[01]\d|2[0-3]):?[0-5]\d)?"
+
+# Patterns of timestamps in strings, tried in order until one is found. Patterns
+# have named groups `year`, `month`, `day` and optionally `hour`, `minute`,
+# `second` and UTC `offset` (`Z` or `+HH:MM`), without which times are in UTC.
+TIMESTAMP_PATTERNS = [
+    # Sentinel and compact ISO 8601, e.g. `20190101T104441` or `20190101T104441Z`
+    re.compile(rf"(?<!\d){_DATE}T{_TIME}(?!\d)"),
+    # ISO 8601, e.g. `2012-01-05T08:42:00+01:00`, `2012-01-05 08:42` or
+    # `2012-01-05_08:42`
+    re.compile(rf"(?<!\d){_DATE}(?:[T _]{_TIME})?(?!\d)"),
+    # Digits only, e.g. `201201050842` or `20120105`
+    re.compile(
+        r"(?<!\d)(?P<year>[12]\d{3})(?P<month>0[1-9]|1[0-2])"
+        r"(?P<day>0[1-9]|[12]\d|3[01])"
+        r"(?:(?P<hour>[01]\d|2[0-3])(?P<minute>[0-5]\d)(?P<second>[0-5]\d)?)?(?!\d)"
+        ),
+    ]
+
+
+def register_pattern(pattern, index=0):
+    """
+    Add a timestamp pattern, tried before the existing patterns by default
+
+    Parameters
+    ==========
+    pattern: str or re.Pattern
+        Regular expression with named groups `year`, `month`, `day` and optionally
+        `hour`, `minute`, `second` and `offset`
+    index: int
+        Position of the pattern in `TIMESTAMP_PATTERNS`
+    """
+    TIMESTAMP_PATTERNS.insert(index, re.compile(pattern))
+    _parse.cache_clear()
+
+
+@functools.lru_cache(maxsize=2 ** 16)
+def _parse(s):
+    """
+    Find a timestamp in a string with the first matching pattern, returning it as
+    an ISO 8601 string without offset and its UTC offset in minutes, or `None` if
+    not found
+    """
+    for pattern in TIMESTAMP_PATTERNS:
+        match = pattern.search(s)
+        if match:
+            g = match.groupdict()
+            iso = (
+                f"{g['year']}-{g['month']}-{g['day']}T{g.get('hour') or '00'}:"
+                f"{g.get('minute') or '00'}:{g.get('second') or '00'}"
+                )
+            return iso, _offset_minutes(g.get("offset"))
+
+    return None
+
+
+def _offset_minutes(offset):
+    """
+    Get the minutes of a UTC offset, e.g. `Z`, `+01:00` or `-0530`
+    """
+    if not offset or offset == "Z":
+        return 0
+
+    digits = offset[1:].replace(":", "")
+    minutes = int(digits[:2]) * 60 + int(digits[2:])
+
+    return -minutes if offset[0] == "-" else minutes
+
 
 def timestamp_from_string(s):
     """
     Locate a timestamp in a string with common separators
 
+    Timestamps are found with the patterns of `TIMESTAMP_PATTERNS`, e.g. Sentinel
+    `20190101T104441`, `201201050842` or ISO 8601 `2012-01-05T08:42`. Times with
+    a UTC offset, e.g. `2012-01-05T08:42+01:00`, are converted to UTC, and times
+    without are taken to be in UTC.
+
     Arguments
     =========
     s: str
@@ -14,19 +94,60 @@ def timestamp_from_string(s):
     Returns
     =======
     ts: pandas.Timestamp
-        Timestamp in string. If no timestamp found, `None` is returned
+        Timestamp in string in UTC. If no timestamp found, `None` is returned
     """
     import pandas
 
-    ts = None
-    for sub in s.split("_"):
-        try:
-            ts = utc_timestamp(sub)
-            break
-        except:
-            pass
+    parsed = _parse(s)
+    if parsed is None:
+        return None
+    iso, offset = parsed
 
-    return ts
+    try:
+        return pandas.Timestamp(iso, tz="UTC") - pandas.Timedelta(minutes=offset)
+    except ValueError:
+        # Non-existent dates, e.g. 20190230
+        return None
+
+
+def timestamps_from_strings(strings):
+    """
+    Locate timestamps in many strings, e.g. file names
+
+    Arguments
+    =========
+    strings: list of str
+        Strings to search for timestamps, see `timestamp_from_string`
+
+    Returns
+    =======
+    timestamps: ndarray
+        Timestamps as `datetime64[ns]` in UTC, `NaT` where not found
+    """
+    import numpy
+
+    parsed = [_parse(s) or ("NaT", 0) for s in strings]
+    isos = [iso for iso, _ in parsed]
+    offsets = numpy.array([offset for _, offset in parsed], dtype="timedelta64[m]")
+    try:
+        timestamps = numpy.array(isos, dtype="datetime64[s]")
+    except ValueError:
+        # Non-existent dates, e.g. 20190230
+        timestamps = numpy.array([_to_datetime64(iso) for iso in isos])
+
+    return (timestamps - offsets).astype("datetime64[ns]")
+
+
+def _to_datetime64(iso):
+    """
+    Convert an ISO 8601 string to `datetime64[s]`, or NaT if not a valid date
+    """
+    import numpy
+
+    try:
+        return numpy.datetime64(iso, "s")
+    except ValueError:
+        return numpy.datetime64("NaT", "s")
 
 
 def utc_timestamp(ts):
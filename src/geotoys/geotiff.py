@@ -1,30 +1,591 @@
 """
 Methods for generating datasets in various formats from GeoTIFF files
 """
+import collections
 import concurrent.futures
+import functools
 import rasterio
 import numpy
 import pandas
 
-from tfol.utils import make_nparray, utc_timestamp
+# Number of GeoTIFF handles each sampling process keeps open between jobs
+MAX_OPEN_DATASETS = 64
 
-def as_xarray(catalog):
+_datasets = collections.OrderedDict()
+
+# Number of GeoTIFF headers kept in memory, see `_header`
+MAX_HEADERS = 4096
+
+
+def as_xarray(catalog, bands=None, chunks=None, n_workers=8):
     """
     Create an xarray dataset from a collection of GeoTiff files
+
+    Only the headers of the GeoTIFFs are read when creating the dataset. Each band
+    is a dask array with dimensions (time, y, x), with a chunk for each block of
+    each file, so that pixel data are only read when computed and are read in
+    parallel by dask.
+
+    Parameters
+    ----------
+    catalog: list of str
+        List of GeoTIFF file paths sharing the same grid. Time coordinates are
+        parsed from the file names.
+    bands: list of str
+        Names corresponding to each band of data in the GeoTIFFs
+    chunks: tuple of int
+        Chunk size for the y and x dimensions. Defaults to the block size of the
+        GeoTIFFs.
+    n_workers: int
+        Number of threads used to read the GeoTIFF headers
+
+    Returns
+    -------
+    ds: xarray.Dataset
+        Lazy dataset with a variable for each band of the GeoTIFFs
     """
-    raise NotImplementedError()
+    import dask.array
+    import dask.base
+    import xarray
+
+    files = [str(fp) for fp in catalog]
+    files = sorted(files, key=lambda fp: (_file_timestamp(fp), fp))
+    if not files:
+        raise ValueError("No GeoTIFF files provided")
+
+    # Read headers concurrently, failing on the first file not matching the grid
+    # without waiting for the headers of the files queued after it
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_header, fp) for fp in files]
+        try:
+            grid = futures[0].result()
+            for fp, future in zip(files[1:], futures[1:]):
+                if future.result()["grid"] != grid["grid"]:
+                    raise ValueError(
+                        f"Grid of {fp} does not match that of {files[0]}"
+                        )
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    if chunks is None:
+        chunks = grid["block_shape"]
+    bands = _band_names(grid["descriptions"], bands)
+
+    transform = rasterio.Affine(*grid["grid"]["transform"])
+    width, height = grid["grid"]["width"], grid["grid"]["height"]
+    dtype = numpy.dtype(grid["grid"]["dtype"])
+    coords = {
+        "time": pandas.to_datetime(_file_timestamps(files)),
+        "y": transform.f + (numpy.arange(height) + 0.5) * transform.e,
+        "x": transform.c + (numpy.arange(width) + 0.5) * transform.a,
+        }
+
+    data_vars = dict()
+    for i, band in enumerate(bands, start=1):
+        stack = _GeoTiffStack(files, i, (len(files), height, width), dtype)
+        data = dask.array.from_array(
+            stack,
+            chunks=(1,) + tuple(chunks),
+            name="geotiff-" + dask.base.tokenize(files, i, chunks),
+            lock=False,
+            asarray=False,
+            fancy=False,
+            meta=numpy.empty((0, 0, 0), dtype=dtype),
+            )
+        data_vars[band] = (("time", "y", "x"), data)
 
+    attrs = {
+        "crs": grid["grid"]["crs"],
+        "transform": grid["grid"]["transform"],
+        "nodata": grid["grid"]["nodata"],
+        }
 
-def as_zarr(catalog):
+    return xarray.Dataset(data_vars, coords=coords, attrs=attrs)
+
+
+class _GeoTiffStack(object):
+    """
+    Array-like stack of a band of GeoTIFFs along time, read when indexed
+    """
+    def __init__(self, files, band, shape, dtype):
+        self.files = files
+        self.band = band
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = len(shape)
+
+    def __getitem__(self, key):
+        from rasterio.windows import Window
+
+        ix_t, rows, cols = key
+        window = Window.from_slices(rows, cols, height=self.shape[1],
+                                    width=self.shape[2])
+
+        data = list()
+        for fp in self.files[ix_t]:
+            with rasterio.open(fp) as src:
+                data.append(src.read(self.band, window=window))
+
+        return numpy.stack(data)
+
+
+def _header(fp):
+    """
+    Read the grid and block shape of a GeoTIFF, cached until the file is modified
+    """
+    import os
+
+    stat = os.stat(fp)
+
+    return _read_header(fp, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=MAX_HEADERS)
+def _read_header(fp, mtime_ns, size):
+    """
+    Read the grid and block shape of a GeoTIFF, keeping the `MAX_HEADERS` most
+    recently used headers by path, modification time and size
+    """
+    with rasterio.open(fp) as src:
+        return {
+            "grid": _grid(src),
+            "block_shape": src.block_shapes[0],
+            "descriptions": list(src.descriptions),
+            }
+
+
+def as_zarr(catalog, store, chunks=(1, 512, 512), compressor=None, n_workers=4):
     """
     Create a zarr dataset from a collection of GeoTiff files
 
     Zarr datasets are optimal Dask analysis.
+
+    The GeoTIFFs are written to a `data` array with dimensions (time, band, y, x),
+    with one time step per file and their timestamps written to a `time` array.
+    Files are processed concurrently, each worker reading and writing a single
+    chunk at a time, so memory use is bounded by `n_workers` chunks.
+
+    Files already written to an existing store are skipped and new files are
+    appended to the end of the time axis, raising a `ValueError` if any is older
+    than the last time step of the store. A file is only marked as `complete` once
+    all of its chunks are written, so an interrupted run is resumed by calling
+    `as_zarr` again with the same catalog.
+
+    Parameters
+    ----------
+    catalog: list of str
+        List of GeoTIFF file paths sharing the same grid
+    store: str or zarr store
+        Path or zarr store to write the dataset to
+    chunks: tuple of int
+        Chunk size for the band, y and x dimensions. Time is chunked per file.
+    compressor: numcodecs codec
+        Compressor used for the `data` array. Defaults to Blosc with zstd.
+    n_workers: int
+        Number of files to be read and written concurrently
+
+    Returns
+    -------
+    group: zarr.hierarchy.Group
+        Zarr group containing the `data`, `time` and `complete` arrays
+    """
+    import numcodecs
+    import zarr
+
+    if compressor is None:
+        compressor = numcodecs.Blosc(cname="zstd", clevel=3)
+
+    catalog = [str(fp) for fp in catalog]
+    if not catalog:
+        raise ValueError("No GeoTIFF files provided to write")
+
+    with rasterio.open(catalog[0]) as src:
+        grid = _grid(src)
+    group = zarr.open_group(store, mode="a")
+
+    # Create arrays for an empty store, otherwise check the grid matches
+    if "data" not in group:
+        shape = (0, grid["count"], grid["height"], grid["width"])
+        group.create_dataset(
+            "data",
+            shape=shape,
+            chunks=(1,) + tuple(chunks),
+            dtype=grid["dtype"],
+            compressor=compressor,
+            fill_value=grid["nodata"],
+            )
+        group.create_dataset("time", shape=(0,), chunks=(4096,), dtype="M8[ns]")
+        group.create_dataset("complete", shape=(0,), chunks=(4096,), dtype=bool)
+        group["data"].attrs["_ARRAY_DIMENSIONS"] = ["time", "band", "y", "x"]
+        group["time"].attrs["_ARRAY_DIMENSIONS"] = ["time"]
+        group["complete"].attrs["_ARRAY_DIMENSIONS"] = ["time"]
+        group.attrs.update({
+            "crs": grid["crs"],
+            "transform": grid["transform"],
+            "files": list(),
+            })
+    elif [group.attrs["crs"], group.attrs["transform"]] != [
+            grid["crs"], grid["transform"]]:
+        raise ValueError(f"Grid of {catalog[0]} does not match the zarr store")
+
+    data, time, complete = group["data"], group["time"], group["complete"]
+
+    # Register new files at the end of the time axis, before writing any data.
+    # Inserting earlier scenes would rewrite every later time step of the store, so
+    # files older than the last stored one are refused to keep the time axis sorted
+    files = list(group.attrs["files"])
+    new = sorted(set(catalog) - set(files), key=lambda fp: (_file_timestamp(fp), fp))
+    if new:
+        timestamps = _file_timestamps(new)
+        if files and timestamps[0] < time[len(files) - 1]:
+            raise ValueError(
+                f"Timestamp of {new[0]} is before the last time step of the zarr "
+                "store, files can only be appended in time order"
+                )
+        n = len(files) + len(new)
+        data.resize(n, *data.shape[1:])
+        time.resize(n)
+        complete.resize(n)
+        time[len(files):] = timestamps
+        complete[len(files):] = False
+        files += new
+        group.attrs["files"] = files
+
+    # Write files not yet completed, marking each complete once written
+    incomplete = numpy.flatnonzero(~complete[:])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(_write_zarr_time_step, files[i], data, i, grid): i
+            for i in incomplete
+            }
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            complete[futures[future]] = True
+
+    return group
+
+
+def _grid(src):
+    """
+    Get the grid definition and data type of an open GeoTIFF
+    """
+    grid = {
+        "crs": src.crs.to_wkt() if src.crs else None,
+        "transform": list(src.transform)[:6],
+        "width": src.width,
+        "height": src.height,
+        "count": src.count,
+        "dtype": src.dtypes[0],
+        "nodata": src.nodata if src.nodata is not None else 0,
+        }
+
+    return grid
+
+
+def _write_zarr_time_step(fp, data, ix_t, grid):
+    """
+    Write a GeoTIFF to a time step of a zarr array, one chunk at a time
+    """
+    from rasterio.windows import Window
+
+    with rasterio.open(fp) as src:
+        if _grid(src) != grid:
+            raise ValueError(f"Grid of {fp} does not match the zarr store")
+
+        _, _, chunk_h, chunk_w = data.chunks
+        for row0 in range(0, src.height, chunk_h):
+            for col0 in range(0, src.width, chunk_w):
+                rows = slice(row0, min(row0 + chunk_h, src.height))
+                cols = slice(col0, min(col0 + chunk_w, src.width))
+                data[ix_t, :, rows, cols] = src.read(
+                    window=Window.from_slices(rows, cols)
+                )
+
+
+def _open(fp):
+    """
+    Open a GeoTIFF for reading, reusing the handle if already open in this process
+
+    The least recently used handles are closed once more than `MAX_OPEN_DATASETS`
+    are open.
+    """
+    src = _datasets.pop(fp, None)
+    if src is None or src.closed:
+        src = rasterio.open(fp)
+    _datasets[fp] = src
+
+    while len(_datasets) > MAX_OPEN_DATASETS:
+        _, src_old = _datasets.popitem(last=False)
+        src_old.close()
+
+    return src
+
+
+def _band_names(descriptions, bands=None):
+    """
+    Get names for each band of a GeoTIFF from its band descriptions if not provided
+    """
+    if bands:
+        return list(bands)
+    # Labels from GeoTIFF descriptions
+    if any(descriptions):
+        return list(descriptions)
+    # Generic enumerated labels
+    return [f"band_{i}" for i in range(len(descriptions))]
+
+
+def _file_timestamp(fp):
+    """
+    Get the timestamp in a GeoTIFF file name as a naive UTC datetime64, or NaT
+    """
+    return _file_timestamps([fp])[0]
+
+
+def _file_timestamps(files):
+    """
+    Get the timestamps in GeoTIFF file names as naive UTC datetime64, or NaT
+    """
+    import os
+
+    from geotoys.datetime import timestamps_from_strings
+
+    return timestamps_from_strings([os.path.basename(fp) for fp in files])
+
+
+def _pixel_index(transform, width, height, x, y, method="nearest"):
+    """
+    Convert x, y coordinates to the pixel row and column indices to be sampled
+
+    Parameters
+    ----------
+    transform: affine.Affine
+        Geotransform of the GeoTIFF
+    width: int
+        Number of columns in the GeoTIFF
+    height: int
+        Number of rows in the GeoTIFF
+    x: ndarray
+        X coordinate positions
+    y: ndarray
+        Y coordinate positions
+    method: str
+        Sampling method, either `nearest` or `bilinear`
+
+    Returns
+    -------
+    rows: ndarray (k, n_points)
+        Row indices of the pixels sampled for each point. One pixel is sampled per
+        point for `nearest` and the four surrounding pixel centers for `bilinear`.
+    cols: ndarray (k, n_points)
+        Column indices of the pixels sampled for each point
+    weights: ndarray (k, n_points)
+        Interpolation weights of each pixel sampled, `None` for `nearest`
+    inside: ndarray
+        Boolean array, `True` where a point falls within the GeoTIFF
+    """
+    cols, rows = ~transform * (x, y)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+    if method == "nearest":
+        rows = numpy.floor(rows[numpy.newaxis]).astype(int)
+        cols = numpy.floor(cols[numpy.newaxis]).astype(int)
+        return rows, cols, None, inside
+
+    if method != "bilinear":
+        raise ValueError("`method` must be one of nearest bilinear")
+
+    # Interpolate between neighbouring pixel centers, clamping at the edges
+    rows = numpy.where(inside, rows - 0.5, 0)
+    cols = numpy.where(inside, cols - 0.5, 0)
+    row0 = numpy.floor(rows)
+    col0 = numpy.floor(cols)
+    dr = rows - row0
+    dc = cols - col0
+    row0 = row0.astype(int)
+    col0 = col0.astype(int)
+
+    rows = numpy.clip(numpy.stack([row0, row0, row0 + 1, row0 + 1]), 0, height - 1)
+    cols = numpy.clip(numpy.stack([col0, col0 + 1, col0, col0 + 1]), 0, width - 1)
+    weights = numpy.stack([(1 - dr) * (1 - dc), (1 - dr) * dc, dr * (1 - dc), dr * dc])
+
+    return rows, cols, weights, inside
+
+
+def _read_pixels(src, rows, cols):
+    """
+    Read the values of all bands at given pixel indices
+
+    Pixels are grouped by the internal block of the GeoTIFF they fall in, so that
+    each block containing pixels is read once and gathered with fancy indexing.
+
+    Returns
+    -------
+    values: ndarray (n_bands, n_pixels)
+        Band values at each pixel
+    """
+    from rasterio.windows import Window
+
+    block_h, block_w = src.block_shapes[0]
+    n_block_cols = -(-src.width // block_w)
+
+    # Sort pixels by block and find the range of pixels in each block
+    block_ids = (rows // block_h) * n_block_cols + (cols // block_w)
+    order = numpy.argsort(block_ids, kind="stable")
+    block_ids, starts = numpy.unique(block_ids[order], return_index=True)
+    ends = numpy.append(starts[1:], len(order))
+
+    values = numpy.empty((src.count, len(rows)), dtype=src.dtypes[0])
+    for block_id, i0, i1 in zip(block_ids, starts, ends):
+        ix = order[i0:i1]
+        row0 = (block_id // n_block_cols) * block_h
+        col0 = (block_id % n_block_cols) * block_w
+        window = Window(
+            col0,
+            row0,
+            min(block_w, src.width - col0),
+            min(block_h, src.height - row0),
+            )
+        data = src.read(window=window)
+        values[:, ix] = data[:, rows[ix] - row0, cols[ix] - col0]
+
+    return values
+
+
+def _sample_dataset(src, x, y, index_cache=None, method="nearest"):
+    """
+    Sample all bands of an open GeoTIFF at each point
+
+    Pixel indices are computed once per unique geotransform and stored in
+    `index_cache`, and only the blocks containing the points are read.
+
+    Returns
+    -------
+    values: ndarray (n_points, n_bands)
+        Sampled values. Masked samples are set to the nodata value of the GeoTIFF,
+        or zero if no nodata value is set, for `nearest` and NaN for `bilinear`.
+    mask: ndarray (n_points, n_bands)
+        Boolean array, `True` where a point falls outside the GeoTIFF or any
+        pixel sampled for it is nodata
+    """
+    if index_cache is None:
+        index_cache = dict()
+
+    key = (tuple(src.transform), src.width, src.height, method)
+    if key not in index_cache:
+        index_cache[key] = _pixel_index(
+            src.transform, src.width, src.height, x, y, method=method
+        )
+    rows, cols, weights, inside = index_cache[key]
+
+    if weights is None:
+        fill = src.nodata if src.nodata is not None else 0
+        values = numpy.full((len(x), src.count), fill, dtype=src.dtypes[0])
+    else:
+        fill = numpy.nan
+        values = numpy.full((len(x), src.count), fill)
+    mask = numpy.ones((len(x), src.count), dtype=bool)
+
+    if inside.any():
+        rows, cols = rows[:, inside], cols[:, inside]
+        pixels = _read_pixels(src, rows.ravel(), cols.ravel())
+        pixels = pixels.reshape(src.count, *rows.shape)
+
+        # Mask points where any pixel sampled is nodata
+        if src.nodata is None:
+            invalid = numpy.zeros((src.count, rows.shape[1]), dtype=bool)
+        elif numpy.isnan(src.nodata):
+            invalid = numpy.isnan(pixels).any(axis=1)
+        else:
+            invalid = (pixels == src.nodata).any(axis=1)
+
+        if weights is None:
+            values[inside] = pixels[:, 0].T
+        else:
+            values[inside] = (pixels * weights[:, inside]).sum(axis=1).T
+        mask[inside] = invalid.T
+        values[mask] = fill
+
+    return values, mask
+
+
+def _sample_files(files, x, y, method="nearest"):
+    """
+    Sample points from a chunk of GeoTIFFs within a single worker
+
+    Parameters
+    ----------
+    files: list of str
+        GeoTIFF file paths to be sampled
+    x: ndarray
+        X coordinate positions corresponding to coordinate system in GeoTIFFs
+    y: ndarray
+        Y coordinate positions corresponding to coordinate system in GeoTIFFs
+    method: str
+        Sampling method, either `nearest` or `bilinear`
+
+    Returns
+    -------
+    timestamps: ndarray (n_files,)
+        Timestamps parsed from the file names as datetime64
+    values: ndarray (n_files, n_points, n_bands)
+        Values sampled from each file for each point
+    mask: ndarray (n_files, n_points, n_bands)
+        Boolean array, `True` where samples are out of bounds or nodata
     """
-    raise NotImplementedError()
+    index_cache = dict()
+
+    timestamps = _file_timestamps(files)
+    samples = [
+        _sample_dataset(_open(fp), x, y, index_cache, method=method) for fp in files
+    ]
+    values = numpy.stack([s[0] for s in samples])
+    mask = numpy.stack([s[1] for s in samples])
+
+    return timestamps, values, mask
 
 
-def _sample(fp, x, y, bands):
+def _as_points(x, y):
+    """
+    Cast single coordinates or sequences of coordinates to 1-D float arrays
+    """
+    x = numpy.atleast_1d(numpy.asarray(x, dtype=float))
+    y = numpy.atleast_1d(numpy.asarray(y, dtype=float))
+
+    if x.shape != y.shape:
+        raise ValueError("`x` and `y` must have the same number of positions")
+
+    return x, y
+
+
+def _to_dataframe(timestamps, x, y, values, bands, mask=None):
+    """
+    Create a dataframe indexed by timestamp and position from sampled values
+
+    If a `mask` is passed, masked values are set to NaN.
+    """
+    n_files, n_points, n_bands = values.shape
+
+    if mask is not None and mask.any():
+        values = values.astype(float)
+        values[mask] = numpy.nan
+
+    df = pandas.DataFrame(values.reshape(-1, n_bands), columns=bands)
+    df["timestamp"] = pandas.to_datetime(
+        numpy.repeat(timestamps, n_points)
+    ).tz_localize("UTC")
+    df["x"] = numpy.tile(x, n_files)
+    df["y"] = numpy.tile(y, n_files)
+
+    # Sort and index by time and positions
+    index_cols = ["timestamp", "x", "y"]
+    df = df.sort_values(index_cols, kind="stable").set_index(index_cols)
+
+    return df
+
+
+def _sample(fp, x, y, bands, method="nearest", masked=False):
     """
     Produce data frame with row of band values for each point
 
@@ -32,10 +593,16 @@ def _sample(fp, x, y, bands):
     ----------
     fp: str
         Path to GeoTIFF file to be sampled
-    xy: list of tuple
-        x, y coordinate pairs
+    x: float or list of float
+        X coordinate positions corresponding to coordinate system in GeoTIFF
+    y: float or list of float
+        Y coordinate positions corresponding to coordinate system in GeoTIFF
     bands: list of str
         Names corresponding to each band of data in the GeoTIFFs
+    method: str
+        Sampling method, either `nearest` or `bilinear`
+    masked: bool
+        Set samples that are out of bounds or nodata to NaN
 
     Returns
     -------
@@ -43,40 +610,28 @@ def _sample(fp, x, y, bands):
         Dataframe containing data sampled from GeoTIFF. Each row corresponds to sample
         from each location sampled.
     """
-    from tfol.utils import timestamp_from_filename
+    x, y = _as_points(x, y)
 
-    try:
-        # Cast to iterable if single coordinate and merge to list of points
-        xy = numpy.vstack([make_nparray(x), make_nparray(y)]).T
+    timestamps, values, mask = _sample_files([fp], x, y, method=method)
+    bands = _band_names(_open(fp).descriptions, bands)
 
-        # Open GeoTiff, sample all bands for given locations
-        src = rasterio.open(fp)
-        result = src.sample(xy)
-
-        # Generate band names if not provided
-        if not bands:
-            # Labels from GeoTIFF descriptions
-            if any(src.descriptions):
-                bands = src.descriptions
-            # Generic enumerated labels
-            else:
-                bands = [f"band_{i}" for i in range(len(src.descriptions))]
-
-        # Create dataframe from rasterio sample generator, and timestamps and locations
-        df = pandas.DataFrame(result, columns=bands)
-        df["timestamp"] = [timestamp_from_filename(fp)]*len(df)
-        df["x"] = x
-        df["y"] = y
-
-    except Exception as e:
-        raise e
+    return _to_dataframe(timestamps, x, y, values, bands, mask if masked else None)
 
-    return df
 
-def as_dataframe(files, x, y, bands=None, n_cpu=3):
+def as_dataframe(files, x, y, bands=None, n_cpu=3, files_per_job=None,
+                 points_per_job=100000, method="nearest", masked=False):
     """
     Create a dataframe from GeoTIFFs for given time(-range) and position(s)
 
+    The files and points are split into jobs of `files_per_job` files and
+    `points_per_job` points. Each job samples its files in a single worker, reusing
+    pixel indices between files sharing a geotransform, and returns the samples as
+    arrays, which are compiled to a single DataFrame once all jobs are complete.
+
+    Points are converted to pixel indices in a single array operation and grouped
+    by the internal blocks of the GeoTIFF, so that each block containing points is
+    read once.
+
     Parameters
     ----------
     files: list of str
@@ -89,28 +644,64 @@ def as_dataframe(files, x, y, bands=None, n_cpu=3):
         Names corresponding to each band of data in the GeoTIFFs
     n_cpu: int
         Number of CPUs to use for running the GeoTIFF sampling
+    files_per_job: int
+        Number of files sampled by each job. By default files are split so that
+        each CPU gets around four jobs.
+    points_per_job: int
+        Maximum number of points sampled by each job
+    method: str
+        Sampling method, either `nearest` or `bilinear`
+    masked: bool
+        Set samples that are out of bounds or nodata to NaN
 
     Returns
     -------
     df: pandas.DataFrame
         Dataframe containing data sampled from all provided GeoTIFFs
     """
+    files = list(files)
+    x, y = _as_points(x, y)
+
+    if not files:
+        raise ValueError("No GeoTIFF files provided to sample")
+
+    if files_per_job is None:
+        files_per_job = max(1, -(-len(files) // (4 * n_cpu)))
+
+    with rasterio.open(files[0]) as src:
+        bands = _band_names(src.descriptions, bands)
 
-    # Sample all points for each file concurrently
-    dataframes = list()
+    file_chunks = range(0, len(files), files_per_job)
+    point_chunks = range(0, len(x), points_per_job)
+
+    # Sample each chunk of points for each chunk of files concurrently
+    timestamps = numpy.empty(len(files), dtype="datetime64[ns]")
+    values = mask = None
     with concurrent.futures.ProcessPoolExecutor(max_workers=n_cpu) as executor:
-        futures = [executor.submit(_sample, fp, x, y, bands) for fp in files]
+        futures = dict()
+        for i in file_chunks:
+            for j in point_chunks:
+                future = executor.submit(
+                    _sample_files,
+                    files[i:i + files_per_job],
+                    x[j:j + points_per_job],
+                    y[j:j + points_per_job],
+                    method,
+                    )
+                futures[future] = (i, j)
+
         for future in concurrent.futures.as_completed(futures):
-            # Append resulting dataframe file file to list of those to be merged
-            try:
-                dataframes.append(future.result())
-            except Exception as e:
-                raise e
-            else:
-                continue
-
-    # Concatenate dataframes, sort and index by time and positions
-    index_cols = ["timestamp", "x", "y"]
-    df = pandas.concat(dataframes).sort_values(index_cols).set_index(index_cols)
+            i, j = futures[future]
+            chunk_timestamps, chunk_values, chunk_mask = future.result()
 
-    return df
+            # Fill results of job into arrays for all files and points
+            if values is None:
+                shape = (len(files), len(x), chunk_values.shape[-1])
+                values = numpy.empty(shape, dtype=chunk_values.dtype)
+                mask = numpy.empty(shape, dtype=bool)
+            n_f, n_p = chunk_values.shape[:2]
+            timestamps[i:i + n_f] = chunk_timestamps
+            values[i:i + n_f, j:j + n_p] = chunk_values
+            mask[i:i + n_f, j:j + n_p] = chunk_mask
+
+    return _to_dataframe(timestamps, x, y, values, bands, mask if masked else None)
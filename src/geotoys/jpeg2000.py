@@ -1,6 +1,37 @@
 """
 Module with methods for handling JPEG2000 images
 """
+import logging
+import re
+
+_logger = logging.getLogger(__name__)
+
+# Band label and optional resolution in Sentinel-2 image names, e.g.
+# `T32VNM_20190101T104441_B02.jp2` (L1C) or `T32VNM_20190101T104441_B8A_20m.jp2` (L2A)
+BAND_PATTERN = re.compile(r"_(B\d[\dA]|TCI|AOT|WVP|SCL)(?:_(\d+m))?\.[^.]+$")
+
+# Directories of SAFE products with masks and auxiliary images named like bands
+SAFE_EXCLUDE_DIRS = ["QI_DATA", "AUX_DATA"]
+
+# Decimation of band images when computing statistics to stretch images by
+STATS_DECIMATION = 8
+
+# Native resolution of each Sentinel-2 band
+SENTINEL2_BAND_RES = {
+    "B01": "60m",
+    "B02": "10m",
+    "B03": "10m",
+    "B04": "10m",
+    "B05": "20m",
+    "B06": "20m",
+    "B07": "20m",
+    "B08": "10m",
+    "B8A": "20m",
+    "B09": "60m",
+    "B10": "60m",
+    "B11": "20m",
+    "B12": "20m",
+    }
 
 # TODO verify these orders somewhere, and 8a band vs 8 band
 SENTINAL2_IMG_TYPES = {
@@ -19,7 +50,301 @@ SENTINAL2_IMG_TYPES = {
     }
 
 
-def product_img_bands(path_data, product_id, res="10m", img_type='true_color'):
+def band_index(path_safe):
+    """
+    Index the band images of a Sentinel-2 SAFE product by band and resolution
+
+    The `IMG_DATA` directories of the product's granules are scanned once, matching
+    band labels exactly from the file names. Level-1C products have each band at
+    its native resolution, while Level-2A products have bands at several
+    resolutions in `R10m`, `R20m` and `R60m` directories.
+
+    Parameters
+    ==========
+    path_safe: str
+        Path to Sentinel SAFE formatted product directory
+
+    Returns
+    =======
+    index: dict
+        Dictionary of band label (e.g. `B02`) to a dictionary of resolution (e.g.
+        `10m`) to image path
+    """
+    import os
+
+    from geotoys.system import scan
+
+    path_granule = os.path.join(path_safe, "GRANULE")
+
+    index = dict()
+    for fp in sorted(scan(path_granule, exts=".jp2", exclude=SAFE_EXCLUDE_DIRS)):
+        match = BAND_PATTERN.search(os.path.basename(fp))
+        if not match or "IMG_DATA" not in fp.split(os.sep):
+            continue
+        if match.group(1) not in SENTINEL2_BAND_RES:
+            continue
+        band, res = match.groups()
+        res = res or SENTINEL2_BAND_RES[band]
+        index.setdefault(band, dict()).setdefault(res, fp)
+
+    return index
+
+
+def _res_m(res):
+    """
+    Get the resolution in metres from a resolution label, e.g. `20m`
+    """
+    return int(res[:-1])
+
+
+def _nearest_res(available, res):
+    """
+    Get the available resolution closest to that requested
+    """
+    return min(available, key=lambda r: abs(_res_m(r) - _res_m(res)))
+
+
+def _default_res(index, band_labels):
+    """
+    Get the coarsest of the finest resolutions available for each band, so that
+    bands are only downsampled, or `None` if a band is not in the band index
+    """
+    if any(f"B{b}" not in index for b in band_labels):
+        return None
+
+    return max((min(index[f"B{b}"], key=_res_m) for b in band_labels), key=_res_m)
+
+
+def _read_band(fp, bounds, out_shape):
+    """
+    Read the first band of an image resampled to a target grid
+
+    The grid is defined by its `bounds` and `out_shape`, so that each band is
+    resampled while being read rather than after loading it at its own resolution.
+    Bands are averaged when downsampled and bilinearly interpolated when upsampled.
+    Decimated reads use the JPEG2000 resolution levels, so that the image is not
+    decoded at full resolution.
+    """
+    import rasterio
+
+    with rasterio.open(fp) as src:
+        return _read_window(src, bounds, out_shape)
+
+
+def _read_window(src, bounds, out_shape):
+    """
+    Read the first band of an open image resampled to a target grid, see
+    `_read_band`
+    """
+    from rasterio.enums import Resampling
+    from rasterio.windows import from_bounds
+
+    window = from_bounds(*bounds, transform=src.transform)
+    if round(window.width) > out_shape[1]:
+        resampling = Resampling.average
+    elif round(window.width) < out_shape[1]:
+        resampling = Resampling.bilinear
+    else:
+        resampling = Resampling.nearest
+
+    return src.read(1, window=window, out_shape=out_shape, resampling=resampling)
+
+
+def _target_grid(fp, res, window=None):
+    """
+    Get the profile of the grid that bands are read to at a given resolution
+
+    Parameters
+    ==========
+    fp: str
+        Path to image covering the grid
+    res: str
+        Resolution of the grid, e.g. `20m`
+    window: rasterio.windows.Window
+        Window of the grid to read, in pixels at the grid resolution
+
+    Returns
+    =======
+    bounds: tuple of float
+        Bounds of the grid (left, bottom, right, top)
+    profile: dict
+        Image profile of the grid
+    """
+    import rasterio
+    from rasterio.windows import Window, bounds as window_bounds
+
+    with rasterio.open(fp) as src:
+        scale = _res_m(res) / src.res[0]
+        transform = src.transform * rasterio.Affine.scale(scale)
+        if window is None:
+            window = Window(0, 0, round(src.width / scale), round(src.height / scale))
+        profile = src.profile
+
+    bounds = window_bounds(window, transform)
+    profile.update({
+        "width": int(window.width),
+        "height": int(window.height),
+        "transform": rasterio.windows.transform(window, transform),
+        })
+
+    return bounds, profile
+
+
+def _decimated_shape(shape, n_bands, itemsize, decimation=None, size=None,
+                     max_bytes=None):
+    """
+    Reduce a shape by a decimation factor, to a size of its longest side, or to fit
+    a number of bands within a maximum number of bytes
+    """
+    height, width = shape
+
+    decimation = decimation or 1
+    if size:
+        decimation = max(decimation, max(height, width) / size)
+    if max_bytes:
+        n_bytes = n_bands * height * width * itemsize
+        decimation = max(decimation, (n_bytes / max_bytes) ** 0.5)
+
+    return (max(1, round(height / decimation)), max(1, round(width / decimation)))
+
+
+def product_grid(path_data, product_id, band_labels, res=None, window=None,
+                 out_shape=None, decimation=None, size=None, max_bytes=None):
+    """
+    Find the band images of a Sentinel SAFE product and the grid to read them to
+
+    Only the headers of the images are read. The image of each band closest to
+    the grid resolution is used.
+
+    Parameters
+    ==========
+    path_data: str
+        Path to directory containing Sentinel SAFE formatted products
+    product_id: str
+        Basename of Sentinel product, omitting the `.SAFE` extension
+    band_labels: list of str
+        Labels of bands to read, e.g. `04` or `8A`
+    res: str
+        Resolution of the grid to read bands to (one of `10m`, `20m`, `60m`). By
+        default the coarsest of the bands' finest resolutions is used, so that
+        bands are only downsampled.
+    window: rasterio.windows.Window
+        Window of the bands to read, in pixels of the grid. By default the full
+        image is read.
+    out_shape: tuple of int
+        Shape (height, width) to read the bands to, e.g. for decimated previews.
+    decimation: float
+        Factor to reduce the shape of the grid by, if `out_shape` not given
+    size: int
+        Size of the longest side to reduce the shape of the grid to, if `out_shape`
+        not given
+    max_bytes: int
+        Maximum number of bytes of all bands read, reducing the shape of the grid
+        if needed, if `out_shape` not given
+
+    Returns
+    =======
+    jp2s: dict of str
+        Path of the image of each band label
+    bounds: tuple of float
+        Bounds of the grid (left, bottom, right, top)
+    profile: dict
+        Image profile metadata of the grid
+    """
+    import os
+    import numpy
+    import rasterio
+
+    resolutions = ["10m", "20m", "60m"]
+
+    if res is not None and res not in resolutions:
+        raise ValueError(f"`res` must be one of {' '.join(resolutions)}")
+
+    index = band_index(os.path.join(path_data, f"{product_id}.SAFE"))
+
+    for b in band_labels:
+        if f"B{b}" not in index:
+            raise ValueError(f"Band B{b} not found in {product_id}")
+    band_res = [index[f"B{b}"] for b in band_labels]
+
+    if res is None:
+        res = _default_res(index, band_labels)
+
+    # Find image of each band at, or closest to, the grid resolution
+    jp2s = {b: r[_nearest_res(r, res)] for b, r in zip(band_labels, band_res)}
+
+    # Define the grid from an image at its resolution, if available
+    fp_grid = next((r[res] for r in band_res if res in r), jp2s[band_labels[0]])
+    bounds, profile = _target_grid(fp_grid, res, window)
+
+    if out_shape is None:
+        out_shape = _decimated_shape(
+            (profile["height"], profile["width"]),
+            len(band_labels),
+            numpy.dtype(profile["dtype"]).itemsize,
+            decimation=decimation,
+            size=size,
+            max_bytes=max_bytes,
+            )
+    transform = profile["transform"] * rasterio.Affine.scale(
+        profile["width"] / out_shape[1], profile["height"] / out_shape[0]
+    )
+    profile.update({
+        "width": out_shape[1],
+        "height": out_shape[0],
+        "transform": transform,
+        })
+
+    return jp2s, bounds, profile
+
+
+def product_bands(path_data, product_id, band_labels, n_threads=3, **kwargs):
+    """
+    Read data for bands from Sentinel SAFE formatted products
+
+    All bands are resampled to a common grid as they are read, so that bands of
+    different resolutions can be composed and memory use is bounded by the size
+    of the grid.
+
+    Parameters
+    ==========
+    path_data: str
+        Path to directory containing Sentinel SAFE formatted products
+    product_id: str
+        Basename of Sentinel product, omitting the `.SAFE` extension
+    band_labels: list of str
+        Labels of bands to read, e.g. `04` or `8A`
+    n_threads: int
+        Number of bands to read concurrently
+    **kwargs: dict
+        Keyword arguments defining the grid passed to `product_grid`, e.g. `res`,
+        `window` or `decimation`
+
+    Returns
+    =======
+    bands: dict of ndarray
+        The data for each band label
+    profile: dict
+        Image profile metadata of the grid the bands were read to
+    """
+    import concurrent.futures
+
+    jp2s, bounds, profile = product_grid(path_data, product_id, band_labels, **kwargs)
+    out_shape = (profile["height"], profile["width"])
+
+    # Read bands concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        data = list(executor.map(
+            lambda b: _read_band(jp2s[b], bounds, out_shape), band_labels
+        ))
+
+    bands = dict(zip(band_labels, data))
+
+    return bands, profile
+
+
+def product_img_bands(path_data, product_id, res=None, img_type='true_color',
+                      **kwargs):
     """
     Read data for RGB bands from Sentinel SAFE formatted products
 
@@ -30,10 +355,13 @@ def product_img_bands(path_data, product_id, res="10m", img_type='true_color'):
     product_id: str
         Basename of Sentinel product, omitting the `.SAFE` extension
     res: str
-        Resolution of bands to extract (one of `10m`, `20m`, `60m`)
+        Resolution of bands to extract (one of `10m`, `20m`, `60m`). By default
+        the coarsest resolution of the bands, so that bands are only downsampled.
     img_type: str
         Name of the image type to extract bands for. This name corresponds to
         the bands that when composed produce that type of image.
+    **kwargs: dict
+        Keyword arguments passed to `product_bands`, e.g. `window` or `decimation`
 
     Returns
     =======
@@ -43,67 +371,420 @@ def product_img_bands(path_data, product_id, res="10m", img_type='true_color'):
     profile: dict
         Image profile metadata from rasterio object
     """
-    import os
-    import rasterio
+    _check_img_types([img_type])
 
-    from geotoys.system import list_ext
+    _logger.info(f"Reading {img_type} bands of {product_id}...")
 
-    resolutions = ["10m", "20m", "60m"]
+    band_labels = SENTINAL2_IMG_TYPES[img_type]
+    bands, profile = product_bands(
+        path_data, product_id, band_labels, res=res, **kwargs
+    )
 
-    if res not in resolutions:
-        raise ValueError(f"`res` must be one of {' '.join(resolutions)}")
+    return [bands[b] for b in band_labels], profile
 
-    if img_type not in IMG_TYPES.keys():
-        raise ValueError(f"`img_type` must be one of {' '.join(IMG_TYPES.keys())}")
 
-    _logger.info(f"Creating {img_type} JPEG of {product_id}...")
+def _check_img_types(img_types):
+    """
+    Check that image types are defined in `SENTINAL2_IMG_TYPES`
+    """
+    for img_type in img_types:
+        if img_type not in SENTINAL2_IMG_TYPES.keys():
+            raise ValueError(
+                f"`img_type` must be one of {' '.join(SENTINAL2_IMG_TYPES.keys())}"
+            )
+
+
+def _band_ranges(path_data, product_id, band_labels, res, percentiles):
+    """
+    Get the values at percentiles of each band to normalize it by
 
-    # Create band search strings for finding bands by label
-    # Add resolution if Level-2A product
-    band_labels = [ f"B{b}" for b in SENTINEL2_IMG_TYPES[img_type]]
-    if 'L2B' in product_id:
-        band_labels = [f"{b}_{res}" for b in band_labels]
+    Statistics are computed from a decimated read of each band image and cached,
+    so that repeated renders of a product skip reading the bands for them.
+    """
+    from geotoys.stats import file_stats
 
-    jp2s = list_ext(os.path.join(path_data, f"{product_id}.SAFE"), '.jp2')
+    jp2s, _, _ = product_grid(path_data, product_id, band_labels, res=res)
 
-    # Loop through jp2 files and collect data for desired bands/resolution
-    bands = list()
-    first_iter = True
+    ranges = dict()
     for b in band_labels:
-        for jp2 in jp2s:
-            if b in jp2:
-                _logger.info(f"Reading data for: {os.path.basename(jp2)}")
-                with rasterio.open(jp2) as src:
-                    bands.append(src.read(1))
-                    if first_iter:
-                        profile = src.profile
-                        first_iter = False
-                    src.close()
+        stats = file_stats(jp2s[b], bands=[1], decimation=STATS_DECIMATION)[1]
+        ranges[b] = tuple(stats.percentile(percentiles))
 
-    return bands, profile
+    return ranges
 
 
-def jp2_to_jpeg(path_data, path_output, product_id, res="10m", img_type='true_color'):
+def _save_composite(bands, profile, fp_dst, ranges=None):
     """
-    Convert a Sentinel product's JPEG2000 to JPEG RGB
+    Save bands as a JPEG RGB composite, returning a summary of the image
+
+    Bands are normalized by their own minimum and maximum, unless the `ranges`
+    of values of each band to normalize by are given, and converted to `uint8`
+    in a single pass.
     """
     import os
-    import uuid
+    import numpy
+
+    from geotoys.process import save_jpeg_rgb, stretch_coefficients, to_uint8
+
+    if ranges is None:
+        ranges = [(numpy.min(x), numpy.max(x)) for x in bands]
 
-    bands, src_profile = product_img_bands(path_data, product_id, res=res, img_type=img_type)
+    composite = numpy.empty((len(bands),) + bands[0].shape, dtype="uint8")
+    for i, (x, (x_min, x_max)) in enumerate(zip(bands, ranges)):
+        scale, offset = stretch_coefficients(x_min, x_max)
+        to_uint8(x, scale, offset, out=composite[i])
 
-    fp_dst = os.path.join(path_output, f"{product_id}_{img_type}.jpg")
     os.makedirs(os.path.dirname(fp_dst), exist_ok=True)
+    save_jpeg_rgb(composite, profile, fp_dst, band_count=len(composite))
 
-    _save_jpeg_rgb(bands, src_profile, fp_dst, band_count=len(IMG_TYPES[img_type]))
+    return _summary(profile, fp_dst)
+
+
+def _grid_reader(fp, profile, stack):
+    """
+    Get a function reading a window of the grid from a band image, which is kept
+    open in an `ExitStack` so that decoded JPEG2000 tiles stay in GDAL's cache
+    between windows
+    """
+    import rasterio
+    from rasterio.windows import bounds
+
+    src = stack.enter_context(rasterio.open(fp))
+
+    def read(window):
+        out_shape = (window.height, window.width)
+        return _read_window(src, bounds(window, profile["transform"]), out_shape)
+
+    return read
+
+
+def _summary(profile, fp_dst):
+    """
+    Create summary of an image written, as done in annotation data
+    """
+    import os
+    import uuid
 
-    # Create summary as done in annotation data
     summary = {
         "id": uuid.uuid4(),
         "file_name": os.path.basename(fp_dst),
-        "width": src_profile["width"],
-        "height": src_profile["height"],
-        "crs": src_profile["crs"].to_epsg()
+        "width": profile["width"],
+        "height": profile["height"],
+        "crs": profile["crs"].to_epsg()
         }
 
     return summary
+
+
+def jp2_to_jpeg(path_data, path_output, product_id, res=None, img_type='true_color',
+                decimation=None, size=None, block_size=None, percentiles=None,
+                cog=False, compress="DEFLATE"):
+    """
+    Convert a Sentinel product's JPEG2000 to JPEG RGB
+
+    Thumbnails and browse images can be produced with a `decimation` factor or
+    output `size`, for which bands are decoded from the reduced JPEG2000
+    resolution levels rather than at full resolution.
+
+    Full resolution images can be produced with bounded memory by passing a
+    `block_size`, for which the image is read, processed and written one block
+    at a time.
+
+    Images served as tiles can be written as a Cloud-Optimized GeoTIFF with
+    internal overviews by passing `cog`, for which the image is always processed
+    by block.
+
+    Parameters
+    ==========
+    path_data: str
+        Path to directory containing Sentinel SAFE formatted products
+    path_output: str
+        Path to directory to write JPEG to
+    product_id: str
+        Basename of Sentinel product, omitting the `.SAFE` extension
+    res: str
+        Resolution of bands to extract (one of `10m`, `20m`, `60m`). By default
+        the coarsest resolution of the bands, so that bands are only downsampled.
+    img_type: str
+        Name of the image type to produce
+    decimation: float
+        Factor to reduce the width and height of the image by
+    size: int
+        Size in pixels of the longest side of the image
+    block_size: int
+        Size of blocks to process the image in, a multiple of 16
+    percentiles: tuple of float
+        Percentiles of the bands to stretch the image between, e.g. `(2, 98)`. By
+        default the image is stretched between the minimum and maximum.
+    cog: bool
+        Write a Cloud-Optimized GeoTIFF (`.tif`) rather than a JPEG
+    compress: str
+        Compression of the Cloud-Optimized GeoTIFF, e.g. `DEFLATE` or `JPEG`
+
+    Returns
+    =======
+    summary: dict
+        Summary of the image written
+    """
+    import contextlib
+    import os
+
+    from geotoys.process import save_cog, save_rgb_tiled
+
+    _check_img_types([img_type])
+    band_labels = SENTINAL2_IMG_TYPES[img_type]
+    ext = "tif" if cog else "jpg"
+    fp_dst = os.path.join(path_output, f"{product_id}_{img_type}.{ext}")
+
+    ranges = None
+    if percentiles is not None:
+        ranges = _band_ranges(path_data, product_id, band_labels, res, percentiles)
+        ranges = [ranges[b] for b in band_labels]
+
+    if block_size or cog:
+        jp2s, _, profile = product_grid(
+            path_data,
+            product_id,
+            band_labels,
+            res=res,
+            decimation=decimation,
+            size=size,
+            )
+        os.makedirs(path_output, exist_ok=True)
+        with contextlib.ExitStack() as stack:
+            readers = [_grid_reader(jp2s[b], profile, stack) for b in band_labels]
+            if cog:
+                save_cog(
+                    readers,
+                    profile,
+                    fp_dst,
+                    block_size=block_size or 512,
+                    compress=compress,
+                    ranges=ranges,
+                    )
+            else:
+                save_rgb_tiled(
+                    readers, profile, fp_dst, ranges=ranges, block_size=block_size
+                    )
+
+        return _summary(profile, fp_dst)
+
+    bands, src_profile = product_img_bands(
+        path_data,
+        product_id,
+        res=res,
+        img_type=img_type,
+        decimation=decimation,
+        size=size,
+        )
+
+    return _save_composite(bands, src_profile, fp_dst, ranges=ranges)
+
+
+def _render_product(path_data, path_output, product_id, img_types, res=None,
+                    decimation=None, size=None, percentiles=None):
+    """
+    Read the bands needed for all image types of a product once and save each
+
+    Image types are rendered at `res`, or else at the default resolution of each
+    image type as with `jp2_to_jpeg`, reading the bands shared by image types of
+    the same resolution once.
+    """
+    import os
+
+    _logger.info(f"Rendering {' '.join(img_types)} of {product_id}...")
+
+    # Group image types by the resolution of their grid
+    index = band_index(os.path.join(path_data, f"{product_id}.SAFE"))
+    groups = dict()
+    for img_type in img_types:
+        img_res = res or _default_res(index, SENTINAL2_IMG_TYPES[img_type])
+        groups.setdefault(img_res, list()).append(img_type)
+
+    summaries = list()
+    for img_res, group in groups.items():
+        # Unique band labels of the image types, in order of first use
+        band_labels = list(dict.fromkeys(
+            b for img_type in group for b in SENTINAL2_IMG_TYPES[img_type]
+        ))
+
+        bands, profile = product_bands(
+            path_data,
+            product_id,
+            band_labels,
+            res=img_res,
+            decimation=decimation,
+            size=size,
+            )
+
+        ranges = None
+        if percentiles is not None:
+            ranges = _band_ranges(
+                path_data, product_id, band_labels, img_res, percentiles
+                )
+
+        for img_type in group:
+            fp_dst = os.path.join(path_output, f"{product_id}_{img_type}.jpg")
+            composite = [bands[b] for b in SENTINAL2_IMG_TYPES[img_type]]
+            composite_ranges = None
+            if ranges:
+                composite_ranges = [ranges[b] for b in SENTINAL2_IMG_TYPES[img_type]]
+            summary = _save_composite(composite, profile, fp_dst, composite_ranges)
+            summary.update({"product_id": product_id, "img_type": img_type})
+            summaries.append(summary)
+
+    return summaries
+
+
+def render_quicklooks(path_data, path_output, product_ids, img_types=("true_color",),
+                      res=None, decimation=None, size=None, percentiles=None,
+                      n_workers=3, fp_manifest=None):
+    """
+    Render JPEG RGB composites of several image types for many Sentinel products
+
+    Each product is rendered in a process pool, reading the bands shared by its
+    image types once. The summary of each image written is appended to a JSON
+    lines manifest as each product completes. Products that fail to render are
+    logged and recorded in the manifest with their `error`, and the remaining
+    products are still rendered.
+
+    Parameters
+    ==========
+    path_data: str
+        Path to directory containing Sentinel SAFE formatted products
+    path_output: str
+        Path to directory to write JPEGs to
+    product_ids: list of str
+        Basenames of Sentinel products, omitting the `.SAFE` extension
+    img_types: list of str
+        Names of the image types to produce, keys of `SENTINAL2_IMG_TYPES`
+    res: str
+        Resolution of bands to extract (one of `10m`, `20m`, `60m`). By default
+        the coarsest resolution of the bands of each image type, so that bands are
+        only downsampled and images match those of `jp2_to_jpeg`.
+    decimation: float
+        Factor to reduce the width and height of the images by
+    size: int
+        Size in pixels of the longest side of the images
+    percentiles: tuple of float
+        Percentiles of the bands to stretch the images between, e.g. `(2, 98)`
+    n_workers: int
+        Number of products to render concurrently
+    fp_manifest: str
+        Path of JSON lines file to append image summaries to
+
+    Returns
+    =======
+    summaries: list of dict
+        Summaries of all images written, omitting failed products
+    """
+    import concurrent.futures
+    import json
+    import os
+
+    img_types = list(img_types)
+    _check_img_types(img_types)
+
+    summaries = list()
+    manifest = None
+    if fp_manifest:
+        os.makedirs(os.path.dirname(os.path.abspath(fp_manifest)), exist_ok=True)
+        manifest = open(fp_manifest, "a")
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(
+                    _render_product,
+                    path_data,
+                    path_output,
+                    product_id,
+                    img_types,
+                    res,
+                    decimation,
+                    size,
+                    percentiles,
+                    ): product_id
+                for product_id in product_ids
+                }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    records = future.result()
+                    summaries += records
+                except Exception as e:
+                    product_id = futures[future]
+                    _logger.error(f"Failed to render {product_id}: {e!r}")
+                    records = [{"product_id": product_id, "error": repr(e)}]
+                if manifest:
+                    for record in records:
+                        manifest.write(json.dumps(record, default=str) + "\n")
+                    manifest.flush()
+    finally:
+        if manifest:
+            manifest.close()
+
+    return summaries
+
+
+def main(argv=None):
+    """
+    Command line interface for rendering quicklooks of Sentinel products
+    """
+    import argparse
+    import os
+
+    from geotoys.system import list_dirs
+
+    parser = argparse.ArgumentParser(
+        description="Render JPEG RGB composites of Sentinel-2 SAFE products"
+    )
+    parser.add_argument("path_data", help="Directory containing SAFE products")
+    parser.add_argument("path_output", help="Directory to write JPEGs to")
+    parser.add_argument(
+        "product_ids",
+        nargs="*",
+        help="Products to render, omitting `.SAFE`. Defaults to all in path_data.",
+        )
+    parser.add_argument(
+        "--img-types",
+        nargs="+",
+        default=["true_color"],
+        choices=SENTINAL2_IMG_TYPES.keys(),
+        help="Image types to render",
+        )
+    parser.add_argument(
+        "--res",
+        choices=["10m", "20m", "60m"],
+        help="Resolution of images. Defaults to the coarsest resolution of bands.",
+        )
+    parser.add_argument("--decimation", type=float, help="Image decimation factor")
+    parser.add_argument("--size", type=int, help="Size of longest side of images")
+    parser.add_argument(
+        "--percentiles",
+        nargs=2,
+        type=float,
+        help="Percentiles of bands to stretch images between, e.g. 2 98",
+        )
+    parser.add_argument("--workers", type=int, default=3, help="Number of processes")
+    parser.add_argument("--manifest", help="JSON lines file to append summaries to")
+    args = parser.parse_args(argv)
+
+    product_ids = args.product_ids
+    if not product_ids:
+        product_ids = [
+            os.path.basename(p)[:-len(".SAFE")]
+            for p in list_dirs(args.path_data, ".SAFE")
+            ]
+
+    logging.basicConfig(level=logging.INFO)
+    render_quicklooks(
+        args.path_data,
+        args.path_output,
+        product_ids,
+        img_types=args.img_types,
+        res=args.res,
+        decimation=args.decimation,
+        size=args.size,
+        percentiles=args.percentiles,
+        n_workers=args.workers,
+        fp_manifest=args.manifest,
+        )
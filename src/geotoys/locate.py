@@ -1,40 +1,646 @@
 """
 Methods for querying OpenStreetMaps for geolocation information from place
 names.
+
+Batches of queries are geocoded with a `Geocoder`, which looks up postal codes
+and place names in a local `Gazetteer` first, then in a persistent cache of
+previous queries, and only queries Nominatim for the remaining misses, at a rate
+limited by a `TokenBucket`. With `locate`, queries are requested concurrently in
+an event loop and results yielded as they complete.
+
+>>> gazetteer = Gazetteer.read("NO.txt")
+>>> with Geocoder(gazetteer) as geocoder:
+...     results = geocoder.geocode_many(["0150 Oslo", "7491 Trondheim"])
+"""
+import logging
+import os
+import re
+import sqlite3
+
+_logger = logging.getLogger(__name__)
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org"
+
+# Parameters of Nominatim searches, returning outlines of places as GeoJSON
+SEARCH_PARAMS = {"format": "jsonv2", "polygon_geojson": 1}
+
+USER_AGENT = "geotoys"
+
+# Response statuses of requests to retry, e.g. when rate limited
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+GEOCODE_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "geotoys", "locate", "geocode.sqlite"
+    )
+
+# Four digit postal codes followed by a place name, e.g. `0150 Oslo`
+PLACE_PATTERN = re.compile(r"(?<!\d)(\d{4})(?!\d)[\s,-]+([^\W\d_][^\d,;()]*)")
+
+# Columns of the tab separated GeoNames postal code files, e.g. `NO.txt`
+GEONAMES_COLUMNS = [
+    "country_code", "postal_code", "place_name", "admin_name1", "admin_code1",
+    "admin_name2", "admin_code2", "admin_name3", "admin_code3", "lat", "lon",
+    "accuracy",
+    ]
+
+_GEOCODE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS geocode (
+    query TEXT PRIMARY KEY,
+    result TEXT,
+    created REAL NOT NULL
+);
 """
-import shapely
 
-# TODO finish
+
+def normalize_place(name):
+    """
+    Normalize a place name or query for lookups, ignoring case, hyphens and
+    repeated whitespace
+    """
+    return " ".join(str(name).replace("-", " ").split()).casefold()
+
+
 def find_places(query):
     """
-    Look for a postal code, place-name combination in a string and return its location
+    Look for postal code, place name combinations in a string
+
+    Postal codes are kept as strings, so that leading zeros are not lost.
+
+    Parameters
+    ==========
+    query: str
+        String containing four digit postal codes followed by place names, e.g.
+        `Karl Johans gate 1, 0154 Oslo`
+
+    Returns
+    =======
+    places: list of tuple
+        Postal code and place name of each combination found
     """
-    parts = str(query).split(' ')
-    for i, p in enumerate(parts):
-        p = p.replace('-', ' ').strip()
-        try:
-            postal_code = int(p)
-            if len(postal_code) == 4:
-                print(postal_code, parts[i+1])
-                # Check 
-                #response = get_osm_location("{postal_code} {name}")
-                #lon = response['lon']
-                #lat = response['lat']
-                #poly = 
-        except Exception as e:
-            continue
-
-def get_osm_location(query):
+    return [
+        (postal_code, " ".join(name.replace("-", " ").split()))
+        for postal_code, name in PLACE_PATTERN.findall(str(query))
+        ]
+
+
+def get_osm_location(query, base_url=NOMINATIM_URL, session=None):
     """
     Query OpenStreetMaps for the location information of a postal code and place name
+
+    Parameters
+    ==========
+    query: str
+        Free form query, e.g. `0150 Oslo`
+    base_url: str
+        URL of the Nominatim server
+    session: requests.Session
+        Session to make the request with, defaults to a new session
+
+    Returns
+    =======
+    places: list of dict
+        Places matching the query, with their outlines as GeoJSON
     """
     import requests
 
-    url = f"https://nominatim.openstreetmap.org/search/{query}?format=json"
+    session = session or requests
+    params = dict(SEARCH_PARAMS, q=query)
+    headers = {"User-Agent": USER_AGENT}
 
-    try:
-        response = requests.get(url, params={'polygon':'1'})
-    except Exception as e:
-        raise e
+    response = session.get(f"{base_url}/search", params=params, headers=headers)
+    response.raise_for_status()
 
     return response.json()
+
+
+class TokenBucket(object):
+    """
+    Rate limiter allowing bursts of up to `capacity` calls and `rate` calls per
+    second on average, shared by threads
+
+    Tokens are taken in the order `acquire` is called, so that waiting callers are
+    served in turn.
+    """
+
+    def __init__(self, rate, capacity=1):
+        import threading
+        import time
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, waiting until they are available
+
+        Returns
+        =======
+        wait: float
+            Seconds waited
+        """
+        import time
+
+        wait = self._take(tokens)
+        if wait:
+            time.sleep(wait)
+
+        return wait
+
+    async def acquire_async(self, tokens=1):
+        """
+        Take tokens from the bucket, waiting in the event loop until they are
+        available, see `acquire`
+        """
+        import asyncio
+
+        wait = self._take(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+        return wait
+
+    def _take(self, tokens):
+        """
+        Take tokens from the bucket, returning the seconds until they are available
+        """
+        import time
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+            self.updated = now
+            self.tokens -= tokens
+
+            return max(-self.tokens / self.rate, 0)
+
+
+class Gazetteer(object):
+    """
+    In-memory index of the locations of postal codes and place names
+
+    Example
+    =======
+    >>> gazetteer = Gazetteer.read("NO.txt")
+    >>> gazetteer.lookup("0150", "Oslo")["lat"]
+    59.9112
+    """
+
+    def __init__(self):
+        self._codes = dict()
+        self._names = dict()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._codes.values())
+
+    def add(self, postal_code, name, geometry):
+        """
+        Add the location of a postal code and place name
+
+        Parameters
+        ==========
+        postal_code: str
+            Postal code, `None` for place names without postal codes
+        name: str
+            Place name
+        geometry: shapely.geometry.base.BaseGeometry
+            Point or outline of the place in longitude and latitude
+        """
+        point = geometry.representative_point()
+        result = {
+            "name": name,
+            "postal_code": postal_code,
+            "lon": point.x,
+            "lat": point.y,
+            "geometry": geometry,
+            "source": "gazetteer",
+            }
+        key = normalize_place(name)
+        if postal_code is not None:
+            self._codes.setdefault(str(postal_code), dict()).setdefault(key, result)
+        self._names.setdefault(key, result)
+
+    def lookup(self, postal_code=None, name=None):
+        """
+        Look up the location of a postal code, place name or both
+
+        Returns
+        =======
+        result: dict
+            Name, postal code, longitude, latitude and geometry of the place, or
+            `None` if not found
+        """
+        if postal_code is None:
+            return self._names.get(normalize_place(name)) if name else None
+
+        entries = self._codes.get(str(postal_code), dict())
+        if name is None:
+            return next(iter(entries.values()), None)
+
+        return entries.get(normalize_place(name))
+
+    @classmethod
+    def read(cls, fp, code_column="postal_code", name_column="place_name",
+             lon_column="lon", lat_column="lat"):
+        """
+        Read a gazetteer from a file
+
+        Delimited text files are read with points from longitude and latitude
+        columns, with the columns of GeoNames postal code files (e.g. `NO.txt`)
+        if they have no header. Other files are read with `geopandas`, e.g.
+        shapefiles or GeoPackages of postal code areas.
+
+        Parameters
+        ==========
+        fp: str
+            Path of gazetteer file
+        code_column: str
+            Name of postal code column, `None` for files of place names only
+        name_column: str
+            Name of place name column
+        lon_column: str
+            Name of longitude column of delimited text files
+        lat_column: str
+            Name of latitude column of delimited text files
+
+        Returns
+        =======
+        gazetteer: Gazetteer
+            Index of the places in the file
+        """
+        from shapely.geometry import Point
+
+        gazetteer = cls()
+        ext = os.path.splitext(fp)[1].lower()
+        if ext in (".csv", ".tsv", ".txt"):
+            import pandas
+
+            sep = "," if ext == ".csv" else "\t"
+            with open(fp, encoding="utf-8") as f:
+                has_header = name_column in f.readline().rstrip("\n").split(sep)
+            df = pandas.read_csv(
+                fp, sep=sep, dtype=str, keep_default_na=False,
+                names=None if has_header else GEONAMES_COLUMNS,
+                )
+            geometries = [
+                Point(float(lon), float(lat))
+                for lon, lat in zip(df[lon_column], df[lat_column])
+                ]
+        else:
+            import geopandas
+
+            df = geopandas.read_file(fp).to_crs("EPSG:4326")
+            geometries = df.geometry
+
+        codes = df[code_column] if code_column else [None] * len(df)
+        for code, name, geometry in zip(codes, df[name_column], geometries):
+            if geometry is not None and not geometry.is_empty:
+                gazetteer.add(code or None, name, geometry)
+
+        return gazetteer
+
+
+class Geocoder(object):
+    """
+    Batch geocoder of postal codes and place names
+
+    Queries are looked up in the gazetteer first, by the first postal code and
+    place name found in them or by the whole query as a place name, then in a
+    persistent SQLite cache of previous queries. Only the remaining queries are
+    sent to Nominatim, at most `rate` requests per second, and their results,
+    including queries not found, are cached.
+
+    Example
+    =======
+    >>> with Geocoder(Gazetteer.read("NO.txt")) as geocoder:
+    ...     df = pandas.DataFrame(geocoder.geocode_many(addresses))
+    """
+
+    def __init__(self, gazetteer=None, path_cache=GEOCODE_CACHE_PATH,
+                 base_url=NOMINATIM_URL, rate=1.0, burst=1, ttl=None):
+        import threading
+        import requests
+
+        if path_cache != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path_cache)), exist_ok=True)
+        self.conn = sqlite3.connect(path_cache, check_same_thread=False)
+        self.conn.executescript(_GEOCODE_SCHEMA)
+        self._lock = threading.Lock()
+
+        self.gazetteer = gazetteer
+        self.base_url = base_url.rstrip("/")
+        self.bucket = TokenBucket(rate, burst)
+        self.ttl = ttl
+        self.session = requests.Session()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+        self.conn.close()
+
+    def geocode(self, query):
+        """
+        Get the location of a postal code and place name, or a place name
+
+        Parameters
+        ==========
+        query: str
+            Query, e.g. `0150 Oslo` or `Karl Johans gate 1, 0154 Oslo`
+
+        Returns
+        =======
+        result: dict
+            Name, postal code, longitude, latitude, geometry and source
+            (`gazetteer`, `cache` or `nominatim`) of the place, or `None` if not
+            found
+        """
+        found, result = self._lookup_local(query)
+        if found:
+            return result
+
+        self.bucket.acquire()
+        places = get_osm_location(query, self.base_url, session=self.session)
+        result = _parse_nominatim(places)
+        self._store(query, result)
+
+        return result
+
+    def geocode_many(self, queries, n_workers=1):
+        """
+        Geocode a batch of queries, requesting each distinct query once
+
+        Parameters
+        ==========
+        queries: list of str
+            Queries, see `geocode`
+        n_workers: int
+            Number of threads making requests, which are still limited to `rate`
+            requests per second. Use more than one with a self-hosted server.
+
+        Returns
+        =======
+        results: list of dict
+            Result of each query, see `geocode`
+        """
+        import concurrent.futures
+
+        queries = list(queries)
+        keys = dict()
+        for query in queries:
+            keys.setdefault(normalize_place(query), query)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            results = dict(zip(keys, executor.map(self.geocode, keys.values())))
+
+        return [results[normalize_place(query)] for query in queries]
+
+    def _lookup_local(self, query):
+        """
+        Look up a query in the gazetteer and cache, returning whether it was found
+        and its result
+        """
+        import json
+        import time
+
+        if self.gazetteer is not None:
+            places = find_places(query)
+            if places:
+                result = self.gazetteer.lookup(*places[0])
+            else:
+                result = self.gazetteer.lookup(name=query)
+            if result is not None:
+                return True, result
+
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT result, created FROM geocode WHERE query = ?",
+                (normalize_place(query),),
+                ).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            return False, None
+        if row[0] is None:
+            return True, None
+
+        return True, _result_from_json(json.loads(row[0]), "cache")
+
+    def _store(self, query, result):
+        """
+        Write the result of a query to the cache
+        """
+        import json
+        import time
+
+        if result is not None:
+            result = json.dumps(_result_to_json(result))
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO geocode VALUES (?, ?, ?)",
+                (normalize_place(query), result, time.time()),
+                )
+
+
+async def locate(queries, geocoder=None, concurrency=8, retries=3, backoff=0.5,
+                 timeout=30):
+    """
+    Geocode queries concurrently, yielding results as they complete
+
+    Queries found in the gazetteer or cache of the geocoder are yielded first.
+    Each distinct remaining query is requested once from the server of the
+    geocoder by `concurrency` tasks sharing a pool of connections, at the rate
+    limit of the geocoder shared by all requests to the server. Requests failing
+    to connect, timing out or with a response status in `RETRY_STATUSES` are
+    retried after `backoff` seconds, doubled at each retry, or as long as the
+    server asks with a `Retry-After` header. A query whose request fails is
+    logged and yielded with the exception as its result, which is not cached,
+    and the remaining queries are still yielded.
+
+    Parameters
+    ==========
+    queries: iterable of str
+        Queries, see `Geocoder.geocode`
+    geocoder: Geocoder
+        Geocoder whose gazetteer, cache, server and rate limit are used, defaults
+        to a `Geocoder` without a gazetteer, closed when done
+    concurrency: int
+        Number of concurrent requests
+    retries: int
+        Number of times to retry a failed request
+    backoff: float
+        Seconds to wait before the first retry
+    timeout: float
+        Seconds to wait for a response to a request
+
+    Yields
+    ======
+    query: str
+        Query
+    result: dict or Exception
+        Result of query, see `Geocoder.geocode`, or the exception of a failed
+        request
+
+    Example
+    =======
+    >>> async for query, result in locate(queries, Geocoder(gazetteer, rate=20)):
+    ...     print(query, result and result["name"])
+    """
+    import asyncio
+    import aiohttp
+
+    own_geocoder = geocoder is None
+    geocoder = geocoder or Geocoder()
+    todo, done = asyncio.Queue(), asyncio.Queue()
+
+    async def worker(session):
+        while True:
+            query = await todo.get()
+            try:
+                result = await _request(session, geocoder, query, retries, backoff)
+            except Exception as e:
+                result = e
+            await done.put((query, result))
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    session = aiohttp.ClientSession(
+        connector=connector,
+        headers={"User-Agent": USER_AGENT},
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        )
+    workers = [asyncio.ensure_future(worker(session)) for _ in range(concurrency)]
+    try:
+        pending = dict()
+        for query in queries:
+            key = normalize_place(query)
+            if key in pending:
+                pending[key].append(query)
+                continue
+            found, result = geocoder._lookup_local(query)
+            if found:
+                yield query, result
+                continue
+            pending[key] = [query]
+            todo.put_nowait(query)
+
+        for _ in range(len(pending)):
+            query, result = await done.get()
+            if isinstance(result, Exception):
+                _logger.error("Failed to geocode %r: %s", query, result)
+            else:
+                geocoder._store(query, result)
+            for duplicate in pending[normalize_place(query)]:
+                yield duplicate, result
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await session.close()
+        if own_geocoder:
+            geocoder.close()
+
+
+def locate_all(queries, geocoder=None, **kwargs):
+    """
+    Geocode queries concurrently with `locate`, returning their results in order
+
+    Runs its own event loop, so that it can not be called from a coroutine, where
+    `locate` is used instead.
+
+    Returns
+    =======
+    results: list of dict or Exception
+        Result of each query, see `Geocoder.geocode`, or the exception of a
+        failed request, see `locate`
+    """
+    import asyncio
+
+    queries = list(queries)
+
+    async def collect():
+        results = locate(queries, geocoder, **kwargs)
+        return {normalize_place(q): r async for q, r in results}
+
+    # Not `asyncio.run`, which is not available before Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(collect())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        loop.close()
+
+    return [results[normalize_place(query)] for query in queries]
+
+
+async def _request(session, geocoder, query, retries, backoff):
+    """
+    Request a query from the server of a geocoder, retrying failed requests
+    """
+    import asyncio
+    import aiohttp
+
+    params = dict(SEARCH_PARAMS, q=query)
+    for attempt in range(retries + 1):
+        delay = backoff * 2 ** attempt
+        await geocoder.bucket.acquire_async()
+        try:
+            async with session.get(f"{geocoder.base_url}/search",
+                                   params=params) as response:
+                if response.status not in RETRY_STATUSES or attempt == retries:
+                    response.raise_for_status()
+                    return _parse_nominatim(await response.json(content_type=None))
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+        await asyncio.sleep(delay)
+
+
+def _parse_nominatim(places):
+    """
+    Get the result of the best match of a Nominatim search, or `None` if none
+    """
+    from shapely.geometry import Point, shape
+
+    if not places:
+        return None
+
+    place = places[0]
+    lon, lat = float(place["lon"]), float(place["lat"])
+    geometry = place.get("geojson")
+    postal_code = place.get("address", dict()).get("postcode")
+
+    return {
+        "name": place.get("display_name"),
+        "postal_code": postal_code,
+        "lon": lon,
+        "lat": lat,
+        "geometry": shape(geometry) if geometry else Point(lon, lat),
+        "source": "nominatim",
+        }
+
+
+def _result_to_json(result):
+    """
+    Get a JSON serializable copy of a result, with its geometry as GeoJSON
+    """
+    from shapely.geometry import mapping
+
+    return dict(result, geometry=mapping(result["geometry"]))
+
+
+def _result_from_json(d, source):
+    """
+    Get a result from a copy made by `_result_to_json`
+    """
+    from shapely.geometry import shape
+
+    return dict(d, geometry=shape(d["geometry"]), source=source)
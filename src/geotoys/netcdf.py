@@ -1,6 +1,65 @@
 """
 Methods for perfoming common tasks with NetCDF files
 """
+import collections
+import re
+import sqlite3
+import threading
+
+# CF time units, e.g. `hours since 1900-01-01 00:00:00.0 +01:00`
+CF_UNITS_PATTERN = re.compile(
+    r"^\s*(?P<unit>[a-zA-Z]+)\s+since\s+"
+    r"(?P<year>[+-]?\d{1,4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})"
+    r"(?:[ T]+(?P<hour>\d{1,2}):(?P<minute>\d{1,2})"
+    r"(?::(?P<second>\d{1,2}(?:\.\d*)?))?)?"
+    r"\s*(?P<tz>Z|UTC|[+-]\d{1,2}(?::?\d{2})?)?\s*$"
+    )
+
+# Microseconds per CF time unit. Months and years are decoded with cftime.
+CF_UNITS_US = {
+    unit: us
+    for units, us in [
+        (("days", "day", "d"), 86400000000),
+        (("hours", "hour", "hrs", "hr", "h"), 3600000000),
+        (("minutes", "minute", "mins", "min"), 60000000),
+        (("seconds", "second", "secs", "sec", "s"), 1000000),
+        (("milliseconds", "millisecond", "msecs", "msec", "ms"), 1000),
+        (("microseconds", "microsecond", "usecs", "usec", "us"), 1),
+        ]
+    for unit in units
+    }
+
+# Calendars that are the proleptic Gregorian calendar of numpy after 1582-10-15
+STANDARD_CALENDARS = ("standard", "gregorian", "proleptic_gregorian")
+
+# Microseconds since 1970 of the start of the Gregorian calendar, 1582-10-15, and of
+# the bounds of datetime64[ns]
+_GREGORIAN_START_US = -12219292800000000
+_NS_RANGE_US = 2 ** 63 // 1000 - 1
+
+# Maximum size in bytes of the chunk cache of a variable when reading a subset
+MAX_CHUNK_CACHE = 256 * 1024 ** 2
+
+# Number of files whose decoded timestamps are kept in memory, see `get_timestamps`
+MAX_TIMESTAMPS = 1024
+
+# Decoded timestamps, keyed by path, modification time, size and variable name, in
+# order of least recent use
+_timestamps = collections.OrderedDict()
+_timestamps_lock = threading.Lock()
+
+_ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    t0 INTEGER,
+    t1 INTEGER,
+    times BLOB
+);
+CREATE INDEX IF NOT EXISTS files_time ON files (t0, t1);
+"""
+
 
 def find_dim(nc, name):
     KEY_NAMES = {
@@ -18,41 +77,882 @@ def find_dim(nc, name):
     if not var:
         raise ValueError(
             f'Variable {name} not found in netCDF. '
-            f'Available variables: {nc.variables.keys}'
+            f'Available variables: {list(nc.variables.keys())}'
             )
 
-    return k
+    return var
 
 
-def get_lons_lats(nc):
+def get_lons_lats(nc, bbox=None):
     """
-    Read longitude and latitude values from NetCDF
+    Read longitude and latitude values from NetCDF, within a bounding box if given
     """
     lons = nc.variables[find_dim(nc, 'lon')][:]
     lats = nc.variables[find_dim(nc, 'lat')][:]
 
+    if bbox is not None:
+        lon_slices = _lon_slices(lons, bbox[0], bbox[2])
+        lons = _wrap_lons(lons, lon_slices)
+        lats = lats[_index_range(lats, bbox[1], bbox[3])]
+
     return lons, lats
 
 
+def read_subset(nc, var_name, bbox=None, time_range=None, time_index=None):
+    """
+    Read the values of a variable within a bounding box and time range
+
+    The 1-D time, latitude and longitude coordinates are binary searched for the
+    index ranges of the subset, so that only the hyperslab of the subset is read
+    from the variable. Coordinates may be ascending or descending and longitudes
+    in -180 to 180 or 0 to 360, for which a bounding box crossing the
+    antimeridian or prime meridian is read as two hyperslabs. The chunk cache of
+    the variable is enlarged to hold the chunks of the subset, so that each chunk
+    is decompressed once.
+
+    Parameters
+    ==========
+    nc: netCDF4.Dataset
+        Open netCDF dataset
+    var_name: str
+        Name of the variable to read
+    bbox: tuple of float
+        Bounding box in longitude and latitude (lon0, lat0, lon1, lat1)
+    time_range: tuple
+        Start and end timestamps of the subset, inclusive, or `None` for an open
+        range, e.g. `("2019-01-01", None)`. Timestamps without time zone are UTC.
+    time_index: slice
+        Slice of time steps of the subset, instead of a `time_range`
+
+    Returns
+    =======
+    values: numpy.ma.MaskedArray
+        Values of the variable in the subset
+    coords: dict of ndarray
+        Values of the `time`, `lat` and `lon` coordinates of the subset that are
+        dimensions of the variable
+
+    Example
+    =======
+    >>> with netCDF4.Dataset("era5.nc") as nc:
+    ...     t2m, coords = read_subset(nc, "t2m", bbox=(-10, 50, 10, 60),
+    ...                               time_range=("2019-01-01", "2019-02-01"))
+    """
+    import numpy
+
+    var = nc.variables[var_name]
+    slices = [slice(None)] * var.ndim
+    coords = dict()
+    lon_axis, lon_slices = None, None
+
+    for name in ("time", "lat", "lon"):
+        try:
+            coord = nc.variables[find_dim(nc, name)]
+        except ValueError:
+            continue
+        if coord.ndim != 1 or coord.dimensions[0] not in var.dimensions:
+            continue
+        axis = var.dimensions.index(coord.dimensions[0])
+
+        if name == "time":
+            values = get_timestamps(nc)
+            if time_index is not None:
+                slices[axis] = time_index
+            elif time_range is not None:
+                slices[axis] = _index_range(values, *_time_bounds(time_range))
+            coords[name] = values[slices[axis]]
+        elif name == "lat":
+            values = coord[:]
+            if bbox is not None:
+                slices[axis] = _index_range(values, bbox[1], bbox[3])
+            coords[name] = values[slices[axis]]
+        else:
+            values = coord[:]
+            lon_axis, lon_slices = axis, [slice(None)]
+            if bbox is not None:
+                lon_slices = _lon_slices(values, bbox[0], bbox[2])
+            coords[name] = _wrap_lons(values, lon_slices)
+
+    # Hyperslabs of the subset, two if split by the edge of the longitudes
+    hyperslabs = [tuple(slices)]
+    if lon_slices is not None:
+        hyperslabs = [
+            tuple(s if i != lon_axis else s_lon for i, s in enumerate(slices))
+            for s_lon in lon_slices
+            ]
+
+    _fit_chunk_cache(var, hyperslabs)
+    values = [var[hyperslab] for hyperslab in hyperslabs]
+    if len(values) == 1:
+        return values[0], coords
+
+    return numpy.ma.concatenate(values, axis=lon_axis), coords
+
+
+def _index_range(values, lower=None, upper=None):
+    """
+    Get the slice of the values of a monotonic array between lower and upper
+    bounds inclusive, by binary search
+    """
+    import numpy
+
+    n = len(values)
+    if n > 1 and values[0] > values[-1]:
+        rev = values[::-1]
+        start = 0 if upper is None else n - numpy.searchsorted(rev, upper, "right")
+        stop = n if lower is None else n - numpy.searchsorted(rev, lower, "left")
+    else:
+        start = 0 if lower is None else numpy.searchsorted(values, lower, "left")
+        stop = n if upper is None else numpy.searchsorted(values, upper, "right")
+
+    return slice(int(start), int(max(start, stop)))
+
+
+def _lon_slices(lons, lon0, lon1):
+    """
+    Get the slices of longitudes between `lon0` and `lon1`, two if the range
+    crosses the edge of the longitudes, e.g. the prime meridian for 0 to 360
+    """
+    if lon1 - lon0 >= 360:
+        return [slice(None)]
+
+    # Convert to the convention of the longitudes, 0 to 360 or -180 to 180
+    if lons.max() > 180:
+        lon0, lon1 = lon0 % 360, lon1 % 360
+    else:
+        lon0, lon1 = (lon0 + 180) % 360 - 180, (lon1 + 180) % 360 - 180
+        lon1 = 180 if lon1 == -180 else lon1
+
+    if lon0 <= lon1:
+        return [_index_range(lons, lon0, lon1)]
+
+    return [_index_range(lons, lon0, None), _index_range(lons, None, lon1)]
+
+
+def _wrap_lons(lons, lon_slices):
+    """
+    Get the longitudes of slices, continuous across the edge of the longitudes
+    """
+    import numpy
+
+    if len(lon_slices) == 1:
+        return lons[lon_slices[0]]
+
+    west, east = (lons[s] for s in lon_slices)
+    if lons.max() > 180:
+        west = west - 360
+    else:
+        east = east + 360
+
+    return numpy.ma.concatenate([west, east])
+
+
+def _time_bounds(time_range):
+    """
+    Convert the start and end of a time range to `datetime64` in UTC
+    """
+    import numpy
+
+    from geotoys.datetime import utc_timestamp
+
+    return tuple(
+        None if ts is None else numpy.datetime64(utc_timestamp(ts).tz_convert(None))
+        for ts in time_range
+        )
+
+
+def _fit_chunk_cache(var, hyperslabs):
+    """
+    Enlarge the chunk cache of a variable to hold all chunks of the hyperslabs
+    """
+    import functools
+    import operator
+
+    chunking = var.chunking()
+    if not isinstance(chunking, (list, tuple)):
+        return
+
+    n_chunks = 0
+    for hyperslab in hyperslabs:
+        n = 1
+        for s, chunk, size in zip(hyperslab, chunking, var.shape):
+            start, stop, _ = s.indices(size)
+            n *= (stop - 1) // chunk - start // chunk + 1 if stop > start else 0
+        n_chunks += n
+
+    chunk_size = functools.reduce(operator.mul, chunking, 1)
+    nbytes = min(n_chunks * chunk_size * var.dtype.itemsize, MAX_CHUNK_CACHE)
+    size, nelems, preemption = var.get_var_chunk_cache()
+    if nbytes > size:
+        var.set_var_chunk_cache(nbytes, max(nelems, 2 * n_chunks + 1), preemption)
+
+
 def get_timestamps(nc):
     """
     Read timestamps from netCDF time variable
+
+    Timestamps are decoded with `decode_times` and cached per file, until the
+    file is modified, for the `MAX_TIMESTAMPS` most recently used files.
+
+    Returns
+    =======
+    timestamps: ndarray
+        Timestamps as `datetime64[ns]` in UTC, or `cftime` datetimes if they can
+        not be represented, e.g. February 30 of a `360_day` calendar
+    """
+    import os
+
+    # Find time variable
+    time_key = find_dim(nc, 'time')
+    times = nc.variables[time_key]
+
+    key = None
+    try:
+        fp = nc.filepath()
+        stat = os.stat(fp)
+        key = (fp, stat.st_mtime_ns, stat.st_size, time_key)
+    except (ValueError, OSError):
+        # In-memory or diskless dataset
+        pass
+
+    with _timestamps_lock:
+        if key in _timestamps:
+            _timestamps.move_to_end(key)
+            return _timestamps[key]
+
+    timestamps = decode_times(
+        times[:],
+        times.units,
+        getattr(times, "calendar", "standard"),
+        )
+    timestamps.flags.writeable = False
+    if key is not None:
+        with _timestamps_lock:
+            _timestamps[key] = timestamps
+            while len(_timestamps) > MAX_TIMESTAMPS:
+                _timestamps.popitem(last=False)
+
+    return timestamps
+
+
+def decode_times(values, units, calendar="standard"):
+    """
+    Decode CF time values to timestamps
+
+    The units are parsed once and values of the standard calendars are decoded by
+    integer array arithmetic, rounded to microseconds as by `cftime`. Values of
+    other calendars, in months or years, before the Gregorian calendar was
+    adopted in 1582 or outside the range of `datetime64[ns]` are decoded with
+    `cftime`.
+
+    Parameters
+    ==========
+    values: ndarray
+        Time values, masked values are decoded to `NaT`
+    units: str
+        CF time units, e.g. `hours since 1900-01-01 00:00:00`
+    calendar: str
+        CF calendar
+
+    Returns
+    =======
+    timestamps: ndarray
+        Timestamps as `datetime64[ns]` in UTC, or `cftime` datetimes if they can
+        not be represented in a `datetime64` array
+
+    Example
+    =======
+    >>> decode_times([0, 1.5], "days since 2000-01-01")
+    array(['2000-01-01T00:00:00.000000000', '2000-01-02T12:00:00.000000000'],
+          dtype='datetime64[ns]')
+    """
+    import numpy
+
+    values = numpy.ma.masked_invalid(numpy.ma.asarray(values))
+    mask = numpy.ma.getmaskarray(values)
+    data = values.filled(0)
+
+    calendar = (calendar or "standard").lower()
+    origin = _parse_units(units)
+    if origin is None or calendar not in STANDARD_CALENDARS:
+        return _decode_times_cftime(values, units, calendar)
+
+    # Decode by arithmetic only within the range of datetime64[ns] and, for the
+    # mixed Julian/Gregorian standard calendar, after the Gregorian calendar
+    origin_us, unit_us = origin
+    start = -_NS_RANGE_US
+    if calendar != "proleptic_gregorian":
+        start = max(start, _GREGORIAN_START_US)
+    if data.size:
+        lo, hi = data.min() * float(unit_us), data.max() * float(unit_us)
+        if origin_us < start or origin_us + lo < start or origin_us + hi > _NS_RANGE_US:
+            return _decode_times_cftime(values, units, calendar)
+
+    if data.dtype.kind in "iu":
+        offset_us = data.astype("int64") * unit_us
+    else:
+        offset_us = numpy.round(data.astype("float64") * unit_us).astype("int64")
+    timestamps = ((origin_us + offset_us) * 1000).view("datetime64[ns]")
+    timestamps[mask] = numpy.datetime64("NaT")
+
+    return timestamps
+
+
+def _parse_units(units):
+    """
+    Parse CF time units, returning the origin in microseconds since 1970 in UTC and
+    the microseconds per unit, or `None` if not decodable by array arithmetic
+    """
+    import numpy
+
+    match = CF_UNITS_PATTERN.match(units)
+    if not match or match["unit"].lower() not in CF_UNITS_US:
+        return None
+
+    year = int(match["year"])
+    if not 0 < year < 10000:
+        return None
+    date = f"{year:04d}-{int(match['month']):02d}-{int(match['day']):02d}"
+    origin_us = int(numpy.datetime64(date, "us").astype("int64"))
+    origin_us += int(match["hour"] or 0) * 3600000000
+    origin_us += int(match["minute"] or 0) * 60000000
+    origin_us += round(float(match["second"] or 0) * 1000000)
+
+    tz = match["tz"]
+    if tz and tz not in ("Z", "UTC"):
+        sign = -1 if tz.startswith("-") else 1
+        hours, _, minutes = tz.lstrip("+-").partition(":")
+        if not minutes and len(hours) > 2:
+            hours, minutes = hours[:-2], hours[-2:]
+        origin_us -= sign * (int(hours) * 60 + int(minutes or 0)) * 60000000
+
+    return origin_us, CF_UNITS_US[match["unit"].lower()]
+
+
+def _decode_times_cftime(values, units, calendar):
+    """
+    Decode CF time values with `cftime`, converting to `datetime64[ns]` if possible
+    """
+    import cftime
+    import numpy
+
+    dates = cftime.num2date(values, units, calendar, only_use_cftime_datetimes=True)
+    dates = numpy.ma.masked_equal(numpy.ma.asarray(dates, dtype=object), None)
+    valid = ~numpy.ma.getmaskarray(dates)
+    try:
+        timestamps_us = numpy.array(
+            [d.isoformat() for d in dates.data[valid]], dtype="datetime64[us]"
+            ).astype("int64")
+    except ValueError:
+        # Dates that do not exist in the Gregorian calendar
+        return dates.filled(None)
+    if timestamps_us.size and (
+            timestamps_us.min() < -_NS_RANGE_US or timestamps_us.max() > _NS_RANGE_US):
+        return dates.filled(None)
+
+    timestamps = numpy.full(dates.shape, numpy.datetime64("NaT"), "datetime64[ns]")
+    timestamps[valid] = timestamps_us * 1000
+
+    return timestamps
+
+
+def as_dataframe(files, x, y, variables, times=None, n_cpu=3, files_per_job=None):
     """
+    Create a dataframe from netCDF files for given position(s) and time(s)
+
+    Points are mapped to the nearest cells of the longitude and latitude grid,
+    shared by all files, in a single array operation. Points are grouped by the
+    chunks of each variable, so that a single hyperslab spanning the points of
+    each chunk is read. Files are split into jobs of `files_per_job` files that
+    are sampled in a process pool, or in this process if there is a single job or
+    process.
+
+    Without `times` all time steps are sampled at all points. With `times` each
+    point is sampled at the time step of the files nearest to its time.
+
+    Parameters
+    ==========
+    files: list of str
+        Paths of netCDF files with variables on the same grid
+    x: list of float
+        Longitudes of points
+    y: list of float
+        Latitudes of points
+    variables: list of str
+        Names of variables with dimensions time, latitude and longitude
+    times: list of timestamps
+        Time of each point, timestamps without time zone are UTC
+    n_cpu: int
+        Number of processes sampling files
+    files_per_job: int
+        Number of files sampled by each job. By default files are split so that
+        each process gets around four jobs.
+
+    Returns
+    =======
+    df: pandas.DataFrame
+        Values of each variable indexed by timestamp, x and y as
+        `geotoys.geotiff.as_dataframe`. Points outside of the grid and masked
+        values are NaN.
+    """
+    import concurrent.futures
     import netCDF4
     import numpy
     import pandas
 
-    # Find time variable
-    time_key = find_dim(nc, 'time')
+    from geotoys.datetime import utc_timestamp
+
+    files = list(files)
+    variables = [variables] if isinstance(variables, str) else list(variables)
+    x = numpy.atleast_1d(numpy.asarray(x, dtype=float))
+    y = numpy.atleast_1d(numpy.asarray(y, dtype=float))
 
-    # Get timestamps from netCDF time variable
-    timestamps = None
-    if time_key:
+    if x.shape != y.shape:
+        raise ValueError("`x` and `y` must have the same number of positions")
+    if not files:
+        raise ValueError("No netCDF files provided to sample")
+
+    # Grid indices of points
+    with netCDF4.Dataset(files[0]) as nc:
+        lons, lats = get_lons_lats(nc)
+    lons, lats = numpy.ma.getdata(lons), numpy.ma.getdata(lats)
+    x_grid = x % 360 if lons.max() > 180 else (x + 180) % 360 - 180
+    ix, inside_x = _nearest_index(lons, x_grid, period=360)
+    iy, inside_y = _nearest_index(lats, y)
+    inside = inside_x & inside_y
+
+    # Time step of each point, points in the jobs of each file
+    if times is not None:
         try:
-            times = nc.variables[time_key]
-            timestamps = netCDF4.num2date(times[:], times.units)
-            timestamps = numpy.array([pandas.Timestamp(ts) for ts in timestamps])
-        except Exception as e:
-            raise e
+            t = pandas.to_datetime(numpy.atleast_1d(times), utc=True)
+        except ValueError:
+            # Strings in differing formats, parsed one at a time
+            t = pandas.DatetimeIndex(
+                [utc_timestamp(ts) for ts in numpy.atleast_1d(times).tolist()]
+                )
+        t = t.tz_convert(None).to_numpy("datetime64[ns]")
+        if t.shape != x.shape:
+            raise ValueError("`times` must have the same number of positions as `x`")
 
-    return timestamps
+        file_times = list()
+        for fp in files:
+            with netCDF4.Dataset(fp) as nc:
+                file_times.append(get_timestamps(nc))
+        steps_all = numpy.concatenate(file_times).view("int64")
+        file_ix = numpy.repeat(numpy.arange(len(files)), [len(t) for t in file_times])
+        step_ix = numpy.concatenate([numpy.arange(len(t)) for t in file_times])
+
+        order = numpy.argsort(steps_all, kind="stable")
+        nearest, _ = _nearest_index(steps_all[order], t.view("int64"))
+        nearest = order[nearest]
+        point_files, point_steps = file_ix[nearest], step_ix[nearest]
+        point_times = steps_all[nearest].view("datetime64[ns]")
+
+    if files_per_job is None:
+        files_per_job = max(1, -(-len(files) // (4 * n_cpu)))
+
+    jobs = list()
+    for i in range(0, len(files), files_per_job):
+        job_files = files[i:i + files_per_job]
+        points, steps = None, None
+        if times is not None:
+            points = [
+                numpy.flatnonzero(inside & (point_files == j))
+                for j in range(i, i + len(job_files))
+                ]
+            steps = [point_steps[p] for p in points]
+        jobs.append((job_files, points, steps))
+
+    # Sample small extractions without the cost of starting processes
+    results = list()
+    if len(jobs) == 1 or n_cpu == 1:
+        for job_files, points, steps in jobs:
+            results += _sample_files(job_files, variables, iy, ix, points, steps)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_cpu) as executor:
+            futures = [
+                executor.submit(
+                    _sample_files, job_files, variables, iy, ix, points, steps
+                    )
+                for job_files, points, steps in jobs
+                ]
+            for future in futures:
+                results += future.result()
+
+    if times is None:
+        timestamps = numpy.concatenate([ts for ts, _ in results])
+        values = numpy.concatenate([v for _, v in results])
+        values[:, ~inside] = numpy.nan
+        n_steps = len(timestamps)
+        df = pandas.DataFrame(values.reshape(-1, len(variables)), columns=variables)
+        df["timestamp"] = numpy.repeat(timestamps, len(x))
+        df["x"] = numpy.tile(x, n_steps)
+        df["y"] = numpy.tile(y, n_steps)
+    else:
+        values = numpy.full((len(x), len(variables)), numpy.nan)
+        for points, file_values in results:
+            values[points] = file_values
+        df = pandas.DataFrame(values, columns=variables)
+        df["timestamp"] = point_times
+        df["x"] = x
+        df["y"] = y
+
+    # Sort and index by time and positions
+    df["timestamp"] = pandas.to_datetime(df["timestamp"]).dt.tz_localize("UTC")
+    index_cols = ["timestamp", "x", "y"]
+    df = df.sort_values(index_cols, kind="stable").set_index(index_cols)
+
+    return df
+
+
+def _nearest_index(coords, values, period=None):
+    """
+    Get the indices of the nearest values of monotonic coordinates to values
+
+    Values further than half the coordinate spacing outside of the coordinates are
+    not inside. If a `period` is given and the coordinates span it, e.g. global
+    longitudes, values past the last coordinate wrap to the first.
+
+    Returns
+    =======
+    index: ndarray
+        Index of nearest coordinate of each value
+    inside: ndarray
+        Boolean array, `True` where values are within the coordinates
+    """
+    import numpy
+
+    n = len(coords)
+    descending = n > 1 and coords[0] > coords[-1]
+    asc = coords[::-1] if descending else coords
+    if n == 1:
+        return numpy.zeros(len(values), dtype="int64"), numpy.ones(len(values), bool)
+
+    index = numpy.clip(numpy.searchsorted(asc, values), 1, n - 1)
+    index -= (values - asc[index - 1]) < (asc[index] - values)
+
+    half = (asc[-1] - asc[0]) / (n - 1) / 2
+    inside = (values >= asc[0] - half) & (values <= asc[-1] + half)
+    if period is not None and asc[-1] - asc[0] + 2 * half >= period:
+        wrapped = values > asc[-1] + half
+        index[wrapped] = 0
+        inside |= wrapped
+
+    if descending:
+        index = n - 1 - index
+
+    return index, inside
+
+
+def _sample_files(files, variables, iy, ix, points=None, steps=None):
+    """
+    Sample grid cells from a chunk of netCDF files within a single worker
+
+    Returns for each file the timestamps and values (n_steps, n_points, n_vars)
+    of all time steps, or if the `points` and `steps` to sample of each file are
+    given, the points and their values (n_points, n_vars).
+    """
+    import netCDF4
+    import numpy
+
+    results = list()
+    for i, fp in enumerate(files):
+        with netCDF4.Dataset(fp) as nc:
+            if points is None:
+                values = [_read_points(nc, v, iy, ix) for v in variables]
+                results.append((get_timestamps(nc), numpy.stack(values, axis=-1)))
+            else:
+                p = points[i]
+                values = [
+                    _read_points(nc, v, iy[p], ix[p], steps[i]) for v in variables
+                    ]
+                results.append((p, numpy.stack(values, axis=-1)))
+
+    return results
+
+
+def _read_points(nc, var_name, iy, ix, steps=None):
+    """
+    Read the values of a variable at grid cells, for all or given time steps
+
+    Cells are grouped by the chunks of the variable, or blocks of 256 by 256 cells
+    if not chunked, and the hyperslab spanning the cells of each chunk is read.
+    Masked values are NaN.
+    """
+    import numpy
+
+    var = nc.variables[var_name]
+    dims = [
+        nc.variables[find_dim(nc, name)].dimensions[0]
+        for name in ("time", "lat", "lon")
+        ]
+    if sorted(dims) != sorted(var.dimensions):
+        raise ValueError(f"{var_name} must have only time, lat and lon dimensions")
+    axes = [var.dimensions.index(d) for d in dims]
+    n_steps = var.shape[axes[0]]
+
+    chunking = var.chunking()
+    if not isinstance(chunking, (list, tuple)):
+        chunking = [256] * var.ndim
+    cy, cx = chunking[axes[1]], chunking[axes[2]]
+
+    shape = (len(iy),) if steps is not None else (n_steps, len(iy))
+    out = numpy.full(shape, numpy.nan)
+    if not len(iy):
+        return out
+
+    # Group cells by chunk
+    key = (iy // cy) * (var.shape[axes[2]] // cx + 1) + ix // cx
+    order = numpy.argsort(key, kind="stable")
+    _, starts = numpy.unique(key[order], return_index=True)
+
+    for group in numpy.split(order, starts[1:]):
+        gy, gx = iy[group], ix[group]
+        y0, x0 = gy.min(), gx.min()
+        t0, t1 = 0, n_steps
+        if steps is not None:
+            t0, t1 = steps[group].min(), steps[group].max() + 1
+
+        index = [None] * var.ndim
+        index[axes[0]] = slice(t0, t1)
+        index[axes[1]] = slice(y0, gy.max() + 1)
+        index[axes[2]] = slice(x0, gx.max() + 1)
+        block = var[tuple(index)].transpose(axes)
+        block = numpy.ma.filled(numpy.ma.asarray(block, dtype=float), numpy.nan)
+
+        if steps is None:
+            out[:, group] = block[:, gy - y0, gx - x0]
+        else:
+            out[group] = block[steps[group] - t0, gy - y0, gx - x0]
+
+    return out
+
+
+class Archive(object):
+    """
+    Collection of netCDF files split along time, e.g. one file per day or month
+
+    The timestamps of each file are indexed in an SQLite database, which can be
+    persisted to a file so that only new or modified files are opened to index
+    them again. Reads of a time range are routed to the files and time steps
+    within the range using the index alone, and files are opened from a pool of
+    at most `max_open` handles, closing the least recently used.
+
+    Example
+    =======
+    >>> files = glob.glob("/data/era5/*.nc")
+    >>> with Archive(files, "era5_index.sqlite") as archive:
+    ...     t2m, coords = archive.read("t2m", ("2019-01-01", "2019-01-31"),
+    ...                                bbox=(-10, 50, 10, 60))
+    """
+
+    def __init__(self, files, path_index=":memory:", max_open=32):
+        self.max_open = max_open
+        self._handles = collections.OrderedDict()
+        self.conn = sqlite3.connect(path_index)
+        self.conn.executescript(_ARCHIVE_SCHEMA)
+        self.update(files)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        while self._handles:
+            _, nc = self._handles.popitem()
+            nc.close()
+        self.conn.close()
+
+    def update(self, files):
+        """
+        Set the files of the archive, indexing those new or modified since indexed
+
+        Parameters
+        ==========
+        files: list of str
+            Paths of netCDF files
+
+        Returns
+        =======
+        n_updated: int
+            Number of files indexed
+        n_removed: int
+            Number of files removed from the index
+        """
+        import os
+
+        stats = dict()
+        for fp in files:
+            stat = os.stat(fp)
+            stats[os.path.abspath(fp)] = (stat.st_mtime, stat.st_size)
+
+        rows = self.conn.execute("SELECT path, mtime, size FROM files")
+        indexed = {fp: (mtime, size) for fp, mtime, size in rows}
+
+        removed = [fp for fp in indexed if fp not in stats]
+        modified = [fp for fp, stat in stats.items() if indexed.get(fp) != stat]
+
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM files WHERE path = ?", [(fp,) for fp in removed]
+                )
+            for fp in modified:
+                self._close(fp)
+                times = self._read_times(fp)
+                t0, t1 = None, None
+                if times.size:
+                    t0, t1 = int(times.min()), int(times.max())
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    (fp,) + stats[fp] + (t0, t1, times.tobytes()),
+                    )
+
+        return len(modified), len(removed)
+
+    def _read_times(self, fp):
+        """
+        Read the timestamps of a file as nanoseconds since 1970
+        """
+        import numpy
+
+        timestamps = get_timestamps(self._open(fp))
+        if timestamps.dtype != "datetime64[ns]":
+            raise ValueError(f"Times of {fp} can not be represented as datetime64")
+
+        return numpy.ascontiguousarray(timestamps).view("int64")
+
+    @property
+    def files(self):
+        """
+        Paths of the files of the archive ordered by their first timestamp
+        """
+        rows = self.conn.execute("SELECT path FROM files ORDER BY t0, path")
+
+        return [fp for fp, in rows]
+
+    @property
+    def timestamps(self):
+        """
+        Timestamps of all files of the archive, in order of the files
+        """
+        import numpy
+
+        blobs = self.conn.execute("SELECT times FROM files ORDER BY t0, path")
+        times = [numpy.frombuffer(blob, dtype="int64") for blob, in blobs]
+        if not times:
+            return numpy.array([], dtype="datetime64[ns]")
+
+        return numpy.concatenate(times).view("datetime64[ns]")
+
+    def select(self, time_range=None):
+        """
+        Find the files and slices of their time steps within a time range
+
+        Parameters
+        ==========
+        time_range: tuple
+            Start and end timestamps, inclusive, or `None` for an open range.
+            Timestamps without time zone are UTC.
+
+        Returns
+        =======
+        selection: list of tuple
+            Path of each file with time steps in the range and the slice of those
+            time steps, ordered by time
+        """
+        import numpy
+
+        t0, t1 = _time_bounds(time_range or (None, None))
+        t0 = None if t0 is None else int(t0.astype("datetime64[ns]").astype("int64"))
+        t1 = None if t1 is None else int(t1.astype("datetime64[ns]").astype("int64"))
+
+        sql = "SELECT path, times FROM files WHERE t0 IS NOT NULL"
+        params = list()
+        if t0 is not None:
+            sql += " AND t1 >= ?"
+            params.append(t0)
+        if t1 is not None:
+            sql += " AND t0 <= ?"
+            params.append(t1)
+        sql += " ORDER BY t0, path"
+
+        selection = list()
+        for fp, blob in self.conn.execute(sql, params):
+            times = numpy.frombuffer(blob, dtype="int64")
+            time_index = _index_range(times, t0, t1)
+            if time_index.stop > time_index.start:
+                selection.append((fp, time_index))
+
+        return selection
+
+    def read(self, var_name, time_range=None, bbox=None):
+        """
+        Read the values of a variable within a time range and bounding box
+
+        Only the files with time steps within the range are opened, see
+        `read_subset`.
+
+        Parameters
+        ==========
+        var_name: str
+            Name of the variable to read
+        time_range: tuple
+            Start and end timestamps, inclusive, or `None` for an open range
+        bbox: tuple of float
+            Bounding box in longitude and latitude (lon0, lat0, lon1, lat1)
+
+        Returns
+        =======
+        values: numpy.ma.MaskedArray
+            Values of the variable, concatenated along time
+        coords: dict of ndarray
+            Values of the `time`, `lat` and `lon` coordinates of the values
+        """
+        import numpy
+
+        values, coords = list(), None
+        for fp, time_index in self.select(time_range):
+            nc = self._open(fp)
+            v, c = read_subset(nc, var_name, bbox=bbox, time_index=time_index)
+            values.append(v)
+            if coords is None:
+                coords = c
+                time_dim = nc.variables[find_dim(nc, "time")].dimensions[0]
+                axis = nc.variables[var_name].dimensions.index(time_dim)
+            else:
+                coords["time"] = numpy.concatenate([coords["time"], c["time"]])
+
+        if not values:
+            raise ValueError(f"No time steps of {var_name} in {time_range}")
+
+        return numpy.ma.concatenate(values, axis=axis), coords
+
+    def _open(self, fp):
+        """
+        Open a file of the archive, reusing the handle if already open
+
+        The least recently used handles are closed once more than `max_open` are
+        open.
+        """
+        import netCDF4
+
+        nc = self._handles.pop(fp, None)
+        if nc is None or not nc.isopen():
+            nc = netCDF4.Dataset(fp)
+        self._handles[fp] = nc
+
+        while len(self._handles) > self.max_open:
+            _, nc_old = self._handles.popitem(last=False)
+            nc_old.close()
+
+        return nc
+
+    def _close(self, fp):
+        """
+        Close the handle of a file if open
+        """
+        nc = self._handles.pop(fp, None)
+        if nc is not None and nc.isopen():
+            nc.close()
@@ -35,18 +35,22 @@ def add_geotiff_ax(ax, fp, band_ind, ix_t, crs):
     return ax
 
 
-def add_netcdf_ax(ax, fp, var_name, ix_t, crs):
+def add_netcdf_ax(ax, fp, var_name, ix_t, crs, bbox=None):
     """
     Add a projected plot of the first timestep in a NetCDF to the Axes instance
+
+    Only the values within the bounding box in longitude and latitude `bbox`
+    (lon0, lat0, lon1, lat1) are read, if given.
     """
     import netCDF4
 
-    nc = netCDF4.Dataset(fp)
+    from geotoys.netcdf import read_subset
 
-    var = nc[var_name][ix_t,:,:]
-    lons, lats = get_lons_lats(nc)
+    with netCDF4.Dataset(fp) as nc:
+        time_index = slice(ix_t, ix_t + 1)
+        var, coords = read_subset(nc, var_name, bbox=bbox, time_index=time_index)
 
-    ax.contourf(lons, lats, var, 60, transform=crs)
+    ax.contourf(coords["lon"], coords["lat"], var[0], 60, transform=crs)
 
     return ax
 
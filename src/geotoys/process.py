@@ -2,39 +2,622 @@
 Methods for general processing of geospatial and satellite data
 """
 
-def normalize(x, lower, upper):
+def normalize(x, lower, upper, x_min=None, x_max=None, out=None, stats=None,
+              percentiles=None):
     """
     Normalize an array to a given bound interval
+
+    The minimum and maximum of the array are used to normalize it unless `x_min`
+    and `x_max` are given, e.g. when normalizing tiles of a larger image, or
+    precomputed `stats` of the array are given. An `out` array, which may be `x`
+    itself, can be passed to normalize in place.
+
+    Passing `percentiles`, e.g. `(2, 98)`, stretches the values between those
+    percentiles to the interval and clips the rest, so that outliers do not
+    compress the stretch.
+
+    Example
+    =======
+    Normalize a tile by the 2-98% stretch of its band
+    >>> stats = geotoys.stats.file_stats(fp)[1]
+    >>> tile = normalize(tile, 0, 255, stats=stats, percentiles=(2, 98))
     """
     import numpy
 
-    x_max = numpy.max(x)
-    x_min = numpy.min(x)
+    if percentiles is not None:
+        if stats is not None:
+            x_min, x_max = stats.percentile(percentiles)
+        else:
+            x_min, x_max = numpy.nanpercentile(x, percentiles)
+    elif stats is not None:
+        x_min, x_max = stats.min, stats.max
+
+    if x_max is None:
+        x_max = numpy.max(x)
+    if x_min is None:
+        x_min = numpy.min(x)
 
     m = (upper - lower) / (x_max - x_min)
-    x_norm = (m * (x - x_min)) + lower
+    if out is None:
+        out = (m * (x - x_min)) + lower
+    else:
+        numpy.subtract(x, x_min, out=out)
+        out *= m
+        out += lower
+
+    if percentiles is not None:
+        numpy.clip(out, lower, upper, out=out)
 
-    return x_norm
+    return out
 
 
-def true_color(a, factor=2.5):
+def true_color(a, factor=2.5, out=None):
     """
     Apply "true color" transformation to ndarray
     """
-    return factor*a
+    import numpy
+
+    return numpy.multiply(a, factor, out=out)
 
 
 def stack_bands(bands):
     """
     Stack bands adding a third dimension to the front of the array
     """
-    from functools import reduce
     import numpy
 
-    bands = reduce(lambda x, xn: numpy.dstack([x, xn]), bands)
-    bands = numpy.moveaxis(bands, -1, 0)
+    return numpy.stack(bands)
+
+
+def stretch_coefficients(x_min, x_max, lower=0, upper=255):
+    """
+    Get the scale and offset normalizing values between `x_min` and `x_max` to the
+    interval `lower` to `upper`, for use with `to_uint8`
+
+    As normalization is linear, any `true_color` factor applied before it cancels
+    out, and `x_min` and `x_max` are those of the untransformed values. A band of
+    constant values, or without values where `x_min` and `x_max` are NaN, is
+    mapped to `lower`.
+    """
+    span = x_max - x_min
+    if span == 0 or span != span:
+        return 0.0, float(lower)
+
+    scale = (upper - lower) / span
+    offset = lower - x_min * scale
+
+    return scale, offset
+
+
+def to_uint8(x, scale, offset, lower=0, upper=255, nodata=None, fill=0, out=None,
+             n_threads=None):
+    """
+    Scale, offset, clip and cast an array to `uint8` in a single pass
+
+    Computes `clip(x * scale + offset, lower, upper)` cast to `uint8`, setting NaN
+    and `nodata` values to `fill`, without full size temporary arrays. Blocks of
+    rows are processed in a thread pool, with a compiled kernel if numba is
+    installed, otherwise with NumPy `out=` operations.
+
+    Example
+    =======
+    Normalize a band to 0-255 and cast to uint8, as with
+    `normalize(true_color(x), 0, 255).astype("uint8")`
+    >>> scale, offset = stretch_coefficients(x.min(), x.max())
+    >>> x_uint8 = to_uint8(x, scale, offset)
+
+    Parameters
+    ==========
+    x: ndarray
+        Array to convert
+    scale: float
+        Factor to multiply values by
+    offset: float
+        Value to add after scaling
+    lower: int
+        Lower value to clip to
+    upper: int
+        Upper value to clip to
+    nodata: float
+        Value of `x` to set to `fill`
+    fill: int
+        Value of output for NaN and `nodata` values
+    out: ndarray
+        Preallocated `uint8` array to write output to, shaped as `x`
+    n_threads: int
+        Number of threads, defaults to number of CPUs
+
+    Returns
+    =======
+    out: ndarray
+        Converted `uint8` array
+    """
+    import numpy
+
+    x = numpy.asarray(x)
+    if out is None:
+        out = numpy.empty(x.shape, dtype="uint8")
+
+    # Process as 2D arrays of rows
+    if x.ndim == 2:
+        x2, out2 = x, out
+    else:
+        x2 = x.reshape(-1, x.shape[-1]) if x.ndim else x.reshape(1, 1)
+        out2 = out.reshape(x2.shape)
+        if not numpy.shares_memory(out, out2):
+            raise ValueError("`out` must be contiguous for arrays other than 2D")
+
+    args = (float(scale), float(offset), float(lower), float(upper))
+    kernel = _numba_uint8_kernel()
+    if kernel is not None:
+        has_nodata = nodata is not None
+        nodata = nodata if has_nodata else 0
+
+        def convert(rows):
+            kernel(x2[rows], *args, has_nodata, nodata, fill, out2[rows])
+
+        _map_row_blocks(convert, x2.shape[0], n_threads)
+    else:
+        _numpy_uint8(x2, *args, nodata, fill, out2, n_threads)
+
+    return out
+
+
+# Compiled numba kernels, `None` if numba is not installed
+_kernels = dict()
+
+
+def _numba_uint8_kernel():
+    """
+    Compile the numba kernel of `to_uint8` on first use, if numba is installed
+
+    The kernel releases the GIL to run in a thread pool rather than using numba's
+    parallel threading layers, which are not safe to use before forking worker
+    processes.
+    """
+    if "uint8" in _kernels:
+        return _kernels["uint8"]
+
+    try:
+        import numba
+    except ImportError:
+        _kernels["uint8"] = None
+        return None
+
+    @numba.njit(nogil=True, cache=True)
+    def kernel(x, scale, offset, lower, upper, has_nodata, nodata, fill, out):
+        for i in range(x.shape[0]):
+            for j in range(x.shape[1]):
+                v = x[i, j]
+                if v != v or (has_nodata and v == nodata):
+                    out[i, j] = fill
+                else:
+                    y = v * scale + offset
+                    if y < lower:
+                        y = lower
+                    elif y > upper:
+                        y = upper
+                    out[i, j] = numba.uint8(y)
+
+    _kernels["uint8"] = kernel
+
+    return kernel
+
+
+def _numpy_uint8(x, scale, offset, lower, upper, nodata, fill, out, n_threads=None,
+                 block_rows=256):
+    """
+    NumPy implementation of `to_uint8` for 2D arrays, processing blocks of rows
+    concurrently with a buffer per block
+    """
+    import numpy
+
+    def convert(rows):
+        xb = x[rows]
+        buf = numpy.multiply(xb, scale, dtype="float64")
+        buf += offset
+        numpy.clip(buf, lower, upper, out=buf)
+
+        invalid = numpy.isnan(buf)
+        if nodata is not None:
+            invalid |= xb == nodata
+        buf[invalid] = fill
+        numpy.copyto(out[rows], buf, casting="unsafe")
+
+    _map_row_blocks(convert, x.shape[0], n_threads, block_rows)
+
+
+def _map_row_blocks(func, n_rows, n_threads=None, block_rows=256):
+    """
+    Call a function with slices of blocks of rows concurrently in a thread pool
+    """
+    import concurrent.futures
+
+    blocks = [slice(i, i + block_rows) for i in range(0, n_rows, block_rows)]
+    if len(blocks) == 1:
+        func(blocks[0])
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(func, blocks))
+
+
+def _band_reader(band, stack):
+    """
+    Get a function reading a window of a band from a file path or reader function
+    """
+    import rasterio
+
+    if callable(band):
+        return band
+
+    src = stack.enter_context(rasterio.open(band))
+
+    return lambda window: src.read(1, window=window)
+
+
+def band_range(band, width, height, block_size=512):
+    """
+    Get the minimum and maximum of a band, reading it one block at a time
+
+    Parameters
+    ==========
+    band: str or callable
+        Path of single band image, or function returning the data of the band for
+        a `rasterio.windows.Window`
+    width: int
+        Width of the band
+    height: int
+        Height of the band
+    block_size: int
+        Size of blocks read
+
+    Returns
+    =======
+    x_min: float
+        Minimum of band
+    x_max: float
+        Maximum of band
+    """
+    import contextlib
+    import numpy
+
+    x_min, x_max = numpy.inf, -numpy.inf
+    with contextlib.ExitStack() as stack:
+        read = _band_reader(band, stack)
+        for window in _block_windows(width, height, block_size):
+            data = read(window)
+            x_min = min(x_min, data.min())
+            x_max = max(x_max, data.max())
+
+    return x_min, x_max
+
+
+def _block_windows(width, height, block_size):
+    """
+    Generate windows of blocks covering an image
+    """
+    from rasterio.windows import Window
+
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield Window(
+                col,
+                row,
+                min(block_size, width - col),
+                min(block_size, height - row),
+                )
+
+
+def save_rgb_tiled(bands, src_profile, fp_dst, lower=0, upper=255, ranges=None,
+                   percentiles=None, block_size=512, driver="JPEG", write_xml=False):
+    """
+    Save true color, normalized bands as an RGB image one block at a time
+
+    Each block of the bands is read, transformed, normalized, clipped and cast to
+    `uint8` in preallocated buffers and written to the destination, so that peak
+    memory is bounded by the block size rather than the image size. Bands are
+    normalized by their range over the whole image, or the range between
+    `percentiles` of the image, which is read in a first pass if `ranges` are not
+    given. The true color factor of `true_color` cancels in this normalization,
+    so that it is not applied.
+
+    Formats that can not be written by block, such as JPEG, are streamed to a
+    temporary tiled GeoTIFF that is then copied to the destination format.
+
+    Parameters
+    ==========
+    bands: list of str or callable
+        Paths of single band images, or functions returning the data of a band
+        for a `rasterio.windows.Window`
+    src_profile: dict
+        Image profile with the width, height, CRS and transform of the bands
+    fp_dst: str
+        Path of image to write
+    lower: int
+        Lower bound of the normalized values
+    upper: int
+        Upper bound of the normalized values
+    ranges: list of tuple
+        Minimum and maximum of each band to normalize by, see `band_range` and
+        `geotoys.stats.BandStats.percentile`
+    percentiles: tuple of float
+        Percentiles of each band to normalize by, if `ranges` not given
+    block_size: int
+        Size of blocks to process, a multiple of 16
+    driver: str
+        GDAL driver of the image written
+    write_xml: bool
+        Write the georeferencing of formats that do not support it, such as JPEG,
+        to an auxiliary XML file
+    """
+    import contextlib
+    import os
+    import rasterio
+    import rasterio.shutil
+
+    width, height = src_profile["width"], src_profile["height"]
+
+    tif_profile = {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "width": width,
+        "height": height,
+        "count": len(bands),
+        "tiled": True,
+        "blockxsize": block_size,
+        "blockysize": block_size,
+        }
+
+    if write_xml or driver == "GTiff":
+        tif_profile.update({
+            "crs": src_profile["crs"],
+            "transform": src_profile["transform"],
+        })
+
+    fp_tif = fp_dst if driver == "GTiff" else f"{fp_dst}.tmp.tif"
+
+    blocks = _rgb_blocks(
+        bands, width, height, lower, upper, ranges, percentiles, block_size
+        )
+    with contextlib.closing(blocks), rasterio.open(fp_tif, "w", **tif_profile) as dst:
+        for window, rgb in blocks:
+            dst.write(rgb, window=window)
+
+    if fp_tif != fp_dst:
+        try:
+            rasterio.shutil.copy(fp_tif, fp_dst, driver=driver)
+        finally:
+            os.remove(fp_tif)
+
+
+def _rgb_blocks(bands, width, height, lower=0, upper=255, ranges=None,
+                percentiles=None, block_size=512):
+    """
+    Generate the windows and normalized `uint8` data of blocks of bands, see
+    `save_rgb_tiled`
+
+    The data of each block is written to the same buffer, so that it is only
+    valid until the next block is generated.
+    """
+    import contextlib
+    import numpy
+
+    if ranges is None and percentiles is not None:
+        from geotoys.stats import band_stats
+
+        ranges = list()
+        with contextlib.ExitStack() as stack:
+            for b in bands:
+                stats = band_stats(_band_reader(b, stack), width, height, block_size)
+                ranges.append(stats.percentile(percentiles))
+    elif ranges is None:
+        ranges = [band_range(b, width, height, block_size) for b in bands]
+
+    # Scale and offset normalizing each band, in which the true color factor cancels
+    coefs = [stretch_coefficients(x0, x1, lower, upper) for x0, x1 in ranges]
+
+    rgb = numpy.empty((len(bands), block_size, block_size), dtype="uint8")
+    with contextlib.ExitStack() as stack:
+        readers = [_band_reader(b, stack) for b in bands]
+
+        for window in _block_windows(width, height, block_size):
+            h, w = window.height, window.width
+            for i, (read, (scale, offset)) in enumerate(zip(readers, coefs)):
+                to_uint8(read(window), scale, offset, lower, upper, out=rgb[i, :h, :w])
+            yield window, rgb[:, :h, :w]
+
+
+def _halve(x, resampling="average"):
+    """
+    Halve the height and width of an image of shape (bands, rows, columns), by
+    averaging or sampling 2x2 pixels, rounding odd sizes up
+    """
+    import numpy
+
+    if resampling == "nearest":
+        return x[:, ::2, ::2]
+
+    _, h, w = x.shape
+    x = numpy.pad(x, ((0, 0), (0, h % 2), (0, w % 2)), mode="edge")
+    x = x.reshape(x.shape[0], x.shape[1] // 2, 2, x.shape[2] // 2, 2)
+
+    return (x.mean(axis=(2, 4), dtype="float32") + 0.5).astype(x.dtype)
+
+
+def _overview_vrt(fp_vrt, fp_tif, fps_overviews, profile):
+    """
+    Write a VRT of the bands of an image with overviews read from other images,
+    so that they are used when the VRT is copied
+    """
+    import xml.etree.ElementTree as ET
+    from rasterio.crs import CRS
+
+    root = ET.Element(
+        "VRTDataset",
+        rasterXSize=str(profile["width"]),
+        rasterYSize=str(profile["height"]),
+        )
+    ET.SubElement(root, "SRS").text = CRS.from_user_input(profile["crs"]).to_wkt()
+    geotransform = profile["transform"].to_gdal()
+    ET.SubElement(root, "GeoTransform").text = ", ".join(map(repr, geotransform))
+
+    color_interps = ["Red", "Green", "Blue"] if profile["count"] == 3 else None
+    for i in range(1, profile["count"] + 1):
+        band = ET.SubElement(root, "VRTRasterBand", dataType="Byte", band=str(i))
+        if color_interps:
+            ET.SubElement(band, "ColorInterp").text = color_interps[i - 1]
+        for element, fp in [("SimpleSource", fp_tif)] + [
+            ("Overview", fp) for fp in fps_overviews
+        ]:
+            source = ET.SubElement(band, element)
+            ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = fp
+            ET.SubElement(source, "SourceBand").text = str(i)
+
+    ET.ElementTree(root).write(fp_vrt)
+
+
+def save_cog(bands, src_profile, fp_dst, block_size=512, compress="DEFLATE",
+             quality=None, resampling="average", **kwargs):
+    """
+    Save true color, normalized bands as an RGB Cloud-Optimized GeoTIFF
+
+    The image is streamed one block at a time, see `save_rgb_tiled`, to a
+    temporary tiled GeoTIFF. Each block is also halved into the overview levels
+    in the same pass, down to a single block, each written to its own temporary
+    GeoTIFF. Levels whose blocks would be smaller than a pixel are halved from
+    the previous level once it is complete. The image and its overviews are then
+    copied to a compressed, tiled GeoTIFF with the overviews stored internally
+    before the full resolution image, so that readers can read any block at any
+    zoom level with few requests.
+
+    The temporary images are written with fast DEFLATE compression. The GDAL COG
+    driver is used if available (GDAL >= 3.1), otherwise the GTiff driver with
+    `COPY_SRC_OVERVIEWS`.
+
+    Parameters
+    ==========
+    bands: list of str or callable
+        Paths of single band images, or functions returning the data of a band
+        for a `rasterio.windows.Window`
+    src_profile: dict
+        Image profile with the width, height, CRS and transform of the bands
+    fp_dst: str
+        Path of image to write
+    block_size: int
+        Size of the internal tiles of the image and its overviews, a multiple of 16
+    compress: str
+        Compression of tiles, e.g. `DEFLATE`, `LZW`, `JPEG`, `WEBP` or `NONE`
+    quality: int
+        Quality of lossy compression, 1-100
+    resampling: str
+        Resampling method of overviews, `average` or `nearest`
+    kwargs:
+        Keyword arguments of the normalization of bands, see `save_rgb_tiled`,
+        e.g. `ranges` or `percentiles`
+
+    Example
+    =======
+    >>> save_cog(["B04.jp2", "B03.jp2", "B02.jp2"], profile, "rgb.tif",
+    ...          compress="JPEG", quality=90, percentiles=(2, 98))
+    """
+    import contextlib
+    import os
+    import shutil
+    import tempfile
+    import rasterio
+    import rasterio.shutil
+    from rasterio.env import GDALVersion
+    from rasterio.windows import Window
+
+    if resampling not in ("average", "nearest"):
+        raise ValueError("`resampling` must be one of average nearest")
+
+    width, height = src_profile["width"], src_profile["height"]
+
+    # Halve the image until it fits in a single block
+    shapes = [(height, width)]
+    while max(shapes[-1]) > block_size:
+        shapes.append(tuple((n + 1) // 2 for n in shapes[-1]))
+
+    # Number of levels halved from each block, whose offsets stay whole pixels
+    n_streamed = 1
+    while n_streamed < len(shapes) and block_size % 2 ** n_streamed == 0:
+        n_streamed += 1
+
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "count": len(bands),
+        "tiled": True,
+        "blockxsize": block_size,
+        "blockysize": block_size,
+        "compress": "DEFLATE",
+        "zlevel": 1,
+        "predictor": 2,
+        "crs": src_profile["crs"],
+        }
+
+    def level_profile(shape):
+        scale = rasterio.Affine.scale(width / shape[1], height / shape[0])
+        return dict(
+            profile,
+            height=shape[0],
+            width=shape[1],
+            transform=src_profile["transform"] * scale,
+            )
+
+    path_tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(fp_dst)))
+    fps = [os.path.join(path_tmp, f"level_{i}.tif") for i in range(len(shapes))]
+    try:
+        blocks = _rgb_blocks(bands, width, height, block_size=block_size, **kwargs)
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(contextlib.closing(blocks))
+            dsts = [
+                stack.enter_context(rasterio.open(fp, "w", **level_profile(shape)))
+                for fp, shape in zip(fps[:n_streamed], shapes)
+                ]
+            for window, rgb in blocks:
+                dsts[0].write(rgb, window=window)
+                for level, dst in enumerate(dsts[1:], 1):
+                    rgb = _halve(rgb, resampling)
+                    dst.write(rgb, window=Window(
+                        window.col_off >> level,
+                        window.row_off >> level,
+                        rgb.shape[2],
+                        rgb.shape[1],
+                        ))
+
+        for level in range(n_streamed, len(shapes)):
+            with rasterio.open(fps[level - 1]) as src:
+                rgb = _halve(src.read(), resampling)
+            with rasterio.open(fps[level], "w", **level_profile(shapes[level])) as dst:
+                dst.write(rgb)
+
+        fp_vrt = os.path.join(path_tmp, "image.vrt")
+        vrt_profile = dict(src_profile, count=len(bands))
+        _overview_vrt(fp_vrt, fps[0], fps[1:], vrt_profile)
+
+        if GDALVersion.runtime().at_least("3.1"):
+            driver = "COG"
+            options = {"compress": compress, "blocksize": block_size}
+            if quality is not None:
+                options["quality"] = quality
+        else:
+            driver = "GTiff"
+            options = {
+                "compress": compress,
+                "tiled": True,
+                "blockxsize": block_size,
+                "blockysize": block_size,
+                "copy_src_overviews": True,
+                }
+            if quality is not None:
+                options["jpeg_quality"] = quality
 
-    return bands
+        rasterio.shutil.copy(fp_vrt, fp_dst, driver=driver, **options)
+    finally:
+        shutil.rmtree(path_tmp, ignore_errors=True)
 
 
 def save_jpeg_rgb(bands, src_profile, fp_dst, band_count=3, write_xml=False):
@@ -69,4 +652,4 @@ def save_jpeg_rgb(bands, src_profile, fp_dst, band_count=3, write_xml=False):
 
     # Write normalized RGB data to jpeg
     with rasterio.open(fp_dst, "w", **jpg_profile) as dst:
-        dst.write(bands.astype("uint8"))
+        dst.write(bands.astype("uint8", copy=False))
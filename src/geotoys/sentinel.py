@@ -8,6 +8,9 @@ This module contains a mini-wrapper for searching and downloading Sentinel data
 # download all results from the search
 >>> api.download_all(products)
 
+# download products concurrently, resuming partial downloads of a previous run
+>>> dl.download(products, "/data/sentinel")
+
 # GeoJSON FeatureCollection containing footprints and metadata of the scenes
 >>> api.to_geojson(products)
 
@@ -21,34 +24,386 @@ This module contains a mini-wrapper for searching and downloading Sentinel data
 # Get the product's full metadata available on the server
 >>> api.get_product_odata(<product_id>, full=True)
 """
+import os
+import re
+
 import geopandas
 from sentinelsat.sentinel import SentinelAPI, geojson_to_wkt
 from shapely.geometry import Polygon
 
-# TODO close connection
+API_URL = "https://scihub.copernicus.eu/dhus"
+
+# Sentinel-2 product names, e.g. `S2A_MSIL1C_20190101T104441_N0207_R008_T32VNM_...`
+PRODUCT_PATTERN = re.compile(
+    r"^(?P<mission>S2[AB])_(?P<level>MSI\w+?)_(?P<sensing>\d{8}T\d{6})"
+    r"_N(?P<baseline>\d{4})_R(?P<orbit>\d{3})_T(?P<tile>\w{5})"
+    r"_(?P<generated>\d{8}T\d{6})"
+    )
+
+QUERY_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "geotoys", "sentinel", "queries"
+    )
+
+_QUERY_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    key TEXT PRIMARY KEY,
+    params TEXT NOT NULL,
+    created REAL NOT NULL,
+    products TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queries_created ON queries (created);
+"""
+
+
 class SentinelDL(object):
+    """
+    Client searching and downloading Sentinel products from a Copernicus hub
+
+    A single HTTP session with a pool of connections is used for all requests,
+    which is closed with `close` or by using the client as a context manager.
+    Query results are cached on disk for `ttl` seconds, and queries within the
+    footprint, date range and cloud cover range of a cached query are answered
+    from the cache.
+
+    Example
+    =======
+    >>> with SentinelDL(user, password) as dl:
+    ...     for product_id, product in dl.iter_query_bb(bb, "20190101", "20190201"):
+    ...         print(product["title"])
+    """
+
+    def __init__(self, user, password, platform='Sentinel-2', api_url=API_URL,
+                 cache_dir=QUERY_CACHE_DIR, ttl=86400, page_size=100, pool_size=8):
+        import requests.adapters
+
+        self.api = SentinelAPI(user, password, api_url, show_progressbars=False)
+        self.api.page_size = page_size
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+            )
+        self.api.session.mount("http://", adapter)
+        self.api.session.mount("https://", adapter)
 
-    def __init__(self, user, password, platform='Sentinel-2'):
-        self.api = SentinelAPI(user, password, 'https://scihub.copernicus.eu/dhus')
         self.platform = platform
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.api.session.close()
 
     def query_bb(self, bb, ts0, ts1, ccrange=(0, 30)):
         """Search by polygon, time and cloud range
 
         return products
         """
+        import collections
+
+        return collections.OrderedDict(self.iter_query_bb(bb, ts0, ts1, ccrange))
+
+    def iter_query_bb(self, bb, ts0, ts1, ccrange=(0, 30)):
+        """
+        Search by bounding box, time and cloud range, yielding products page by page
+
+        Products are requested from the hub a page of `page_size` products at a
+        time, unless found in the query cache. The results are cached once all
+        pages have been read.
+
+        Parameters
+        ==========
+        bb: tuple of float
+            Bounding box in longitude and latitude (lon0, lat0, lon1, lat1)
+        ts0: str or datetime
+            Start of sensing date range, e.g. `20190101` or `NOW-7DAYS`
+        ts1: str or datetime
+            End of sensing date range
+        ccrange: tuple of float
+            Range of cloud cover percentage
+
+        Yields
+        ======
+        product_id: str
+            UUID of product
+        product: dict
+            Properties of product
+        """
         # search by polygon, time, and Hub query keywords
         if type(bb) is not tuple:
             raise TypeError("Bounding box must be a tuple of min/max values of Lon/Lat")
 
+        params = self._query_params(bb, ts0, ts1, ccrange)
+        cached = self._cached_query(params)
+        if cached is not None:
+            yield from cached
+            return
+
         footprint = geojson_to_wkt(SentinelDL.geojson_bb(*bb))
 
-        return self.api.query(
-                        footprint,
-                        date = (ts0, ts1),
-                        platformname = self.platform,
-                        cloudcoverpercentage = ccrange
-                        )
+        products = list()
+        offset = 0
+        while True:
+            page = self.api.query(
+                footprint,
+                date=(ts0, ts1),
+                platformname=self.platform,
+                cloudcoverpercentage=ccrange,
+                limit=self.api.page_size,
+                offset=offset,
+                )
+            for product in page.items():
+                products.append(product)
+                yield product
+            if len(page) < self.api.page_size:
+                break
+            offset += len(page)
+
+        self._cache_query(params, products)
+
+    def _query_params(self, bb, ts0, ts1, ccrange):
+        """
+        Get the parameters of a query identifying it in the cache
+        """
+        from sentinelsat import format_query_date
+
+        return {
+            "api_url": self.api.api_url,
+            "platform": self.platform,
+            "bb": [float(v) for v in bb],
+            "date": [format_query_date(ts0), format_query_date(ts1)],
+            "ccrange": [float(v) for v in ccrange],
+            }
+
+    def _cached_query(self, params):
+        """
+        Get the products of a query from the cache, or `None` if not cached
+
+        Products are filtered from a cached query with the same platform whose
+        bounding box, date range and cloud cover range contain those of the query.
+        Queries cached more than `ttl` seconds ago are deleted.
+        """
+        import contextlib
+        import json
+        import sqlite3
+        import time
+
+        fp_cache = self._query_cache_path()
+        if fp_cache is None or not os.path.exists(fp_cache):
+            return None
+
+        key = _query_key(params)
+        with contextlib.closing(sqlite3.connect(fp_cache)) as conn:
+            conn.executescript(_QUERY_CACHE_SCHEMA)
+            with conn:
+                conn.execute(
+                    "DELETE FROM queries WHERE created < ?", (time.time() - self.ttl,)
+                    )
+            rows = conn.execute(
+                "SELECT key, params FROM queries ORDER BY key = ? DESC", (key,)
+                ).fetchall()
+            for cached_key, cached_params in rows:
+                cached_params = json.loads(cached_params)
+                exact = cached_params == params
+                if not exact and not _contains_query(cached_params, params):
+                    continue
+                products, = conn.execute(
+                    "SELECT products FROM queries WHERE key = ?", (cached_key,)
+                    ).fetchone()
+                products = _loads_products(products)
+                if exact:
+                    return products
+                return [
+                    (product_id, product) for product_id, product in products
+                    if _matches_query(product, params)
+                    ]
+
+        return None
+
+    def _cache_query(self, params, products):
+        """
+        Write the products of a query to the cache
+        """
+        import contextlib
+        import json
+        import sqlite3
+        import time
+
+        fp_cache = self._query_cache_path()
+        if fp_cache is None:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with contextlib.closing(sqlite3.connect(fp_cache)) as conn:
+            conn.executescript(_QUERY_CACHE_SCHEMA)
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)",
+                    (
+                        _query_key(params), json.dumps(params, sort_keys=True),
+                        time.time(), _dumps_products(products),
+                        ),
+                    )
+
+    def _query_cache_path(self):
+        """
+        Get the path of the query cache database, or `None` if not caching
+        """
+        if not self.cache_dir:
+            return None
+
+        return os.path.join(self.cache_dir, "queries.sqlite")
+
+    def select_bb(self, bb, ts0, ts1, ccrange=(0, 30), min_gain=0.001):
+        """
+        Search by bounding box, time and cloud range, selecting the products to
+        cover the bounding box, see `select_products`
+        """
+        products = self.query_bb(bb, ts0, ts1, ccrange)
+
+        return select_products(products, bb, min_gain=min_gain)
+
+    def download(self, product_ids, path_output, n_workers=4, fp_state=None,
+                 chunk_size=2 ** 20):
+        """
+        Download products concurrently, resuming partial downloads
+
+        Products are downloaded to `{title}.zip.incomplete` files, which are
+        renamed once their MD5 checksum, computed while writing, matches that of
+        the hub. Partial files of a previous run are resumed with HTTP range
+        requests, hashing the part already written once.
+
+        The queue of products and the status of each are persisted to a JSON
+        state file, so that a run that is interrupted can be resumed by passing
+        no new products. Products that failed are retried.
+
+        Parameters
+        ==========
+        product_ids: list of str
+            UUIDs of products to download, e.g. keys of `query_bb` results
+        path_output: str
+            Path to directory to download products to
+        n_workers: int
+            Number of products downloaded concurrently, at most the `pool_size`
+            of the client
+        fp_state: str
+            Path of the state file, by default `.downloads.json` in `path_output`
+        chunk_size: int
+            Size in bytes of chunks of data written
+
+        Returns
+        =======
+        state: dict
+            State of each product by UUID, with its `status` of `done`, `failed`
+            or `offline`, `path` and `error`
+        """
+        import concurrent.futures
+        import threading
+
+        os.makedirs(path_output, exist_ok=True)
+        if fp_state is None:
+            fp_state = os.path.join(path_output, ".downloads.json")
+
+        state = _load_state(fp_state)
+        for product_id in product_ids or list():
+            state.setdefault(product_id, {"status": "queued"})
+
+        queue = [
+            product_id for product_id, product in state.items()
+            if product["status"] != "done" or not os.path.exists(product["path"])
+            ]
+        for product_id in queue:
+            state[product_id]["status"] = "queued"
+        _save_state(fp_state, state)
+
+        lock = threading.Lock()
+
+        def update(product_id, **values):
+            with lock:
+                state[product_id].update(values)
+                _save_state(fp_state, state)
+
+        def download(product_id):
+            try:
+                self._download_product(
+                    product_id, path_output, state[product_id], update, chunk_size
+                    )
+            except Exception as e:
+                update(product_id, status="failed", error=repr(e))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(download, queue))
+
+        return state
+
+    def _download_product(self, product_id, path_output, product, update,
+                          chunk_size):
+        """
+        Download a product, resuming a partial download and verifying its MD5
+
+        The metadata of the product, including whether it is online, is requested
+        unless a partial download is resumed, as archived products may go offline
+        between runs.
+        """
+        import hashlib
+
+        resuming = "path" in product and os.path.exists(f"{product['path']}.incomplete")
+        if not resuming:
+            url = f"{self.api.api_url}odata/v1/Products('{product_id}')"
+            response = self.api.session.get(url, params={"$format": "json"})
+            response.raise_for_status()
+            d = response.json()["d"]
+            update(
+                product_id,
+                title=d["Name"],
+                size=int(d["ContentLength"]),
+                md5=d["Checksum"]["Value"].lower(),
+                url=d["__metadata"]["media_src"],
+                path=os.path.join(path_output, f"{d['Name']}.zip"),
+                )
+            if not d.get("Online", True):
+                update(product_id, status="offline", error="Product is offline")
+                return
+
+        fp = product["path"]
+        fp_partial = f"{fp}.incomplete"
+        update(product_id, status="downloading")
+
+        # Hash the part already downloaded
+        md5 = hashlib.md5()
+        offset = 0
+        if os.path.exists(fp_partial) and os.path.getsize(fp_partial) > product["size"]:
+            os.remove(fp_partial)
+        if os.path.exists(fp_partial):
+            with open(fp_partial, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    md5.update(chunk)
+                    offset += len(chunk)
+
+        if offset < product["size"]:
+            headers = {"Range": f"bytes={offset}-"} if offset else dict()
+            with self.api.session.get(product["url"], headers=headers,
+                                      stream=True) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # Range not supported, start over
+                    md5 = hashlib.md5()
+                    offset = 0
+                with open(fp_partial, "ab" if offset else "wb") as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                        md5.update(chunk)
+
+        if md5.hexdigest() != product["md5"]:
+            os.remove(fp_partial)
+            update(product_id, status="failed", error="MD5 checksum mismatch")
+            return
+
+        os.replace(fp_partial, fp)
+        update(product_id, status="done", error=None)
 
     @staticmethod
     def geojson_bb(lon0, lat0, lon1, lat1):
@@ -59,8 +414,264 @@ class SentinelDL(object):
             (lon0, lat0),
             (lon1, lat0),
             (lon1, lat1),
-            (lon1, lat0),
+            (lon0, lat1),
             (lon0, lat0)
             ])
 
         return geopandas.GeoSeries([poly]).__geo_interface__
+
+
+def deduplicate(products):
+    """
+    Remove reprocessed duplicates of products, keeping the latest processing
+
+    Products with the same mission, level, sensing time, relative orbit and tile
+    in their names are duplicates, of which the product of the highest processing
+    baseline and latest generation time is kept.
+
+    Parameters
+    ==========
+    products: dict
+        Properties of products by UUID, as returned by `SentinelDL.query_bb`
+
+    Returns
+    =======
+    products: collections.OrderedDict
+        Products without duplicates, in their original order
+    """
+    import collections
+
+    latest = dict()
+    for product_id, product in products.items():
+        match = PRODUCT_PATTERN.match(product.get("title", ""))
+        if not match:
+            latest[product_id] = (product_id, None)
+            continue
+        key = tuple(match[k] for k in ("mission", "level", "sensing", "orbit", "tile"))
+        version = (match["baseline"], match["generated"])
+        if key not in latest or latest[key][1] < version:
+            latest[key] = (product_id, version)
+
+    keep = {product_id for product_id, _ in latest.values()}
+
+    return collections.OrderedDict(
+        (product_id, product) for product_id, product in products.items()
+        if product_id in keep
+        )
+
+
+def select_products(products, bb, min_gain=0.001):
+    """
+    Select a small set of products covering a bounding box
+
+    Reprocessed duplicates are removed, see `deduplicate`, and the footprints of
+    the remaining products indexed in an STRtree. Products are then chosen
+    greedily by the clear area they add to the coverage of the bounding box, the
+    area of the bounding box they newly cover less their cloud cover percentage,
+    preferring the most recent of equal products, until no product adds more than
+    `min_gain` of the area of the bounding box.
+
+    Parameters
+    ==========
+    products: dict
+        Properties of products by UUID, as returned by `SentinelDL.query_bb`,
+        with `footprint` WKT in longitude and latitude
+    bb: tuple of float
+        Bounding box in longitude and latitude (lon0, lat0, lon1, lat1)
+    min_gain: float
+        Fraction of the bounding box a product must newly cover to be selected
+
+    Returns
+    =======
+    selected: collections.OrderedDict
+        Selected products in order of selection
+
+    Example
+    =======
+    >>> products = dl.query_bb(bb, "20190101", "20190201")
+    >>> dl.download(select_products(products, bb), "/data/sentinel")
+    """
+    import collections
+    import datetime
+
+    from shapely import wkt
+    from shapely.geometry import shape
+    from shapely.strtree import STRtree
+
+    aoi = shape(SentinelDL.geojson_bb(*bb)["features"][0]["geometry"])
+    products = deduplicate(products)
+
+    ids = [p for p in products if products[p].get("footprint")]
+    footprints = [wkt.loads(products[p]["footprint"]) for p in ids]
+    tree = STRtree(footprints)
+    index = {id(footprint): i for i, footprint in enumerate(footprints)}
+
+    def intersecting(geometry):
+        # Shapely 1 returns the geometries of bounding boxes intersecting, Shapely
+        # 2 their indices
+        found = [
+            index[id(item)] if hasattr(item, "geom_type") else int(item)
+            for item in tree.query(geometry)
+            ]
+        return [i for i in found if footprints[i].intersects(geometry)]
+
+    def priority(i):
+        product = products[ids[i]]
+        clear = 1 - product.get("cloudcoverpercentage", 0) / 100
+        sensed = product.get("beginposition") or datetime.datetime.min
+        return clear, sensed
+
+    selected = collections.OrderedDict()
+    remaining = aoi
+    candidates = set(intersecting(aoi))
+    while candidates and not remaining.is_empty:
+        gains = dict()
+        for i in intersecting(remaining):
+            if i in candidates:
+                clear, sensed = priority(i)
+                area = footprints[i].intersection(remaining).area / aoi.area
+                gains[i] = (round(area * clear, 9), sensed, area)
+
+        best = max(gains, key=gains.get, default=None)
+        if best is None or gains[best][2] < min_gain:
+            break
+
+        selected[ids[best]] = products[ids[best]]
+        remaining = remaining.difference(footprints[best])
+        candidates.discard(best)
+
+    return selected
+
+
+def _load_state(fp_state):
+    """
+    Load the state of downloads, or an empty state if not found
+    """
+    import json
+
+    if not os.path.exists(fp_state):
+        return dict()
+
+    with open(fp_state) as f:
+        return json.load(f)
+
+
+def _save_state(fp_state, state):
+    """
+    Write the state of downloads atomically
+    """
+    import json
+
+    with open(f"{fp_state}.tmp", "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(f"{fp_state}.tmp", fp_state)
+
+
+def _contains_query(outer, inner):
+    """
+    Check whether the results of a query contain those of another query
+    """
+    if any(outer[k] != inner[k] for k in ("api_url", "platform")):
+        return False
+
+    # Relative dates, e.g. `NOW-1DAY`, can not be compared
+    dates = outer["date"] + inner["date"]
+    if any(d.startswith("NOW") for d in dates):
+        return False
+
+    o_lon0, o_lat0, o_lon1, o_lat1 = outer["bb"]
+    lon0, lat0, lon1, lat1 = inner["bb"]
+    (o_cc0, o_cc1), (cc0, cc1) = outer["ccrange"], inner["ccrange"]
+
+    return (
+        o_lon0 <= lon0 and lon1 <= o_lon1 and o_lat0 <= lat0 and lat1 <= o_lat1
+        and o_cc0 <= cc0 and cc1 <= o_cc1
+        and _date_range_contains(outer["date"], inner["date"])
+        )
+
+
+def _date_range_contains(outer, inner):
+    """
+    Check whether a query date range contains another, where `*` is unbounded
+    """
+    from geotoys.datetime import utc_timestamp
+
+    (o_ts0, o_ts1), (ts0, ts1) = outer, inner
+    start = o_ts0 == "*" or ts0 != "*" and utc_timestamp(o_ts0) <= utc_timestamp(ts0)
+    end = o_ts1 == "*" or ts1 != "*" and utc_timestamp(ts1) <= utc_timestamp(o_ts1)
+
+    return start and end
+
+
+def _matches_query(product, params):
+    """
+    Check whether a product matches the footprint, date and cloud cover of a query
+    """
+    from shapely import wkt
+    from shapely.geometry import box
+
+    from geotoys.datetime import utc_timestamp
+
+    cc0, cc1 = params["ccrange"]
+    cloud_cover = product.get("cloudcoverpercentage")
+    if cloud_cover is not None and not cc0 <= cloud_cover <= cc1:
+        return False
+
+    sensed = product.get("beginposition")
+    if sensed is not None:
+        ts0, ts1 = params["date"]
+        if ts0 != "*" and utc_timestamp(sensed) < utc_timestamp(ts0):
+            return False
+        if ts1 != "*" and utc_timestamp(sensed) > utc_timestamp(ts1):
+            return False
+
+    footprint = product.get("footprint")
+    if footprint is not None:
+        return wkt.loads(footprint).intersects(box(*params["bb"]))
+
+    return True
+
+
+def _query_key(params):
+    """
+    Get the key of query parameters in the cache
+    """
+    import hashlib
+    import json
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def _dumps_products(products):
+    """
+    Serialize `(product_id, product)` pairs to JSON, with datetimes tagged
+    """
+    import datetime
+    import json
+
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            return {"__datetime__": value.isoformat()}
+        raise TypeError(f"Cannot serialize {type(value).__name__} to JSON")
+
+    return json.dumps(products, default=default)
+
+
+def _loads_products(s):
+    """
+    Deserialize `(product_id, product)` pairs from `_dumps_products`
+    """
+    import collections
+    import json
+
+    import pandas
+
+    def object_pairs_hook(pairs):
+        if len(pairs) == 1 and pairs[0][0] == "__datetime__":
+            return pandas.Timestamp(pairs[0][1]).to_pydatetime()
+        return collections.OrderedDict(pairs)
+
+    return [
+        (product_id, product)
+        for product_id, product in json.loads(s, object_pairs_hook=object_pairs_hook)
+        ]
@@ -0,0 +1,362 @@
+"""
+Module for computing statistics of rasters in a single streaming pass over blocks
+"""
+import os
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "geotoys", "stats")
+
+# Magnitude of the smallest values distinguished from zero in histograms
+MIN_MAGNITUDE = 1e-9
+
+
+class BandStats(object):
+    """
+    Streaming statistics of the values of a band
+
+    The count, minimum, maximum, mean and variance are exact. Percentiles are
+    approximated from a histogram with logarithmically spaced bins, so that they
+    are within a relative `accuracy` of the exact value however far outliers
+    extend the range of the band. When values span more than `n_bins` bins, the
+    bins of the values closest to zero are merged into a bin at zero. Statistics
+    of blocks, bands or files can be combined with `merge`.
+
+    Example
+    =======
+    >>> stats = BandStats()
+    >>> for block in blocks:
+    ...     stats.update(block, nodata=0)
+    >>> p2, p98 = stats.percentile([2, 98])
+    """
+
+    def __init__(self, n_bins=4096, accuracy=0.005):
+        import numpy
+
+        self.n_bins = n_bins
+        self.accuracy = accuracy
+        self.count = 0
+        self.min = numpy.inf
+        self.max = -numpy.inf
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.hist_keys = numpy.zeros(0, dtype="int64")
+        self.hist = numpy.zeros(0, dtype="int64")
+
+    @property
+    def var(self):
+        return self.m2 / self.count if self.count else float("nan")
+
+    @property
+    def std(self):
+        return self.var ** 0.5
+
+    @property
+    def _log_gamma(self):
+        import math
+
+        return math.log((1 + self.accuracy) / (1 - self.accuracy))
+
+    def update(self, data, nodata=None):
+        """
+        Add the values of an array, ignoring nodata and NaN values
+        """
+        import numpy
+
+        data = numpy.asarray(data).ravel()
+        valid = ~numpy.isnan(data) if data.dtype.kind == "f" else True
+        if nodata is not None:
+            valid = valid & (data != nodata)
+        if valid is not True:
+            data = data[valid]
+        if data.size == 0:
+            return self
+
+        block = BandStats(self.n_bins, self.accuracy)
+        block.count = data.size
+        block.min = data.min().item()
+        block.max = data.max().item()
+        block.mean = data.mean(dtype="float64").item()
+        block.m2 = ((data - block.mean) ** 2).sum().item()
+
+        # Count values by bin key, offset to be counted with bincount
+        keys = block._keys(data)
+        k0 = keys.min()
+        counts = numpy.bincount(keys - k0)
+        block.hist_keys = numpy.flatnonzero(counts) + k0
+        block.hist = counts[counts > 0].astype("int64")
+
+        return self.merge(block)
+
+    def merge(self, other):
+        """
+        Combine the statistics of another `BandStats` into these
+        """
+        import numpy
+
+        if other.accuracy != self.accuracy:
+            raise ValueError("Can not merge statistics of different accuracies")
+        if not other.count:
+            return self
+        if not self.count:
+            n_bins = self.n_bins
+            self.__dict__.update(other.__dict__)
+            self.n_bins = n_bins
+            self.hist_keys = other.hist_keys.copy()
+            self.hist = other.hist.copy()
+            self._collapse()
+            return self
+
+        # Combine means and variances (Chan et al.)
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+
+        # Add counts of bins with the same key
+        keys, ix = numpy.unique(
+            numpy.concatenate([self.hist_keys, other.hist_keys]), return_inverse=True
+            )
+        counts = numpy.bincount(
+            ix.ravel(), weights=numpy.concatenate([self.hist, other.hist])
+            )
+        self.hist_keys, self.hist = keys, counts.astype("int64")
+        self._collapse()
+
+        return self
+
+    def _keys(self, values):
+        """
+        Get the histogram bin keys of values
+
+        Keys increase with the values, a key `k` > 0 holding values in
+        (`gamma ** (k - 1)`, `gamma ** k`] times `MIN_MAGNITUDE`, negative keys
+        holding negative values likewise and key 0 values of a smaller magnitude.
+        """
+        import numpy
+
+        magnitude = numpy.abs(values.astype("float64"))
+        significant = magnitude > MIN_MAGNITUDE
+        with numpy.errstate(divide="ignore"):
+            keys = numpy.ceil(
+                numpy.log(magnitude / MIN_MAGNITUDE) / self._log_gamma
+                )
+        keys = numpy.where(significant, keys, 0).astype("int64")
+
+        return numpy.where(values < 0, -keys, keys)
+
+    def _values(self, keys):
+        """
+        Get the value represented by histogram bin keys, within a relative
+        `accuracy` of the values in the bins
+        """
+        import numpy
+
+        gamma = numpy.exp(self._log_gamma)
+        magnitude = MIN_MAGNITUDE * 2 * gamma ** numpy.abs(keys) / (gamma + 1)
+
+        return numpy.where(keys == 0, 0.0, numpy.sign(keys) * magnitude)
+
+    def _collapse(self):
+        """
+        Merge the bins closest to zero into the bin at zero to keep at most
+        `n_bins` bins
+        """
+        import numpy
+
+        if len(self.hist_keys) <= self.n_bins:
+            return
+
+        order = numpy.argsort(numpy.abs(self.hist_keys), kind="stable")
+        fold = numpy.zeros(len(order), dtype=bool)
+        fold[order[:len(order) - self.n_bins + 1]] = True
+        fold |= self.hist_keys == 0
+
+        keys = numpy.append(self.hist_keys[~fold], 0)
+        counts = numpy.append(self.hist[~fold], self.hist[fold].sum())
+        order = numpy.argsort(keys)
+        self.hist_keys, self.hist = keys[order], counts[order]
+
+    def percentile(self, q):
+        """
+        Approximate percentile(s) `q` (0-100) from the histogram
+        """
+        import numpy
+
+        if not self.count:
+            return numpy.full(numpy.shape(q), numpy.nan)
+
+        # Find the bin of the value at the rank of each percentile
+        cdf = numpy.cumsum(self.hist)
+        rank = numpy.asarray(q, dtype=float) / 100 * (self.count - 1)
+        ix = numpy.searchsorted(cdf, numpy.floor(rank), side="right")
+        values = self._values(self.hist_keys[numpy.minimum(ix, len(cdf) - 1)])
+
+        return numpy.clip(values, self.min, self.max)
+
+    def to_dict(self):
+        """
+        Get the statistics as a JSON serializable dictionary
+        """
+        return {
+            "n_bins": self.n_bins,
+            "accuracy": self.accuracy,
+            "count": self.count,
+            "min": float(self.min),
+            "max": float(self.max),
+            "mean": self.mean,
+            "m2": self.m2,
+            "hist_keys": self.hist_keys.tolist(),
+            "hist": self.hist.tolist(),
+            }
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Create statistics from a dictionary produced by `to_dict`
+        """
+        import numpy
+
+        stats = cls(d["n_bins"], d["accuracy"])
+        stats.__dict__.update(d)
+        stats.hist_keys = numpy.asarray(d["hist_keys"], dtype="int64")
+        stats.hist = numpy.asarray(d["hist"], dtype="int64")
+
+        return stats
+
+
+def band_stats(read, width, height, block_size=1024, nodata=None, n_bins=4096):
+    """
+    Compute statistics of a band, reading it one block at a time
+
+    Parameters
+    ==========
+    read: callable
+        Function returning the data of the band for a `rasterio.windows.Window`
+    width: int
+        Width of the band
+    height: int
+        Height of the band
+    block_size: int
+        Size of blocks read
+    nodata: float
+        Value of the band to ignore
+    n_bins: int
+        Number of histogram bins
+
+    Returns
+    =======
+    stats: BandStats
+        Statistics of the band
+    """
+    from geotoys.process import _block_windows
+
+    stats = BandStats(n_bins)
+    for window in _block_windows(width, height, block_size):
+        stats.update(read(window), nodata=nodata)
+
+    return stats
+
+
+def file_stats(fp, bands=None, decimation=None, cache_dir=CACHE_DIR, n_bins=4096):
+    """
+    Compute statistics of the bands of a raster file, caching them per file and band
+
+    Each band is read one block at a time. Cached statistics are used until the
+    file is modified.
+
+    Parameters
+    ==========
+    fp: str
+        Path of raster file
+    bands: list of int
+        Indexes of bands to compute statistics for, starting at 1. Defaults to all.
+    decimation: int
+        Factor to reduce the band by when reading, to approximate the statistics
+        from an overview
+    cache_dir: str
+        Directory of the cache, `None` to not use a cache
+    n_bins: int
+        Number of histogram bins
+
+    Returns
+    =======
+    stats: dict of BandStats
+        Statistics of each band index
+    """
+    import hashlib
+    import json
+    import tempfile
+    import rasterio
+
+    fp = os.path.abspath(fp)
+    stat = os.stat(fp)
+    key = {"mtime": stat.st_mtime, "size": stat.st_size, "decimation": decimation}
+
+    # Load cached statistics if the file is unchanged
+    cached = dict()
+    if cache_dir:
+        name = hashlib.sha1(f"{fp}:{decimation}".encode()).hexdigest()
+        fp_cache = os.path.join(cache_dir, f"{name}.json")
+        cached = _read_cache(fp_cache, key)
+
+    stats = dict()
+    with rasterio.open(fp) as src:
+        if bands is None:
+            bands = src.indexes
+        for i in bands:
+            if i in cached and cached[i].n_bins == n_bins:
+                stats[i] = cached[i]
+                continue
+
+            scale = decimation or 1
+            height = max(1, round(src.height / scale))
+            width = max(1, round(src.width / scale))
+
+            def read(window, i=i):
+                from rasterio.windows import Window
+
+                src_window = Window(
+                    window.col_off * scale,
+                    window.row_off * scale,
+                    min(window.width * scale, src.width - window.col_off * scale),
+                    min(window.height * scale, src.height - window.row_off * scale),
+                    )
+                out_shape = (window.height, window.width)
+                return src.read(i, window=src_window, out_shape=out_shape)
+
+            stats[i] = band_stats(read, width, height, nodata=src.nodata, n_bins=n_bins)
+
+    # Write the cache to a temporary file replacing it once complete, so that an
+    # interrupted or concurrent write does not leave a truncated cache
+    if cache_dir:
+        cached.update(stats)
+        os.makedirs(cache_dir, exist_ok=True)
+        bands = {i: s.to_dict() for i, s in cached.items()}
+        fd, fp_tmp = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"path": fp, "key": key, "bands": bands}, f)
+            os.replace(fp_tmp, fp_cache)
+        except BaseException:
+            os.remove(fp_tmp)
+            raise
+
+    return stats
+
+
+def _read_cache(fp_cache, key):
+    """
+    Read cached statistics of each band if the cache matches `key`, otherwise an
+    empty dictionary, also if the cache is missing or can not be read
+    """
+    import json
+
+    try:
+        with open(fp_cache) as f:
+            cache = json.load(f)
+        if cache["key"] != key:
+            return dict()
+        return {int(i): BandStats.from_dict(d) for i, d in cache["bands"].items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        return dict()
@@ -2,31 +2,123 @@
 Module containing methods for working with system environment and objects, e.g. files
 """
 
-def list_ext(path, ext):
+def scan(path, exts=None, suffix=None, include=None, exclude=None, n_threads=8):
     """
-    Recursively list all files under path with given extension
+    Concurrently walk a directory tree, yielding paths as they are found
+
+    Directories are listed with `os.scandir` in a thread pool, fanning out over
+    subdirectories, so that listing is not bound by the latency of each stat on
+    network filesystems. Paths are yielded in no particular order. Symbolic links
+    to directories are followed, but each directory is descended into only once,
+    so that links to a parent directory do not loop.
+
+    Parameters
+    ==========
+    path: str
+        Path to directory to recursively search
+    exts: str or list of str
+        Extensions of files to yield
+    suffix: str or list of str
+        Suffixes of directories to yield. Matching directories are not descended
+        into, e.g. `.SAFE` product directories.
+    include: str or list of str
+        Glob patterns that the names of files or directories yielded must match
+    exclude: str or list of str
+        Glob patterns of names of files or directories to skip. Excluded
+        directories are not descended into.
+    n_threads: int
+        Number of threads listing directories concurrently
+
+    Yields
+    ======
+    path: str
+        Path of file with one of the extensions or directory with one of the
+        suffixes
     """
-    from glob import glob
+    import concurrent.futures
+    from fnmatch import fnmatch
     import os
 
-    if not ext.startswith('.'):
-        ext = f".{ext}"
+    exts = tuple(e if e.startswith(".") else f".{e}" for e in _as_tuple(exts))
+    suffixes = _as_tuple(suffix)
+    include = _as_tuple(include)
+    exclude = _as_tuple(exclude)
+
+    def matches(name):
+        if include and not any(fnmatch(name, p) for p in include):
+            return False
+        return not any(fnmatch(name, p) for p in exclude)
+
+    def list_dir(p):
+        """
+        List a directory, returning matching paths and subdirectories to descend
+        with their device and inode numbers
+        """
+        found, subdirs = list(), list()
+        try:
+            entries = list(os.scandir(p))
+        except (PermissionError, FileNotFoundError):
+            return found, subdirs
 
-    return sorted(glob(os.path.join(path, f"**/*{ext}"), recursive=True))
+        for entry in entries:
+            if entry.is_dir():
+                if exclude and any(fnmatch(entry.name, p) for p in exclude):
+                    continue
+                if suffixes and entry.name.endswith(suffixes):
+                    if matches(entry.name):
+                        found.append(entry.path)
+                else:
+                    try:
+                        stat = os.stat(entry.path)
+                    except (PermissionError, FileNotFoundError):
+                        continue
+                    subdirs.append((entry.path, (stat.st_dev, stat.st_ino)))
+            elif exts and entry.name.endswith(exts) and matches(entry.name):
+                found.append(entry.path)
 
+        return found, subdirs
 
-def list_dirs(path, suffix):
+    stat = os.stat(path)
+    visited = {(stat.st_dev, stat.st_ino)}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = {executor.submit(list_dir, path)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                found, subdirs = future.result()
+                for p, key in subdirs:
+                    if key not in visited:
+                        visited.add(key)
+                        pending.add(executor.submit(list_dir, p))
+                yield from found
+
+
+def _as_tuple(x):
     """
-    Recursively list all dirs under path with given suffix
+    Cast `None`, a single string or a list of strings to a tuple
     """
-    import os
+    if x is None:
+        return tuple()
+    if isinstance(x, str):
+        return (x,)
+    return tuple(x)
+
 
-    dirs = list()
-    for p in os.listdir(path):
-        p = os.path.join(path, p)
-        if os.path.isdir(p):
-            if p.endswith(suffix):
-                dirs.append(p)
-            else:
-                dirs += list_dirs(p, suffix)
-    return dirs
+def list_ext(path, ext, **kwargs):
+    """
+    Recursively list all files under path with given extension(s)
+
+    Keyword arguments are passed to `scan`.
+    """
+    return sorted(scan(path, exts=ext, **kwargs))
+
+
+def list_dirs(path, suffix, **kwargs):
+    """
+    Recursively list all dirs under path with given suffix
+
+    Keyword arguments are passed to `scan`.
+    """
+    return sorted(scan(path, suffix=suffix, **kwargs))
@@ -0,0 +1,319 @@
+"""
+Module for cutting RGB composites into XYZ web map tiles in Web Mercator
+"""
+import math
+
+# Half the width of the Web Mercator (EPSG:3857) extent in metres
+ORIGIN = 20037508.342789244
+
+# Latitude of the northern and southern edges of the Web Mercator extent
+MAX_LAT = 85.0511287798066
+
+TILE_DRIVERS = {"png": "PNG", "jpg": "JPEG", "webp": "WEBP"}
+
+
+def tile_bounds(x, y, z):
+    """
+    Get the bounds (left, bottom, right, top) of a tile in Web Mercator metres
+    """
+    size = 2 * ORIGIN / 2 ** z
+    left = -ORIGIN + x * size
+    top = ORIGIN - y * size
+
+    return left, top - size, left + size, top
+
+
+def tile_range(bounds, z):
+    """
+    Get the range of tile columns and rows intersecting bounds at a zoom level
+
+    Parameters
+    ==========
+    bounds: tuple of float
+        Bounds (left, bottom, right, top) in Web Mercator metres
+    z: int
+        Zoom level
+
+    Returns
+    =======
+    xs: range
+        Columns of tiles
+    ys: range
+        Rows of tiles
+    """
+    left, bottom, right, top = bounds
+    size = 2 * ORIGIN / 2 ** z
+    n = 2 ** z
+
+    def clip(i):
+        return min(max(i, 0), n - 1)
+
+    x0 = clip(math.floor((left + ORIGIN) / size))
+    x1 = clip(math.ceil((right + ORIGIN) / size) - 1)
+    y0 = clip(math.floor((ORIGIN - top) / size))
+    y1 = clip(math.ceil((ORIGIN - bottom) / size) - 1)
+
+    return range(x0, x1 + 1), range(y0, y1 + 1)
+
+
+def tiles(bounds, zooms):
+    """
+    Get the tiles intersecting bounds in longitude and latitude over zoom levels
+
+    Parameters
+    ==========
+    bounds: tuple of float
+        Bounding box in longitude and latitude (lon0, lat0, lon1, lat1)
+    zooms: list of int
+        Zoom levels
+
+    Returns
+    =======
+    tiles: list of tuple
+        Zoom level, column and row (z, x, y) of each tile
+    """
+    from rasterio.warp import transform_bounds
+
+    lon0, lat0, lon1, lat1 = bounds
+    lat0, lat1 = max(lat0, -MAX_LAT), min(lat1, MAX_LAT)
+    bounds = transform_bounds("EPSG:4326", "EPSG:3857", lon0, lat0, lon1, lat1)
+
+    result = list()
+    for z in zooms:
+        xs, ys = tile_range(bounds, z)
+        result += [(z, x, y) for x in xs for y in ys]
+
+    return result
+
+
+def lonlat_bounds(fp):
+    """
+    Get the bounds of a raster file in longitude and latitude
+    """
+    import rasterio
+    from rasterio.warp import transform_bounds
+
+    with rasterio.open(fp) as src:
+        return transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+
+
+def _mercator_bounds(fp):
+    """
+    Get the bounds of a raster file in Web Mercator metres
+    """
+    import rasterio
+    from rasterio.warp import transform_bounds
+
+    with rasterio.open(fp) as src:
+        return transform_bounds(src.crs, "EPSG:3857", *src.bounds)
+
+
+def _intersects(a, b):
+    """
+    Check whether bounds (left, bottom, right, top) overlap
+    """
+    return a[0] < b[2] and a[2] > b[0] and a[1] < b[3] and a[3] > b[1]
+
+
+def _render_tiles(sources, path_output, tile_list, tile_size, resampling, fmt):
+    """
+    Render tiles from sources, returning the tiles written
+
+    Sources are given as their path and bounds in Web Mercator, and are only
+    opened once a tile intersects them. Each source is warped to the grid of each
+    tile it intersects and drawn over the previous sources where it has valid
+    data. Tiles without valid data are not written.
+    """
+    import contextlib
+    import os
+    import numpy
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_bounds
+    from rasterio.vrt import WarpedVRT
+
+    written = list()
+    rgb = numpy.empty((3, tile_size, tile_size), dtype="uint8")
+    alpha = numpy.empty((tile_size, tile_size), dtype="uint8")
+
+    with contextlib.ExitStack() as stack:
+        srcs = dict()
+
+        for z, x, y in tile_list:
+            bounds = tile_bounds(x, y, z)
+            rgb[:] = 0
+            alpha[:] = 0
+
+            for fp, src_bounds in sources:
+                if not _intersects(src_bounds, bounds):
+                    continue
+                if fp not in srcs:
+                    srcs[fp] = stack.enter_context(rasterio.open(fp))
+                src = srcs[fp]
+
+                with WarpedVRT(
+                    src,
+                    crs="EPSG:3857",
+                    transform=from_bounds(*bounds, tile_size, tile_size),
+                    width=tile_size,
+                    height=tile_size,
+                    resampling=Resampling[resampling],
+                    add_alpha=src.count == 3 and src.nodata is None,
+                    ) as vrt:
+                    mask = vrt.dataset_mask() > 0
+                    if not mask.any():
+                        continue
+                    data = vrt.read(indexes=[1, 2, 3])
+
+                rgb[:, mask] = data[:, mask]
+                alpha[mask] = 255
+
+            if not alpha.any():
+                continue
+
+            fp_tile = os.path.join(path_output, str(z), str(x), f"{y}.{fmt}")
+            os.makedirs(os.path.dirname(fp_tile), exist_ok=True)
+
+            profile = {
+                "driver": TILE_DRIVERS[fmt],
+                "dtype": "uint8",
+                "width": tile_size,
+                "height": tile_size,
+                "count": 4 if fmt != "jpg" else 3,
+                }
+            with rasterio.open(fp_tile, "w", **profile) as dst:
+                dst.write(rgb, [1, 2, 3])
+                if fmt != "jpg":
+                    dst.write(alpha, 4)
+
+            written.append((z, x, y))
+
+    return written
+
+
+def _tile_jobs(sources, tile_list, tiles_per_job):
+    """
+    Split tiles into jobs, each with the sources intersecting the bounds of its
+    tiles, skipping jobs without sources
+
+    Parameters
+    ==========
+    sources: list of tuple
+        Path and bounds in Web Mercator of each source
+    tile_list: list of tuple
+        Zoom level, column and row (z, x, y) of each tile
+    tiles_per_job: int
+        Number of tiles per job
+
+    Returns
+    =======
+    jobs: list of tuple
+        Sources and tiles of each job
+    """
+    jobs = list()
+    for i in range(0, len(tile_list), tiles_per_job):
+        job = tile_list[i:i + tiles_per_job]
+        all_bounds = [tile_bounds(x, y, z) for z, x, y in job]
+        job_bounds = (
+            min(b[0] for b in all_bounds),
+            min(b[1] for b in all_bounds),
+            max(b[2] for b in all_bounds),
+            max(b[3] for b in all_bounds),
+            )
+        job_sources = [s for s in sources if _intersects(s[1], job_bounds)]
+        if job_sources:
+            jobs.append((job_sources, job))
+
+    return jobs
+
+
+def render_tiles(sources, path_output, zooms, bounds=None, tile_size=256,
+                 resampling="bilinear", fmt="png", n_workers=3, tiles_per_job=64):
+    """
+    Render an XYZ tile pyramid in Web Mercator from RGB composites
+
+    Tiles are written to `{path_output}/{z}/{x}/{y}.{fmt}`. Each tile is warped
+    from the sources it intersects, later sources drawn over earlier sources, so
+    that sources should be ordered oldest first. Tiles without valid data are
+    skipped. Tiles of all zoom levels are rendered in a process pool, reading
+    Cloud-Optimized GeoTIFF sources from their overviews at lower zoom levels.
+    The bounds of the sources are read once, and each job of tiles is only given
+    the sources intersecting it.
+
+    To re-render only the tiles touched by a new scene, pass its `bounds` along
+    with all sources.
+
+    Parameters
+    ==========
+    sources: list of str
+        Paths of georeferenced RGB `uint8` images, e.g. written by
+        `geotoys.jpeg2000.jp2_to_jpeg` with `cog=True`
+    path_output: str
+        Path to directory to write tiles to
+    zooms: list of int
+        Zoom levels to render
+    bounds: tuple of float
+        Bounding box in longitude and latitude (lon0, lat0, lon1, lat1) of tiles
+        to render. Defaults to the union of the bounds of the sources.
+    tile_size: int
+        Width and height of tiles, e.g. 256 or 512
+    resampling: str
+        Resampling method, e.g. `nearest`, `bilinear` or `average`
+    fmt: str
+        Format of tiles, one of `png`, `jpg` or `webp`. JPEG tiles have no
+        transparency.
+    n_workers: int
+        Number of processes rendering tiles
+    tiles_per_job: int
+        Number of tiles rendered by a process per job
+
+    Returns
+    =======
+    written: list of tuple
+        Zoom level, column and row (z, x, y) of tiles written
+
+    Example
+    =======
+    Render a new scene and update the tiles it touches
+    >>> fp_new = "S2A_..._true_color.tif"
+    >>> render_tiles(sources + [fp_new], "tiles", range(8, 15),
+    ...              bounds=lonlat_bounds(fp_new))
+    """
+    import concurrent.futures
+    from rasterio.warp import transform_bounds
+
+    if fmt not in TILE_DRIVERS:
+        raise ValueError(f"Tile format must be one of {', '.join(TILE_DRIVERS)}")
+
+    sources = [(fp, _mercator_bounds(fp)) for fp in sources]
+    if bounds is None:
+        all_bounds = [
+            transform_bounds("EPSG:3857", "EPSG:4326", *b) for _, b in sources
+            ]
+        bounds = (
+            min(b[0] for b in all_bounds),
+            min(b[1] for b in all_bounds),
+            max(b[2] for b in all_bounds),
+            max(b[3] for b in all_bounds),
+            )
+
+    jobs = _tile_jobs(sources, tiles(bounds, zooms), tiles_per_job)
+
+    written = list()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                _render_tiles,
+                job_sources,
+                path_output,
+                job,
+                tile_size,
+                resampling,
+                fmt,
+                )
+            for job_sources, job in jobs
+            ]
+        for future in concurrent.futures.as_completed(futures):
+            written += future.result()
+
+    return sorted(written)
@@ -0,0 +1,73 @@
+
+def _write_band(fp, left, top):
+    """
+    Write a single band test GeoTIFF in UTM zone 32N with 10 unit pixels
+    """
+    import numpy
+    import rasterio
+    from rasterio.transform import from_origin
+
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint16",
+        "count": 1,
+        "height": 10,
+        "width": 10,
+        "crs": "EPSG:32632",
+        "transform": from_origin(left, top, 10, 10),
+    }
+    with rasterio.open(fp, "w", **profile) as dst:
+        dst.write(numpy.zeros((1, 10, 10), dtype="uint16"))
+
+
+def test_catalog_update_query(tmp_path):
+    """
+    Test that files are indexed incrementally and queried by bbox, time and band
+    """
+    from geotoys.catalog import Catalog
+
+    path_data = tmp_path / "data"
+    path_data.mkdir()
+    fp_b02 = str(path_data / "T32VNM_20190101T104441_B02_10m.tif")
+    fp_b04 = str(path_data / "T32VNM_20190201T104441_B04_10m.tif")
+    fp_far = str(path_data / "T32VNM_20190101T104441_B04_10m.tif")
+    _write_band(fp_b02, 600000, 6650000)
+    _write_band(fp_b04, 600000, 6650000)
+    _write_band(fp_far, 400000, 6450000)
+
+    with Catalog(str(tmp_path / "catalog.sqlite")) as catalog:
+        assert catalog.update(str(path_data)) == (3, 0)
+        assert catalog.update(str(path_data)) == (0, 0)
+
+        bbox = (10.5, 59.9, 11.0, 60.1)
+        assert catalog.query(bbox=bbox) == [fp_b02, fp_b04]
+        assert catalog.query(bbox=bbox, band="B04") == [fp_b04]
+        assert catalog.query(ts0="2019-01-15", ts1="2019-03-01") == [fp_b04]
+
+        (path_data / "T32VNM_20190101T104441_B02_10m.tif").unlink()
+        assert catalog.update(str(path_data)) == (0, 1)
+        assert catalog.query(band="B02") == []
+
+
+def test_catalog_update_prefix(tmp_path):
+    """
+    Test that updating a directory leaves sibling directories whose names match
+    it as SQL wildcards, and skips unreadable files and band masks
+    """
+    from geotoys.catalog import Catalog, band_from_filename
+
+    for name in ["axb", "a_b", "A_B"]:
+        (tmp_path / name).mkdir()
+        _write_band(str(tmp_path / name / "T32VNM_20190101T104441_B02_10m.tif"),
+                    600000, 6650000)
+    (tmp_path / "a_b" / "T32VNM_20190102T104441_B03_10m.tif").write_bytes(b"junk")
+
+    with Catalog(str(tmp_path / "catalog.sqlite")) as catalog:
+        assert catalog.update(str(tmp_path / "axb")) == (1, 0)
+        assert catalog.update(str(tmp_path / "A_B")) == (1, 0)
+        assert catalog.update(str(tmp_path / "a_b")) == (1, 0)
+        assert len(catalog.query(band="B02")) == 3
+
+    assert band_from_filename("GRANULE/L1C/QI_DATA/MSK_DETFOO_B02.jp2") is None
+    fp = "GRANULE/L1C/IMG_DATA/T32VNM_20190101T104441_B8A.jp2"
+    assert band_from_filename(fp) == "B8A"
@@ -27,3 +27,52 @@ def test_utc_timestamp():
     ts_utc = utc_timestamp(ts)
 
     assert ts_utc.tz is pytz.UTC
+
+
+def test_timestamps_from_strings():
+    """
+    Test that timestamps are found in many strings with the known patterns
+    """
+    from geotoys.datetime import timestamps_from_strings
+    import numpy
+
+    strings = [
+        "S2A_MSIL1C_20190101T104441_N0207_R008_T32VNM_20190101T111111.SAFE",
+        "some_file_name_201201050842_with_timestamp.tif",
+        "2012-01-05_08:42_with_timestamp.tif",
+        "invalid_20190230.tif",
+        "no_timestamp.tif",
+    ]
+    expected = numpy.array(
+        ["2019-01-01T10:44:41", "2012-01-05T08:42", "2012-01-05T08:42", "NaT", "NaT"],
+        dtype="datetime64[ns]",
+    )
+
+    timestamps = timestamps_from_strings(strings)
+    assert timestamps.dtype == "datetime64[ns]"
+    assert ((timestamps == expected) | numpy.isnat(expected)).all()
+    assert numpy.isnat(timestamps[3:]).all()
+
+
+def test_timestamp_offsets():
+    """
+    Test that times with a UTC offset are converted to UTC
+    """
+    from geotoys.datetime import timestamp_from_string, timestamps_from_strings
+    import numpy
+    import pandas
+
+    strings = [
+        "ERA5_2019-01-05T08:42:00+01:00_v1.nc",
+        "ERA5_2019-01-05T08:42-0530_v1.nc",
+        "S2A_20190105T084200Z.tif",
+        "2019-01-05_08:42_v1.nc",
+    ]
+    expected = ["2019-01-05T07:42", "2019-01-05T14:12", "2019-01-05T08:42",
+                "2019-01-05T08:42"]
+
+    for s, ts in zip(strings, expected):
+        assert timestamp_from_string(s) == pandas.Timestamp(ts, tz="UTC")
+    assert (timestamps_from_strings(strings) == (
+        numpy.array(expected, dtype="datetime64[ns]")
+        )).all()
@@ -0,0 +1,180 @@
+
+def _write_geotiff(fp, data, nodata=None):
+    """
+    Write a small test GeoTIFF with 10 unit pixels starting at (500000, 6000000)
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    profile = {
+        "driver": "GTiff",
+        "dtype": data.dtype,
+        "count": data.shape[0],
+        "height": data.shape[1],
+        "width": data.shape[2],
+        "crs": "EPSG:32632",
+        "transform": from_origin(500000, 6000000, 10, 10),
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 16,
+        "blockysize": 16,
+    }
+    with rasterio.open(fp, "w", **profile) as dst:
+        dst.write(data)
+
+
+def test_as_dataframe(tmp_path):
+    """
+    Test that points are sampled from each file into a timestamp, x, y indexed frame
+    """
+    from geotoys.geotiff import as_dataframe
+    import numpy
+
+    data = numpy.arange(2 * 40 * 40, dtype="int16").reshape(2, 40, 40)
+    files = list()
+    for i, day in enumerate(["05", "06"]):
+        fp = str(tmp_path / f"scene_201201{day}0842_s2.tif")
+        _write_geotiff(fp, data + i)
+        files.append(fp)
+
+    x = [500005.0, 500155.0, 500395.0]
+    y = [5999995.0, 5999755.0, 5999605.0]
+
+    df = as_dataframe(files, x, y, bands=["a", "b"], n_cpu=2, files_per_job=1,
+                      points_per_job=2)
+
+    assert list(df.columns) == ["a", "b"]
+    assert len(df) == 6
+
+    expected = data[:, [0, 24, 39], [0, 15, 39]].T
+    first = df.loc[df.index.get_level_values("timestamp").min()]
+    assert (first.values == expected).all()
+
+
+def test_sample_bilinear_masked(tmp_path):
+    """
+    Test bilinear interpolation and masking of nodata and out of bounds points
+    """
+    from geotoys.geotiff import _sample
+    import numpy
+
+    data = numpy.arange(40 * 40, dtype="float32").reshape(1, 40, 40)
+    data[0, 30, 30] = -1
+    fp = str(tmp_path / "scene_201201050842_s2.tif")
+    _write_geotiff(fp, data, nodata=-1)
+
+    # Between pixel centers, on nodata and outside the GeoTIFF
+    x = [500010.0, 500305.0, 499990.0]
+    y = [5999990.0, 5999695.0, 5999990.0]
+
+    df = _sample(fp, x, y, ["a"], method="bilinear", masked=True)
+    values = df["a"].droplevel("timestamp")
+
+    assert values[(500010.0, 5999990.0)] == data[0, :2, :2].mean()
+    assert numpy.isnan(values[(500305.0, 5999695.0)])
+    assert numpy.isnan(values[(499990.0, 5999990.0)])
+
+
+def test_as_zarr_append(tmp_path):
+    """
+    Test that GeoTIFFs are written to a zarr store and new files are appended
+    in time order
+    """
+    from geotoys.geotiff import as_zarr
+    import numpy
+    import pytest
+    import zarr
+
+    data = numpy.arange(2 * 40 * 40, dtype="int16").reshape(2, 40, 40)
+    files = list()
+    for i, day in enumerate(["05", "06", "07"]):
+        fp = str(tmp_path / f"scene_201201{day}0842_s2.tif")
+        _write_geotiff(fp, data + i)
+        files.append(fp)
+
+    store = str(tmp_path / "stack.zarr")
+    as_zarr(files[:2], store, chunks=(1, 16, 16), n_workers=2)
+    group = as_zarr(files, store, chunks=(1, 16, 16), n_workers=2)
+
+    assert group["data"].shape == (3, 2, 40, 40)
+    assert group["complete"][:].all()
+    assert (numpy.diff(group["time"][:]) > numpy.timedelta64(0)).all()
+    for i in range(3):
+        assert (group["data"][i] == data + i).all()
+
+    # Scenes older than the last time step can not be appended
+    fp = str(tmp_path / "scene_201201040842_s2.tif")
+    _write_geotiff(fp, data)
+    with pytest.raises(ValueError):
+        as_zarr(files + [fp], store, chunks=(1, 16, 16))
+    assert zarr.open_group(store)["data"].shape == (3, 2, 40, 40)
+
+
+def test_as_xarray(tmp_path):
+    """
+    Test that a lazy dataset is created from GeoTIFFs and mismatched grids fail
+    """
+    from geotoys.geotiff import as_xarray
+    import numpy
+    import pytest
+
+    data = numpy.arange(2 * 40 * 40, dtype="int16").reshape(2, 40, 40)
+    files = list()
+    for i, day in enumerate(["06", "05"]):
+        fp = str(tmp_path / f"scene_201201{day}0842_s2.tif")
+        _write_geotiff(fp, data + i)
+        files.append(fp)
+
+    ds = as_xarray(files, bands=["a", "b"])
+
+    assert ds["a"].chunks == ((1, 1), (16, 16, 8), (16, 16, 8))
+    assert ds.time.to_index().is_monotonic_increasing
+    assert (ds["b"][0].values == data[1] + 1).all()
+
+    fp = str(tmp_path / "scene_201201070842_s2.tif")
+    _write_geotiff(fp, data[:, :20])
+    with pytest.raises(ValueError):
+        as_xarray(files + [fp])
+
+
+def test_as_xarray_fail_fast(tmp_path, monkeypatch):
+    """
+    Test that headers queued after a mismatched grid are not read
+    """
+    from geotoys import geotiff
+    import numpy
+    import pytest
+
+    data = numpy.zeros((1, 40, 40), dtype="int16")
+    files = list()
+    for day in range(1, 29):
+        fp = str(tmp_path / f"scene_201201{day:02d}0842_s2.tif")
+        _write_geotiff(fp, data[:, :20] if day == 2 else data)
+        files.append(fp)
+
+    read = list()
+    header = geotiff._header
+    monkeypatch.setattr(geotiff, "_header", lambda fp: read.append(fp) or header(fp))
+    with pytest.raises(ValueError, match="201201020842"):
+        geotiff.as_xarray(files, n_workers=1)
+    assert len(read) < len(files) / 2
+
+
+def test_header_cache(tmp_path, monkeypatch):
+    """
+    Test that cached headers are bounded and read again once a file is rewritten
+    """
+    from geotoys import geotiff
+    import numpy
+
+    monkeypatch.setattr(geotiff, "_read_header", geotiff.functools.lru_cache(
+        maxsize=2)(geotiff._read_header.__wrapped__))
+    data = numpy.zeros((1, 40, 40), dtype="int16")
+    files = [str(tmp_path / f"scene_2012010{day}0842_s2.tif") for day in range(1, 4)]
+    for fp in files:
+        _write_geotiff(fp, data)
+        assert geotiff._header(fp)["grid"]["height"] == 40
+    assert geotiff._read_header.cache_info().currsize == 2
+
+    _write_geotiff(files[-1], data[:, :20])
+    assert geotiff._header(files[-1])["grid"]["height"] == 20
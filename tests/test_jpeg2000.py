@@ -0,0 +1,203 @@
+
+def test_band_index(tmp_path):
+    """
+    Test that bands are indexed by exact label and resolution, skipping QI data
+    """
+    from geotoys.jpeg2000 import band_index
+
+    granule = tmp_path / "P.SAFE/GRANULE/L2A_T32VNM"
+    paths = [
+        "IMG_DATA/R10m/T32VNM_20190101T104441_B02_10m.jp2",
+        "IMG_DATA/R10m/T32VNM_20190101T104441_TCI_10m.jp2",
+        "IMG_DATA/R20m/T32VNM_20190101T104441_B02_20m.jp2",
+        "IMG_DATA/R20m/T32VNM_20190101T104441_B8A_20m.jp2",
+        "QI_DATA/MSK_DETFOO_B02.jp2",
+    ]
+    for p in paths:
+        (granule / p).parent.mkdir(parents=True, exist_ok=True)
+        (granule / p).touch()
+
+    index = band_index(str(tmp_path / "P.SAFE"))
+
+    assert index == {
+        "B02": {
+            "10m": str(granule / paths[0]),
+            "20m": str(granule / paths[2]),
+        },
+        "B8A": {"20m": str(granule / paths[3])},
+    }
+
+
+def _write_safe(path_data, product_id, bands=("02", "03", "04", "08", "8A", "11")):
+    """
+    Write a Level-1C SAFE product with JPEG2000 band images covering 600 m, with
+    60 pixels of 10 m or 30 pixels of 20 m, whose values are 1000 times the
+    position of the band plus the easting from the left edge
+    """
+    import numpy
+    import rasterio
+    from rasterio.transform import from_origin
+
+    from geotoys.jpeg2000 import SENTINEL2_BAND_RES
+
+    path_img = path_data / f"{product_id}.SAFE/GRANULE/L1C_T32VNM/IMG_DATA"
+    path_img.mkdir(parents=True)
+    for b in bands:
+        res = int(SENTINEL2_BAND_RES[f"B{b}"][:-1])
+        n = 600 // res
+        data = numpy.tile(numpy.arange(n, dtype="uint16") * res, (n, 1))
+        data += (bands.index(b) + 1) * 1000
+        profile = {
+            "driver": "JP2OpenJPEG",
+            "dtype": "uint16",
+            "count": 1,
+            "height": n,
+            "width": n,
+            "crs": "EPSG:32632",
+            "transform": from_origin(600000, 6650000, res, res),
+            "quality": 100,
+            "reversible": True,
+            }
+        fp = path_img / f"T32VNM_20190101T104441_B{b}.jp2"
+        with rasterio.open(str(fp), "w", **profile) as dst:
+            dst.write(data, 1)
+
+
+def test_product_grid_decimated(tmp_path):
+    """
+    Test that grids are reduced by a decimation factor, size or number of bytes,
+    keeping their bounds
+    """
+    from geotoys.jpeg2000 import jp2_to_jpeg, product_bands, product_grid
+    import rasterio
+
+    _write_safe(tmp_path, "P")
+
+    _, bounds, profile = product_grid(str(tmp_path), "P", ["04", "03", "02"])
+    assert (profile["height"], profile["width"]) == (60, 60)
+    assert bounds == (600000, 6649400, 600600, 6650000)
+
+    for kwargs, shape in [
+        ({"decimation": 2}, (30, 30)),
+        ({"size": 20}, (20, 20)),
+        ({"max_bytes": 3 * 15 * 15 * 2}, (15, 15)),
+        ]:
+        _, _, profile = product_grid(str(tmp_path), "P", ["04", "03", "02"], **kwargs)
+        assert (profile["height"], profile["width"]) == shape
+        assert profile["transform"].a == 600 / shape[1]
+        assert (profile["transform"].c, profile["transform"].f) == (600000, 6650000)
+
+    # Decimated pixels average those they cover
+    bands, _ = product_bands(str(tmp_path), "P", ["02"], decimation=2)
+    assert bands["02"][0, :3].tolist() == [1005, 1025, 1045]
+
+    summary = jp2_to_jpeg(str(tmp_path), str(tmp_path / "out"), "P", size=15)
+    assert (summary["width"], summary["height"]) == (15, 15)
+    with rasterio.open(str(tmp_path / "out" / "P_true_color.jpg")) as src:
+        assert src.shape == (15, 15) and src.count == 3
+
+
+def test_render_quicklooks(tmp_path):
+    """
+    Test that image types are rendered at their own resolution, failed products
+    are recorded in the manifest, and the command line renders all products
+    """
+    from geotoys.jpeg2000 import jp2_to_jpeg, main, render_quicklooks
+    import json
+    import rasterio
+
+    path_data = tmp_path / "data"
+    for product_id in ["P1", "P2"]:
+        _write_safe(path_data, product_id)
+    _write_safe(path_data, "BAD", bands=("02",))
+
+    path_output = tmp_path / "out"
+    fp_manifest = str(tmp_path / "manifest.jsonl")
+    summaries = render_quicklooks(
+        str(path_data),
+        str(path_output),
+        ["P1", "BAD", "P2"],
+        img_types=["true_color", "agriculture"],
+        n_workers=2,
+        fp_manifest=fp_manifest,
+        )
+
+    shapes = {(s["product_id"], s["img_type"]): s["width"] for s in summaries}
+    assert shapes == {
+        ("P1", "true_color"): 60,
+        ("P1", "agriculture"): 30,
+        ("P2", "true_color"): 60,
+        ("P2", "agriculture"): 30,
+        }
+    with rasterio.open(str(path_output / "P1_agriculture.jpg")) as src:
+        assert src.shape == (30, 30)
+    summary = jp2_to_jpeg(str(path_data), str(tmp_path / "single"), "P1")
+    assert summary["width"] == shapes[("P1", "true_color")]
+
+    with open(fp_manifest) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 5
+    errors = [r for r in records if "error" in r]
+    assert [r["product_id"] for r in errors] == ["BAD"]
+    assert "B04" in errors[0]["error"]
+
+    main([str(path_data), str(tmp_path / "cli"), "--size", "10", "--workers", "1",
+          "--manifest", fp_manifest])
+    with open(fp_manifest) as f:
+        records = [json.loads(line) for line in f][5:]
+    assert sorted((r["product_id"], r.get("width")) for r in records) == [
+        ("BAD", None), ("P1", 10), ("P2", 10),
+        ]
+    assert (tmp_path / "cli" / "P2_true_color.jpg").exists()
+
+
+def test_product_bands_mixed_res(tmp_path):
+    """
+    Test that bands of 10 m and 20 m are read to a common grid, averaging bands
+    downsampled and interpolating bands upsampled
+    """
+    from geotoys.jpeg2000 import product_bands
+    import numpy
+
+    _write_safe(tmp_path, "P")
+
+    bands, profile = product_bands(str(tmp_path), "P", ["02", "11"])
+    assert profile["transform"].a == 20
+    assert bands["02"].shape == bands["11"].shape == (30, 30)
+    assert bands["02"][0, :3].tolist() == [1005, 1025, 1045]
+    assert bands["11"][0, :3].tolist() == [6000, 6020, 6040]
+
+    bands, profile = product_bands(str(tmp_path), "P", ["02", "11"], res="10m")
+    assert profile["transform"].a == 10
+    assert bands["02"].shape == bands["11"].shape == (60, 60)
+    assert bands["02"][0, :3].tolist() == [1000, 1010, 1020]
+    assert (numpy.diff(bands["11"][0].astype(int)) >= 0).all()
+    assert bands["11"].min() == 6000 and bands["11"].max() <= 6580
+
+
+def test_jp2_to_jpeg_blocks(tmp_path, monkeypatch):
+    """
+    Test that images written by block open each band image once for all blocks
+    """
+    from geotoys.jpeg2000 import jp2_to_jpeg
+    import collections
+    import rasterio
+
+    _write_safe(tmp_path, "P")
+
+    opened = collections.Counter()
+    open_ = rasterio.open
+
+    def counting_open(fp, *args, **kwargs):
+        opened.update([fp])
+        return open_(fp, *args, **kwargs)
+
+    monkeypatch.setattr(rasterio, "open", counting_open)
+    summary = jp2_to_jpeg(str(tmp_path), str(tmp_path / "out"), "P", block_size=16)
+    monkeypatch.undo()
+
+    assert (summary["width"], summary["height"]) == (60, 60)
+    jp2s = [fp for fp in opened if str(fp).endswith("_B04.jp2")]
+    assert len(jp2s) == 1 and opened[jp2s[0]] <= 2
+    with rasterio.open(str(tmp_path / "out" / "P_true_color.jpg")) as src:
+        assert src.read(1)[:, 0].max() < src.read(1)[:, -1].min()
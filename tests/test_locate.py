@@ -0,0 +1,227 @@
+
+def _serve_nominatim(places, failures=None, delay=0, status=503):
+    """
+    Serve Nominatim searches from a dictionary of results by query on a local
+    HTTP server, responding `status` to the number of first requests of a query
+    given in `failures`, and returning the server and list of queries requested
+    """
+    import http.server
+    import json
+    import socketserver
+    import threading
+    import time
+    import urllib.parse
+
+    queries = list()
+    failures = dict(failures or dict())
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)["q"][0]
+            queries.append(query)
+            time.sleep(delay)
+            if failures.get(query):
+                failures[query] -= 1
+                self.send_response(status)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = json.dumps(places.get(query, [])).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, queries
+
+
+def test_find_places():
+    """
+    Test that postal codes and place names are found with leading zeros kept
+    """
+    from geotoys.locate import find_places
+
+    assert find_places("Karl Johans gate 1, 0154 Oslo") == [("0154", "Oslo")]
+    assert find_places("9010 Tromsø; 8622 Mo i Rana") == [
+        ("9010", "Tromsø"), ("8622", "Mo i Rana"),
+        ]
+    assert find_places("Postboks 12345 Oslo") == []
+
+
+def test_token_bucket():
+    """
+    Test that calls beyond the burst capacity are spaced at the rate
+    """
+    from geotoys.locate import TokenBucket
+    import time
+
+    bucket = TokenBucket(rate=50, capacity=2)
+    t0 = time.monotonic()
+    waits = [bucket.acquire() for _ in range(7)]
+    assert waits[:2] == [0, 0]
+    assert time.monotonic() - t0 >= 5 / 50 * 0.9
+
+
+def test_geocoder(tmp_path):
+    """
+    Test that queries are looked up in the gazetteer, then in the cache, and
+    only requested once from the server
+    """
+    from geotoys.locate import Gazetteer, Geocoder
+
+    fp_gazetteer = tmp_path / "NO.txt"
+    fp_gazetteer.write_text(
+        "NO\t0150\tOslo\tOslo\t03\t\t\t\t\t59.9112\t10.7528\t4\n"
+        "NO\t7491\tTrondheim\tTrøndelag\t50\t\t\t\t\t63.4305\t10.3951\t4\n",
+        encoding="utf-8",
+        )
+    gazetteer = Gazetteer.read(str(fp_gazetteer))
+    assert len(gazetteer) == 2
+
+    places = {
+        "9010 Tromsø": [{
+            "display_name": "Tromsø, Troms",
+            "lon": "18.9553",
+            "lat": "69.6492",
+            "geojson": {"type": "Point", "coordinates": [18.9553, 69.6492]},
+            }],
+        }
+    server, queries = _serve_nominatim(places)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    fp_cache = str(tmp_path / "geocode.sqlite")
+    try:
+        with Geocoder(gazetteer, fp_cache, base_url=base_url, rate=100) as geocoder:
+            results = geocoder.geocode_many(
+                ["0150 Oslo", "9010 Tromsø", "7491 trondheim", "9010  Tromsø",
+                 "Nowhere"],
+                n_workers=2,
+                )
+        assert [r and r["source"] for r in results] == [
+            "gazetteer", "nominatim", "gazetteer", "nominatim", None,
+            ]
+        assert results[0]["lat"] == 59.9112
+        assert results[1]["geometry"].x == 18.9553
+        assert sorted(queries) == ["9010 Tromsø", "Nowhere"]
+
+        # Results, including places not found, are persisted
+        with Geocoder(None, fp_cache, base_url=base_url) as geocoder:
+            assert geocoder.geocode("9010 Tromsø")["source"] == "cache"
+            assert geocoder.geocode("Nowhere") is None
+        assert len(queries) == 2
+    finally:
+        server.shutdown()
+
+
+def test_locate(tmp_path):
+    """
+    Test that queries are requested concurrently, retried and yielded as they
+    complete
+    """
+    from geotoys.locate import Gazetteer, Geocoder, locate, locate_all
+    from shapely.geometry import Point
+    import asyncio
+    import time
+
+    places = {
+        f"{i:04d} Sted": [{"display_name": f"Sted {i}", "lon": i, "lat": 60}]
+        for i in range(20)
+        }
+    server, queries = _serve_nominatim(places, {"0003 Sted": 2}, delay=0.1)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    fp_cache = str(tmp_path / "geocode.sqlite")
+    gazetteer = Gazetteer()
+    gazetteer.add("9999", "Hjemme", Point(10, 60))
+
+    async def collect(names, geocoder):
+        return [item async for item in locate(names, geocoder, concurrency=10,
+                                              backoff=0.01)]
+
+    names = ["9999 Hjemme"] + list(places) + ["0001 sted"]
+    try:
+        t0 = time.monotonic()
+        loop = asyncio.new_event_loop()
+        with Geocoder(gazetteer, fp_cache, base_url=base_url, rate=1000) as geocoder:
+            results = loop.run_until_complete(collect(names, geocoder))
+        loop.close()
+        assert time.monotonic() - t0 < 20 * 0.1 / 2
+        assert results[0] == ("9999 Hjemme", gazetteer.lookup("9999"))
+        assert results[-1][0] == "0003 Sted"
+        assert dict(results)["0001 sted"]["lon"] == 1
+        assert len(results) == len(names)
+        assert len(queries) == 20 + 2
+
+        # The sync wrapper returns results in order, from the cache
+        with Geocoder(gazetteer, fp_cache, base_url=base_url) as geocoder:
+            results = locate_all(names[::-1], geocoder)
+        assert [r["lon"] for r in results[:3]] == [1, 19, 18]
+        assert len(queries) == 20 + 2
+    finally:
+        server.shutdown()
+
+
+def test_locate_failure(tmp_path):
+    """
+    Test that a query failing with a status not retried is yielded with its
+    error, not cached, and does not stop the other queries
+    """
+    from geotoys.locate import Gazetteer, Geocoder, locate_all
+    import aiohttp
+
+    places = {
+        f"{i:04d} Sted": [{"display_name": f"Sted {i}", "lon": i, "lat": 60}]
+        for i in range(22)
+        }
+    server, queries = _serve_nominatim(places, {"0005 Sted": 1}, status=400)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    fp_cache = str(tmp_path / "geocode.sqlite")
+    try:
+        with Geocoder(Gazetteer(), fp_cache, base_url=base_url, rate=1000) as geocoder:
+            results = locate_all(places, geocoder, concurrency=4, backoff=0.01)
+        assert isinstance(results[5], aiohttp.ClientResponseError)
+        assert results[5].status == 400
+        assert [r["lon"] for r in results[:5] + results[6:]] == [
+            i for i in range(22) if i != 5
+            ]
+        assert queries.count("0005 Sted") == 1
+
+        # The failed query is requested again
+        with Geocoder(Gazetteer(), fp_cache, base_url=base_url) as geocoder:
+            results = locate_all(places, geocoder)
+        assert results[5]["lon"] == 5
+        assert len(queries) == 22 + 1
+    finally:
+        server.shutdown()
+
+
+def test_locate_all_sync(tmp_path, monkeypatch):
+    """
+    Test that the sync wrapper runs its own event loop without `asyncio.run`,
+    which is not available before Python 3.7, and can be called repeatedly
+    """
+    from geotoys.locate import Gazetteer, Geocoder, locate_all
+    import asyncio
+
+    monkeypatch.delattr(asyncio, "run", raising=False)
+    places = {"0150 Oslo": [{"display_name": "Oslo", "lon": 10.75, "lat": 59.91}]}
+    server, queries = _serve_nominatim(places)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        for _ in range(2):
+            with Geocoder(Gazetteer(), ":memory:", base_url=base_url) as geocoder:
+                results = locate_all(["0150 Oslo", "Nowhere"], geocoder)
+            assert results[0]["lon"] == 10.75
+            assert results[1] is None
+        assert len(queries) == 4
+    finally:
+        server.shutdown()
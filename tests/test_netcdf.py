@@ -0,0 +1,184 @@
+
+def test_get_timestamps(tmp_path, monkeypatch):
+    """
+    Test that times are decoded as with cftime, and cached until the file changes
+    for a bounded number of files
+    """
+    from geotoys import netcdf
+    from geotoys.netcdf import decode_times, get_timestamps
+    import cftime
+    import netCDF4
+    import numpy
+
+    fp = str(tmp_path / "times.nc")
+    units = "hours since 1950-01-01 00:00:00 +01:00"
+    values = numpy.arange(0, 1000, 0.25)
+    with netCDF4.Dataset(fp, "w") as nc:
+        nc.createDimension("time", None)
+        var = nc.createVariable("time", "f8", ("time",))
+        var.units = units
+        var.calendar = "gregorian"
+        var[:] = values
+
+    expected = cftime.num2date(values, units, only_use_python_datetimes=True,
+                               only_use_cftime_datetimes=False)
+    expected = numpy.array(expected, dtype="datetime64[ns]")
+
+    with netCDF4.Dataset(fp) as nc:
+        timestamps = get_timestamps(nc)
+        assert timestamps.dtype == "datetime64[ns]"
+        assert (timestamps == expected).all()
+        assert get_timestamps(nc) is timestamps
+
+    with netCDF4.Dataset(fp, "a") as nc:
+        nc.variables["time"][len(values)] = 1000
+    monkeypatch.setattr(netcdf, "MAX_TIMESTAMPS", 1)
+    with netCDF4.Dataset(fp) as nc:
+        assert len(get_timestamps(nc)) == len(values) + 1
+    assert len(netcdf._timestamps) == 1
+
+    # Non-standard calendars are decoded with cftime
+    assert decode_times([0, 59], "days since 2000-02-01", "noleap")[1] == (
+        numpy.datetime64("2000-04-01")
+        )
+    assert decode_times([29], "days since 2000-02-01", "360_day")[0] == (
+        cftime.Datetime360Day(2000, 2, 30)
+        )
+
+
+def test_read_subset(tmp_path):
+    """
+    Test that subsets across the prime meridian and of descending latitudes and
+    time ranges match indexing the whole variable
+    """
+    from geotoys.netcdf import get_lons_lats, read_subset
+    import netCDF4
+    import numpy
+
+    fp = str(tmp_path / "global.nc")
+    lons = numpy.arange(0, 360, 2.5)
+    lats = numpy.arange(90, -90.1, -2.5)
+    data = numpy.arange(10 * len(lats) * len(lons)).reshape(10, len(lats), len(lons))
+    with netCDF4.Dataset(fp, "w") as nc:
+        for name, values in [("time", range(10)), ("lat", lats), ("lon", lons)]:
+            nc.createDimension(name, len(values))
+            var = nc.createVariable(name, "f8", (name,))
+            var[:] = values
+        nc.variables["time"].units = "days since 2019-01-01"
+        var = nc.createVariable("t2m", "f4", ("time", "lat", "lon"), zlib=True,
+                                chunksizes=(1, 16, 16))
+        var[:] = data
+
+    with netCDF4.Dataset(fp) as nc:
+        values, coords = read_subset(nc, "t2m", bbox=(-10, 50, 10, 60),
+                                     time_range=("2019-01-03", "2019-01-04"))
+        assert get_lons_lats(nc, bbox=(-10, 50, 10, 60))[0].tolist() == (
+            coords["lon"].tolist()
+            )
+
+    ix_lon = numpy.r_[140:144, 0:5]
+    ix_lat = numpy.flatnonzero((lats >= 50) & (lats <= 60))
+    assert coords["lon"].tolist() == [-10, -7.5, -5, -2.5, 0, 2.5, 5, 7.5, 10]
+    assert coords["lat"].tolist() == [60, 57.5, 55, 52.5, 50]
+    assert (coords["time"] == numpy.array(["2019-01-03", "2019-01-04"],
+                                          dtype="datetime64[ns]")).all()
+    assert (values == data[2:4][:, ix_lat][:, :, ix_lon]).all()
+
+
+def test_archive(tmp_path):
+    """
+    Test that time ranges are read from the files indexed, which are only indexed
+    again once modified
+    """
+    from geotoys.netcdf import Archive
+    import netCDF4
+    import numpy
+
+    files = list()
+    for day in range(1, 6):
+        fp = str(tmp_path / f"model_201901{day:02d}.nc")
+        with netCDF4.Dataset(fp, "w") as nc:
+            nc.createDimension("time", 24)
+            nc.createDimension("lat", 2)
+            nc.createDimension("lon", 3)
+            var = nc.createVariable("time", "f8", ("time",))
+            var.units = f"hours since 2019-01-{day:02d}"
+            var[:] = numpy.arange(24)
+            nc.createVariable("lat", "f8", ("lat",))[:] = [60, 61]
+            nc.createVariable("lon", "f8", ("lon",))[:] = [10, 11, 12]
+            var = nc.createVariable("t2m", "f4", ("time", "lat", "lon"))
+            var[:] = numpy.arange(24 * 6).reshape(24, 2, 3) + day * 1000
+        files.append(fp)
+
+    fp_index = str(tmp_path / "index.sqlite")
+    with Archive(files, fp_index, max_open=2) as archive:
+        assert len(archive.timestamps) == 5 * 24
+        values, coords = archive.read("t2m", ("2019-01-02T22", "2019-01-03T01"))
+        assert len(archive._handles) == 2
+        selection = archive.select(("2019-01-02T22", None))
+        assert [s.start for _, s in selection] == [22, 0, 0, 0]
+
+    assert values.shape == (4, 2, 3)
+    assert values[:, 0, 0].tolist() == [2132, 2138, 3000, 3006]
+    assert coords["time"][0] == numpy.datetime64("2019-01-02T22:00", "ns")
+
+    with Archive(files[1:], fp_index) as archive:
+        assert archive.update(files[1:]) == (0, 0)
+        assert archive.files == files[1:]
+        assert archive.select((None, "2019-01-01T23")) == []
+
+
+def test_as_dataframe(tmp_path, monkeypatch):
+    """
+    Test that points are sampled at all or given times as indexing the variables
+    """
+    from geotoys.netcdf import as_dataframe
+    import concurrent.futures
+    import netCDF4
+    import numpy
+    import pandas
+
+    lons = numpy.arange(0, 360, 10.0)
+    lats = numpy.arange(80, -81, -10.0)
+    files, data = list(), list()
+    for day in (1, 2):
+        fp = str(tmp_path / f"model_201901{day:02d}.nc")
+        d = numpy.random.default_rng(day).random((4, len(lats), len(lons)))
+        with netCDF4.Dataset(fp, "w") as nc:
+            for name, values in [("time", range(4)), ("lat", lats), ("lon", lons)]:
+                nc.createDimension(name, len(values))
+                nc.createVariable(name, "f8", (name,))[:] = values
+            nc.variables["time"].units = f"hours since 2019-01-{day:02d}"
+            var = nc.createVariable("t2m", "f4", ("time", "lat", "lon"),
+                                    chunksizes=(2, 4, 4))
+            var[:] = d
+        files.append(fp)
+        data.append(d.astype("float32"))
+    data = numpy.concatenate(data)
+
+    x = numpy.array([-10.0, 21.0, 354.0, 100.0])
+    y = numpy.array([59.0, -41.0, 0.0, 100.0])
+    ix, iy = [35, 2, 35, 10], [2, 12, 8, 0]
+
+    df = as_dataframe(files, x, y, "t2m", n_cpu=2)
+    assert len(df) == 8 * 4
+    sample = df.xs(21.0, level="x")["t2m"].to_numpy()
+    assert (sample == data[:, iy[1], ix[1]]).all()
+    assert df.xs(100.0, level="x")["t2m"].isna().all()
+
+    # Strings in mixed formats and with UTC offsets
+    times = ["2019-01-01T02:10", "20190102 04:00+01:00", "2019-01-01 23:00:00Z",
+             "2019-01-01"]
+    df = as_dataframe(files, x, y, ["t2m"], times=times, n_cpu=2)
+    df = df.reset_index().set_index("x")
+    assert df.loc[-10.0, "t2m"] == data[2, iy[0], ix[0]]
+    assert df.loc[21.0, "t2m"] == data[7, iy[1], ix[1]]
+    assert df.loc[354.0, "t2m"] == data[4, iy[2], ix[2]]
+    assert numpy.isnan(df.loc[100.0, "t2m"])
+    assert df.loc[354.0, "timestamp"] == pandas.Timestamp("2019-01-02", tz="UTC")
+
+    # A single job is sampled without a process pool
+    monkeypatch.delattr(concurrent.futures, "ProcessPoolExecutor")
+    single = as_dataframe(files, x, y, "t2m", n_cpu=2, files_per_job=2)
+    assert single.equals(as_dataframe(files, x, y, "t2m", n_cpu=1))
+    assert (single.xs(21.0, level="x")["t2m"].to_numpy() == sample).all()
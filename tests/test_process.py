@@ -0,0 +1,122 @@
+
+def test_save_rgb_tiled(tmp_path):
+    """
+    Test that the tiled RGB pipeline matches processing the whole image at once
+    """
+    from geotoys.process import normalize, save_rgb_tiled, stack_bands, true_color
+    import numpy
+    import rasterio
+
+    rng = numpy.random.default_rng(0)
+    bands = [rng.integers(0, 4000, (70, 90)).astype("uint16") for _ in range(3)]
+    profile = {"width": 90, "height": 70}
+
+    rgb = stack_bands([normalize(true_color(x, 2.5), 0, 255) for x in bands])
+
+    readers = [lambda window, x=x: x[window.toslices()] for x in bands]
+    fp_tiled = str(tmp_path / "tiled.png")
+    save_rgb_tiled(readers, profile, fp_tiled, block_size=32, driver="PNG")
+
+    with rasterio.open(fp_tiled) as src:
+        assert (src.read() == rgb.astype("uint8")).all()
+
+
+def test_to_uint8():
+    """
+    Test that the fused conversion scales, clips and masks as the NumPy chain
+    """
+    from geotoys.process import _numpy_uint8, stretch_coefficients, to_uint8
+    import numpy
+    import warnings
+
+    x = numpy.linspace(-100, 1100, 3 * 40 * 50).reshape(3, 40, 50)
+    x[0, 0, :5] = numpy.nan
+    x[1, 2, 3] = -9999
+
+    scale, offset = stretch_coefficients(0, 1000)
+    expected = numpy.clip(x * scale + offset, 0, 255)
+    expected[numpy.isnan(x) | (x == -9999)] = 7
+    expected = expected.astype("uint8")
+
+    out = to_uint8(x, scale, offset, nodata=-9999, fill=7)
+    assert (out == expected).all()
+
+    out = numpy.empty((120, 50), dtype="uint8")
+    _numpy_uint8(x.reshape(120, 50), scale, offset, 0, 255, -9999, 7, out,
+                 block_rows=16)
+    assert (out == expected.reshape(120, 50)).all()
+
+    # Constant and empty bands are mapped to the lower bound
+    for x_min, x_max in [(5, 5), (numpy.float64(5), numpy.float64(5)),
+                         (numpy.nan, numpy.nan)]:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            scale, offset = stretch_coefficients(x_min, x_max, lower=1)
+        assert (scale, offset) == (0, 1)
+    out = to_uint8(numpy.full((3, 4), 5.0), 0.0, 1.0)
+    assert (out == 1).all()
+
+
+def test_save_cog(tmp_path):
+    """
+    Test that a Cloud-Optimized GeoTIFF is tiled, compressed and has overviews
+    """
+    from geotoys.process import save_cog
+    import numpy
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = numpy.random.default_rng(0)
+    bands = [rng.integers(0, 4000, (300, 200)).astype("uint16") for _ in range(3)]
+    profile = {
+        "width": 200,
+        "height": 300,
+        "crs": "EPSG:32632",
+        "transform": from_origin(500000, 6000000, 10, 10),
+        }
+
+    readers = [lambda window, x=x: x[window.toslices()] for x in bands]
+    fp_cog = str(tmp_path / "rgb.tif")
+    save_cog(readers, profile, fp_cog, block_size=64)
+
+    with rasterio.open(fp_cog) as src:
+        assert src.count == 3 and src.dtypes[0] == "uint8"
+        assert src.block_shapes[0] == (64, 64)
+        assert src.overviews(1) == [2, 4, 8]
+        assert src.compression.name.upper() == "DEFLATE"
+        assert src.crs.to_epsg() == 32632
+    assert list(tmp_path.iterdir()) == [tmp_path / "rgb.tif"]
+
+
+def test_save_cog_overviews(tmp_path):
+    """
+    Test that overviews halved while streaming blocks, and from the previous
+    level beyond the block size, average the full resolution image
+    """
+    from geotoys.process import _halve, save_cog
+    import numpy
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = numpy.random.default_rng(1)
+    bands = [rng.integers(0, 255, (300, 170)).astype("uint8") for _ in range(3)]
+    profile = {
+        "width": 170,
+        "height": 300,
+        "crs": "EPSG:32632",
+        "transform": from_origin(500000, 6000000, 10, 10),
+        }
+
+    readers = [lambda window, x=x: x[window.toslices()] for x in bands]
+    fp_cog = str(tmp_path / "rgb.tif")
+    save_cog(readers, profile, fp_cog, block_size=16, ranges=[(0, 255)] * 3)
+
+    with rasterio.open(fp_cog) as src:
+        assert len(src.overviews(1)) == 5
+        expected = src.read()
+        assert (expected == numpy.stack(bands)).all()
+    for level in range(5):
+        expected = _halve(expected)
+        with rasterio.open(fp_cog, overview_level=level) as src:
+            assert (src.read() == expected).all()
+    assert list(tmp_path.iterdir()) == [tmp_path / "rgb.tif"]
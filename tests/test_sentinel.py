@@ -8,4 +8,243 @@ def test_sentineldl_geojson_bb():
     # TODO validate geojson produced here
 
     # Make sure we've made a Polygon here
-    assert bb_json['features'][0]['geometry']['type'] is 'Polygon'
+    assert bb_json['features'][0]['geometry']['type'] == 'Polygon'
+    assert bb_json['features'][0]['geometry']['coordinates'][0] == (
+        (170.0, 45.0), (175.0, 45.0), (175.0, 46.0), (170.0, 46.0), (170.0, 45.0)
+        )
+
+
+def _box_wkt(lon0, lat0, lon1, lat1):
+    """
+    Get the WKT of a box in longitude and latitude
+    """
+    from shapely.geometry import box
+
+    return box(lon0, lat0, lon1, lat1).wkt
+
+
+def _product_entry(i):
+    """
+    Create an OpenSearch JSON entry of a test product
+    """
+    lon = 10 + i
+    return {
+        "id": f"uuid-{i}",
+        "title": f"S2A_MSIL1C_2019010{i + 1}T104441_N0207_R008_T32VNM_{i}",
+        "date": [{"name": "beginposition", "content": f"2019-01-0{i + 1}T10:44:41Z"}],
+        "double": [{"name": "cloudcoverpercentage", "content": str(5.0 * i)}],
+        "str": [{
+            "name": "footprint",
+            "content": _box_wkt(lon, 60, lon + 1, 61),
+            }],
+        }
+
+
+def _serve_hub(products, files=None, offline=None):
+    """
+    Serve OpenSearch queries of a Copernicus hub from a list of product entries,
+    and OData metadata and data of products from a dictionary of product names and
+    data by UUID, with the UUIDs in the set `offline` not online, on a local HTTP
+    server, returning the server and list of requested paths and range headers
+    """
+    import hashlib
+    import http.server
+    import json
+    import re
+    import socketserver
+    import threading
+    import urllib.parse
+
+    requests = list()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append((self.path, self.headers.get("Range")))
+            url = urllib.parse.urlparse(self.path)
+            match = re.search(r"Products\('([^']+)'\)(/\$value)?$", url.path)
+            if match:
+                name, data = files[match[1]]
+                if not match[2]:
+                    host = f"http://127.0.0.1:{self.server.server_port}"
+                    d = {
+                        "Name": name,
+                        "ContentLength": str(len(data)),
+                        "Checksum": {
+                            "Algorithm": "MD5",
+                            "Value": hashlib.md5(data).hexdigest().upper(),
+                            },
+                        "__metadata": {"media_src": f"{host}{url.path}/$value"},
+                        "Online": match[1] not in (offline or set()),
+                        }
+                    return self._send(200, json.dumps({"d": d}).encode())
+                start = 0
+                if self.headers.get("Range"):
+                    start = int(re.match(r"bytes=(\d+)-", self.headers["Range"])[1])
+                return self._send(206 if start else 200, data[start:])
+
+            query = urllib.parse.parse_qs(url.query)
+            start, rows = int(query["start"][0]), int(query["rows"][0])
+            feed = {
+                "opensearch:totalResults": str(len(products)),
+                "entry": products[start:start + rows],
+                }
+            self._send(200, json.dumps({"feed": feed}).encode())
+
+        def _send(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, requests
+
+
+def test_sentineldl_iter_query_cache(tmp_path):
+    """
+    Test that query results are paginated, cached and filtered from the cache
+    """
+    from geotoys.sentinel import SentinelDL
+    import sqlite3
+
+    server, requests = _serve_hub([_product_entry(i) for i in range(5)])
+    api_url = f"http://127.0.0.1:{server.server_port}/dhus"
+    try:
+        with SentinelDL("user", "password", api_url=api_url, page_size=2,
+                        cache_dir=str(tmp_path)) as dl:
+            bb = (9.0, 59.0, 16.0, 62.0)
+            products = dl.iter_query_bb(bb, "20190101", "20190110", (0, 30))
+            queried = [next(products)]
+            assert queried[0][0] == "uuid-0"
+            assert len(requests) == 1
+            queried.extend(products)
+            assert [p for p, _ in queried] == [f"uuid-{i}" for i in range(5)]
+            assert len(requests) == 3
+
+            # Repeated and contained queries are answered from the cache
+            cached = dl.query_bb(bb, "20190101", "20190110", (0, 30))
+            assert list(cached.items()) == queried
+            products = dl.query_bb((10.2, 59.0, 11.5, 62.0), "20190102", "20190110",
+                                   (0, 30))
+            assert list(products) == ["uuid-1"]
+            assert len(requests) == 3
+
+            dl.query_bb(bb, "20190101", "20190110", (0, 50))
+            assert len(requests) == 6
+
+        # Expired queries are deleted from the cache
+        with SentinelDL("user", "password", api_url=api_url, page_size=2,
+                        cache_dir=str(tmp_path), ttl=0) as dl:
+            dl.query_bb(bb, "20190101", "20190110", (0, 30))
+            assert len(requests) == 9
+        with sqlite3.connect(str(tmp_path / "queries.sqlite")) as conn:
+            assert conn.execute("SELECT COUNT(*) FROM queries").fetchone() == (1,)
+    finally:
+        server.shutdown()
+
+
+def test_sentineldl_download(tmp_path):
+    """
+    Test that downloads resume partial files and are verified and persisted
+    """
+    from geotoys.sentinel import SentinelDL
+    import json
+
+    data = bytes(range(256)) * 4096
+    files = {"uuid-0": ("S2A_0", data), "uuid-1": ("S2A_1", data[::-1])}
+    offline = set()
+    server, requests = _serve_hub(list(), files, offline)
+    api_url = f"http://127.0.0.1:{server.server_port}/dhus"
+
+    path_output = tmp_path / "products"
+    path_output.mkdir()
+    (path_output / "S2A_0.zip.incomplete").write_bytes(data[:1000])
+    try:
+        with SentinelDL("user", "password", api_url=api_url) as dl:
+            state = dl.download(["uuid-0", "uuid-1"], str(path_output),
+                                chunk_size=4096)
+            assert [p["status"] for p in state.values()] == ["done", "done"]
+            assert (path_output / "S2A_0.zip").read_bytes() == data
+            assert (path_output / "S2A_1.zip").read_bytes() == data[::-1]
+            assert ("/dhus/odata/v1/Products('uuid-0')/$value", "bytes=1000-") in (
+                requests
+                )
+
+            # Completed products are not downloaded again
+            n_requests = len(requests)
+            state = dl.download(None, str(path_output))
+            assert len(requests) == n_requests
+
+            # Corrupt downloads fail and are retried
+            files["uuid-2"] = ("S2A_2", data)
+            (path_output / "S2A_2.zip.incomplete").write_bytes(b"x" * 1000)
+            state = dl.download(["uuid-2"], str(path_output))
+            assert state["uuid-2"]["status"] == "failed"
+            assert not (path_output / "S2A_2.zip.incomplete").exists()
+            state = dl.download(None, str(path_output))
+            assert state["uuid-2"]["status"] == "done"
+
+            # Products are checked to be online on each attempt
+            files["uuid-3"] = ("S2A_3", data)
+            offline.add("uuid-3")
+            state = dl.download(["uuid-3"], str(path_output))
+            assert state["uuid-3"]["status"] == "offline"
+            state = dl.download(None, str(path_output))
+            assert state["uuid-3"]["status"] == "offline"
+            assert not any("uuid-3')/$value" in path for path, _ in requests)
+            offline.clear()
+            state = dl.download(None, str(path_output))
+            assert state["uuid-3"]["status"] == "done"
+
+        with open(path_output / ".downloads.json") as f:
+            assert json.load(f)["uuid-2"]["status"] == "done"
+    finally:
+        server.shutdown()
+
+
+def test_select_products():
+    """
+    Test that duplicates are removed and the clearest, most recent products
+    covering the bounding box are selected
+    """
+    from geotoys.sentinel import select_products
+    import datetime
+
+    def product(title, lon0, lon1, cloud_cover, day):
+        return {
+            "title": title,
+            "footprint": _box_wkt(lon0, 60, lon1, 61),
+            "cloudcoverpercentage": cloud_cover,
+            "beginposition": datetime.datetime(2019, 1, day, 10, 44),
+            }
+
+    products = {
+        "west": product("S2A_MSIL1C_20190105T104441_N0207_R008_T32VNM_20190105T111111",
+                        10, 11, 10, 5),
+        "west_reprocessed": product(
+            "S2A_MSIL1C_20190105T104441_N0208_R008_T32VNM_20190301T111111",
+            10, 11, 10, 5,
+            ),
+        "west_clear": product("S2B_MSIL1C_20190103T104441_N0207_R008_T32VNM_0",
+                              10, 11, 2, 3),
+        "east": product("S2A_MSIL1C_20190105T104441_N0207_R008_T32VPM_0",
+                        11, 12, 20, 5),
+        "east_recent": product("S2A_MSIL1C_20190106T104441_N0207_R108_T32VPM_0",
+                               11, 12, 20, 6),
+        "far": product("S2A_MSIL1C_20190106T104441_N0207_R108_T33VPM_0", 20, 21, 0, 6),
+        }
+
+    selected = select_products(products, (10.2, 60.2, 11.8, 60.8))
+    assert list(selected) == ["west_clear", "east_recent"]
+
+    del products["west_clear"]
+    selected = select_products(products, (10.2, 60.2, 10.8, 60.8))
+    assert list(selected) == ["west_reprocessed"]
@@ -0,0 +1,84 @@
+
+def test_band_stats_merge():
+    """
+    Test that statistics merged over blocks match those of the whole array
+    """
+    from geotoys.stats import BandStats
+    import numpy
+
+    rng = numpy.random.default_rng(0)
+    data = rng.normal(1000, 200, 100000)
+    data[:10] = 1e6
+
+    stats = BandStats()
+    for block in numpy.array_split(data, 7):
+        stats.update(block)
+
+    assert stats.count == data.size
+    assert stats.min == data.min()
+    assert stats.max == data.max()
+    assert numpy.isclose(stats.mean, data.mean())
+    assert numpy.isclose(stats.std, data.std())
+    assert stats.hist.sum() == data.size
+
+
+def test_band_stats_percentile_outlier():
+    """
+    Test that percentiles are accurate despite a single extreme hot pixel
+    """
+    from geotoys.stats import BandStats
+    import numpy
+
+    rng = numpy.random.default_rng(0)
+    data = rng.normal(1000, 200, (1000, 1000))
+    data[500, 500] = 1e12
+
+    stats = BandStats()
+    for block in numpy.array_split(data, 9):
+        stats.update(block)
+
+    p = stats.percentile([2, 50, 98])
+    assert numpy.allclose(p, numpy.percentile(data, [2, 50, 98]), rtol=0.005)
+    assert stats.percentile(100) == 1e12
+
+    # Negative values and values near zero
+    data = rng.normal(0, 1, 100000)
+    stats = BandStats().update(data).update(numpy.zeros(10))
+    p = stats.percentile([2, 98])
+    assert numpy.allclose(p, numpy.percentile(data, [2, 98]), rtol=0.005)
+
+    # Bins of values closest to zero are merged beyond the number of bins
+    stats = BandStats(n_bins=500).update(data)
+    assert len(stats.hist) <= 500
+    assert numpy.allclose(stats.percentile([2, 98]), p, rtol=0.005)
+
+
+def test_file_stats_cache(tmp_path):
+    """
+    Test that file statistics are cached and reused until the file is modified
+    """
+    from geotoys.stats import file_stats
+    import numpy
+    import rasterio
+
+    fp = str(tmp_path / "band.tif")
+    profile = {"driver": "GTiff", "dtype": "uint16", "count": 1, "width": 50,
+               "height": 40, "nodata": 0}
+    data = numpy.arange(1, 2001, dtype="uint16").reshape(1, 40, 50)
+    with rasterio.open(fp, "w", **profile) as dst:
+        dst.write(data)
+
+    cache_dir = str(tmp_path / "cache")
+    stats = file_stats(fp, cache_dir=cache_dir)[1]
+    cached = file_stats(fp, cache_dir=cache_dir)[1]
+
+    assert (stats.min, stats.max, stats.count) == (1, 2000, 2000)
+    assert cached.to_dict() == stats.to_dict()
+
+    # A truncated cache is recomputed and replaced
+    (fp_cache,) = (tmp_path / "cache").iterdir()
+    fp_cache.write_text(fp_cache.read_text()[:100])
+    recomputed = file_stats(fp, cache_dir=cache_dir)[1]
+    assert recomputed.to_dict() == stats.to_dict()
+    assert [p.name for p in (tmp_path / "cache").iterdir()] == [fp_cache.name]
+    assert file_stats(fp, cache_dir=cache_dir)[1].to_dict() == stats.to_dict()
@@ -0,0 +1,50 @@
+
+def test_scan(tmp_path):
+    """
+    Test that files and directories are found, with pruning and exclusion
+    """
+    from geotoys.system import list_dirs, list_ext
+
+    paths = [
+        "a/S2A_1.SAFE/GRANULE/B02.jp2",
+        "a/b/S2A_2.SAFE/B03.jp2",
+        "a/b/image.tif",
+        "a/b/image.tiff",
+        "tmp/S2A_3.SAFE/B04.jp2",
+    ]
+    for p in paths:
+        (tmp_path / p).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / p).touch()
+
+    safes = list_dirs(str(tmp_path), ".SAFE", exclude="tmp")
+    assert safes == [
+        str(tmp_path / "a/S2A_1.SAFE"),
+        str(tmp_path / "a/b/S2A_2.SAFE"),
+    ]
+
+    files = list_ext(str(tmp_path), ["jp2", ".tif"], include="B0[23]*")
+    assert files == [str(tmp_path / p) for p in sorted(paths[:2])]
+
+    files = list_ext(str(tmp_path), "tif")
+    assert files == [str(tmp_path / "a/b/image.tif")]
+
+
+def test_scan_symlink_loop(tmp_path):
+    """
+    Test that symbolic links to directories are followed once, without looping
+    """
+    from geotoys.system import list_ext
+
+    (tmp_path / "data/b").mkdir(parents=True)
+    (tmp_path / "data/b/image.tif").touch()
+    (tmp_path / "data/b/parent").symlink_to(tmp_path / "data")
+    (tmp_path / "link").symlink_to(tmp_path / "elsewhere")
+    (tmp_path / "elsewhere").mkdir()
+    (tmp_path / "elsewhere/other.tif").touch()
+
+    files = list_ext(str(tmp_path / "data"), "tif")
+    assert files == [str(tmp_path / "data/b/image.tif")]
+
+    files = list_ext(str(tmp_path), "tif")
+    assert len(files) == 2
+    assert str(tmp_path / "data/b/image.tif") in files
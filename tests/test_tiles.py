@@ -0,0 +1,70 @@
+
+def test_tile_range():
+    """
+    Test that tiles are found from bounds in Web Mercator and longitude, latitude
+    """
+    from geotoys.tiles import ORIGIN, tile_bounds, tile_range, tiles
+
+    assert tile_bounds(0, 0, 0) == (-ORIGIN, -ORIGIN, ORIGIN, ORIGIN)
+    assert tile_bounds(1, 0, 1) == (0, 0, ORIGIN, ORIGIN)
+    assert tile_range((1, 1, ORIGIN, ORIGIN), 1) == (range(1, 2), range(0, 1))
+    assert tiles((-180, -90, 180, 90), [0, 1]) == [
+        (0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1),
+        ]
+
+
+def test_render_tiles(tmp_path):
+    """
+    Test that tiles are rendered with transparency, and updated incrementally
+    """
+    from geotoys.tiles import lonlat_bounds, render_tiles, tiles
+    import numpy
+    import rasterio
+    from rasterio.transform import from_origin
+
+    fp_rgb = str(tmp_path / "rgb.tif")
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "count": 3,
+        "height": 100,
+        "width": 100,
+        "crs": "EPSG:32632",
+        "transform": from_origin(600000, 6650000, 100, 100),
+        }
+    with rasterio.open(fp_rgb, "w", **profile) as dst:
+        dst.write(numpy.full((3, 100, 100), 200, dtype="uint8"))
+
+    path_tiles = tmp_path / "tiles"
+    written = render_tiles([fp_rgb], str(path_tiles), [8, 9], n_workers=2)
+    bounds = lonlat_bounds(fp_rgb)
+    assert written == sorted(tiles(bounds, [8, 9]))
+
+    z, x, y = written[-1]
+    with rasterio.open(str(path_tiles / str(z) / str(x) / f"{y}.png")) as src:
+        assert src.count == 4 and src.width == 256
+        alpha = src.read(4)
+        assert alpha.any() and not alpha.all()
+        assert (src.read(1)[alpha > 0] == 200).all()
+
+    # Only tiles intersecting the bounds are re-rendered
+    bbox = (bounds[0], bounds[1], bounds[0] + 0.01, bounds[1] + 0.01)
+    written = render_tiles([fp_rgb], str(path_tiles), [9], bounds=bbox)
+    assert written == tiles(bbox, [9])
+
+
+def test_tile_jobs():
+    """
+    Test that each job of tiles is only given the sources intersecting it
+    """
+    from geotoys.tiles import _tile_jobs, tile_bounds
+
+    west, east = tile_bounds(0, 0, 1), tile_bounds(1, 1, 1)
+    sources = [("west.tif", west), ("east.tif", east)]
+    tile_list = [(2, 0, 0), (2, 0, 1), (2, 3, 2), (2, 3, 3), (2, 1, 2)]
+
+    jobs = _tile_jobs(sources, tile_list, 2)
+    assert jobs == [
+        ([sources[0]], tile_list[0:2]),
+        ([sources[1]], tile_list[2:4]),
+        ]